@@ -21,14 +21,12 @@ import arcpy
 CWDNAME = os.path.dirname(__file__)
 sys.path.append(CWDNAME)
 
-from nvdb_access.shared import (BaseTool, update_cfg, init_logging, request)
+from nvdb_access.shared import (BaseTool, init_logging, request, METRICS,
+                                dump_metrics)
 
-if sys.version_info[0] < 3:
-    from nvdb_access.yaml import load
-else:
-    from nvdb_access.yaml_3 import load
-from nvdb_access.da.meta_da import (build_meta, get_omrade_by_name, lokasjon_filter)
-from nvdb_access.da.data_da import populate_fc
+from nvdb_access.da.meta_da import (get_omrade_by_name, lokasjon_filter,
+                                    save_meta)
+from nvdb_access.da.data_da import populate_fc, clear_templates
 
 class HentData(BaseTool):
 
@@ -45,16 +43,6 @@ class HentData(BaseTool):
         self.__debug = debug
         self._ws = arcpy.env.workspace  # @UndefinedVariable
 
-    @classmethod
-    def set_config_meta(cls, cwd):
-        cls._cwd = cwd
-        # cls._cfg = load(file(os.path.join(cls._cwd, r'nvdb_access\config\config.yaml')))
-        cls._cfg = load(open(os.path.join(cls._cwd, r'nvdb_access\config\config.yaml')))
-        update_cfg(cls._cfg, cls._cwd)
-
-        cls._meta = build_meta(cls._cfg)
-
-
     #---------------------------------------------------------------------------------------
     # getParameterInfo
     #---------------------------------------------------------------------------------------
@@ -625,6 +613,7 @@ class HentData(BaseTool):
         # Initialize logging here, could use logging module instead of AddMessages and all that stuff
         init_logging(verbose=self.__debug)
         logger = logging.getLogger('hent_data_pyt')
+        METRICS.reset()
 
         objekttabell = self['objekttabell'].values
         out_geodatabase = self['out_geodatabase'].valueAsText
@@ -737,7 +726,11 @@ class HentData(BaseTool):
                                      vegreferanse=vegreferanse,
                                      lokasjon=loc_filter,
                                      max_pr_request=10000, overwrite=True,
-                                     extended_extras=extended_extras, verbose=True)
+                                     extended_extras=extended_extras,
+                                     stream=self._cfg.get('stream_pages', False),
+                                     partition_by=self._cfg.get('partition_by'),
+                                     partition_workers=self._cfg.get('partition_workers', 4),
+                                     verbose=True)
 
                 if result[2]:
                     other_fcs = result[2]
@@ -867,6 +860,10 @@ class HentData(BaseTool):
                     msgs = "GP ERRORS:\n{0}\n".format(arcpy.GetMessages(2))
                     logger.error(msgs)
 
+        save_meta(self._cfg, self._meta)
+        clear_templates()
+        dump_metrics(self._cfg)
+
 #---------------------------------------------------------------------------------------
 # main
 #---------------------------------------------------------------------------------------
@@ -18,14 +18,13 @@ import arcpy
 CWDNAME = os.path.dirname(__file__)
 sys.path.append(CWDNAME)
 
-from nvdb_access.shared import (BaseTool, update_cfg, init_logging, sok_parse, request)
+from nvdb_access.shared import (BaseTool, init_logging, sok_parse, request,
+                                METRICS, dump_metrics)
 
-if sys.version_info[0] < 3:
-    from nvdb_access.yaml import load
-else:
-    from nvdb_access.yaml_3 import load
-from nvdb_access.da.meta_da import (build_meta, get_omrade_by_name, lokasjon_filter)
-from nvdb_access.da.data_da import (populate_fc, lag_metrert_vegnett)
+from nvdb_access.da.meta_da import (get_omrade_by_name, lokasjon_filter,
+                                    save_meta)
+from nvdb_access.da.data_da import (populate_fc, lag_metrert_vegnett,
+                                    clear_templates)
 
 class LagMetrertVegnett(BaseTool):
 
@@ -43,15 +42,6 @@ class LagMetrertVegnett(BaseTool):
         self._ws = arcpy.env.workspace  # @UndefinedVariable
 
 
-    @classmethod
-    def set_config_meta(cls, cwd):
-        cls._cwd = cwd
-        cls._cfg = load(open(os.path.join(cls._cwd, r'nvdb_access\config\config.yaml')))
-        update_cfg(cls._cfg, cls._cwd)
-
-        cls._meta = build_meta(cls._cfg)
-
-
     #---------------------------------------------------------------------------------------
     # getParameterInfo
     #---------------------------------------------------------------------------------------
@@ -319,6 +309,7 @@ class LagMetrertVegnett(BaseTool):
 
         init_logging(verbose=self.__debug)
         logger = logging.getLogger('lag_metrert_vegnett_pyt')
+        METRICS.reset()
         # Skal alltid ha med utvida attributttabell for metrert vegnett
         extended_extras = True
 
@@ -414,7 +405,11 @@ class LagMetrertVegnett(BaseTool):
                         vegreferanse=vegreferanse,
                         lokasjon=loc_filter,
                         max_pr_request=10000, overwrite=True,
-                        extended_extras=extended_extras, verbose=True)
+                        extended_extras=extended_extras,
+                        stream=self._cfg.get('stream_pages', False),
+                        partition_by=self._cfg.get('partition_by'),
+                        partition_workers=self._cfg.get('partition_workers', 4),
+                        verbose=True)
 
             lag_metrert_vegnett(out_features_temp, out_features)
 
@@ -550,6 +545,10 @@ class LagMetrertVegnett(BaseTool):
                 msgs = "GP ERRORS:\n{0}\n".format(arcpy.GetMessages(2))
                 logger.error(msgs)
 
+        save_meta(self._cfg, self._meta)
+        clear_templates()
+        dump_metrics(self._cfg)
+
 #---------------------------------------------------------------------------------------
 # main
 #---------------------------------------------------------------------------------------
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+'''
+asyncio client for many small NVDB requests at once. Python 3 only, and
+needs aiohttp; *shared.gather_json()* falls back to threads without it.
+
+All requests are sent from one thread, while the cache, rate limiter,
+retry policy and metrics are those of the *NvdbClient* used by
+*request()*. Requests in flight count against the same per-host
+concurrency as threaded requests. Use it through *shared.gather_json()*.
+'''
+import asyncio
+from contextlib import asynccontextmanager
+import time
+from io import BytesIO
+from urllib.error import HTTPError
+from urllib.parse import urlparse
+
+import aiohttp
+
+from .shared import CannedResponse
+
+# Sekund mellom kvart forsøk på å få ein ledig plass hos rate limiteren
+SLOT_POLL = 0.01
+
+
+class AsyncNvdbClient(object):
+    '''
+    Sends GET requests for *client* with asyncio, at most *concurrency*
+    in flight pr host. Each request also holds one of the per-host slots of
+    *client.limiter*, so threads and the event loop share the limit.
+    '''
+
+    def __init__(self, client, concurrency=None):
+        self.client = client
+        self.concurrency = concurrency or client.limiter.concurrency
+        self._semaphores = {}
+
+    def _semaphore(self, host):
+        # Lagas i løkka som køyrer
+        sem = self._semaphores.get(host)
+        if sem is None:
+            sem = self._semaphores[host] = asyncio.Semaphore(self.concurrency)
+        return sem
+
+    @asynccontextmanager
+    async def _slot(self, host):
+        '''
+        Hold a slot of the shared limiter for *host*. The threading
+        semaphore cannot be awaited, so it is polled without blocking the
+        loop.
+        '''
+        limiter = self.client.limiter
+        async with self._semaphore(host):
+            while not limiter.try_acquire(host):
+                await asyncio.sleep(SLOT_POLL)
+            try:
+                yield
+            finally:
+                limiter.release(host)
+
+    async def _take_token(self, host):
+        limiter = self.client.limiter
+        while True:
+            wait = limiter.try_token(host)
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+    async def _send(self, session, url, headers, info):
+        '''
+        Returns *CannedResponse* for *url*, retrying as *NvdbClient._send()*.
+        Connection errors are retried *client.retries* times.
+        '''
+        limiter = self.client.limiter
+        host = urlparse(url).netloc
+        attempt = 0
+        failures = 0
+        while True:
+            try:
+                async with self._slot(host):
+                    await self._take_token(host)
+                    async with session.get(url, headers=headers) as resp:
+                        body = await resp.read()
+                        response = CannedResponse(url, resp.status,
+                                                  dict(resp.headers), body)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if failures >= self.client.retries:
+                    raise
+                failures += 1
+                await asyncio.sleep(min(limiter.max_backoff,
+                                        limiter.backoff * 2 ** failures))
+                continue
+            status = response.status_code
+            if status not in limiter.retry_statuses:
+                break
+            if attempt >= limiter.max_retries:
+                raise HTTPError(url, status, 'Ga opp etter %d forsøk' % (attempt + 1),
+                                response.headers, BytesIO(response.content))
+            delay = limiter.retry_delay(response, attempt)
+            if status == 429 or 'Retry-After' in response.headers:
+                limiter.block(host, delay)
+            await asyncio.sleep(delay)
+            attempt += 1
+        info['retries'] = attempt
+        return response
+
+    async def request(self, session, url, headers):
+        '''
+        Returns decoded JSON response from *url*, or '' if NVDB answers
+        with an error, as *NvdbClient.request()*
+        '''
+        client = self.client
+        info = {}
+        t0 = time.time()
+        try:
+            r, state = client._lookup(url, headers, info)
+            if state is None:
+                return r
+            response = await self._send(session, url, state[3], info)
+            return client._finish(url, response, state, t0, info)
+        except HTTPError as e:
+            info['status'] = e.code
+            raise
+        except Exception as e:
+            info['status'] = type(e).__name__
+            raise
+        finally:
+            client._record(url, info)
+
+    async def gather(self, urls, headers, return_exceptions=False):
+        connect_timeout, read_timeout = self.client.timeout
+        timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout,
+                                        sock_read=read_timeout)
+        connector = aiohttp.TCPConnector(limit=0,
+                                         limit_per_host=self.concurrency)
+        async with aiohttp.ClientSession(
+                timeout=timeout, connector=connector,
+                headers={'Accept-Encoding': 'gzip, deflate'}) as session:
+            return await asyncio.gather(
+                *[self.request(session, url, headers) for url in urls],
+                return_exceptions=return_exceptions)
+
+
+def gather_urls(client, urls, headers, concurrency=None,
+                return_exceptions=False):
+    '''
+    Returns list of decoded responses for *urls*, fetched in a new event
+    loop. See *shared.gather_json()*.
+    '''
+    loop = asyncio.new_event_loop()
+    try:
+        aclient = AsyncNvdbClient(client, concurrency)
+        return list(loop.run_until_complete(
+            aclient.gather(urls, headers, return_exceptions=return_exceptions)))
+    finally:
+        loop.close()
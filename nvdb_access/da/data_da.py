@@ -5,22 +5,31 @@ import sys
 from os.path import basename, dirname, join
 import pylab as pl
 from datetime import datetime
-from datetime import timedelta
+import threading
+import pickle
+import tempfile
 if sys.version_info[0] < 3:
     from urllib2 import HTTPError
     from urllib import urlencode
+    from urlparse import urlparse, urlunparse, parse_qsl
+    from Queue import Queue, Full, Empty
 else:
     from urllib.error import HTTPError
-    from urllib.parse import urlencode
+    from urllib.parse import urlencode, urlparse, urlunparse, parse_qsl
+    from queue import Queue, Full, Empty
 
 import logging
 
 import arcpy
-from arcpy.da import (InsertCursor, ListDomains, UpdateCursor) # @UnresolvedImport
+from arcpy.da import (InsertCursor, UpdateCursor) # @UnresolvedImport
 
 if not __name__ == '__main__':
-    from ..shared import request, sok_parse, arcyfy_name, extract_data
-    from .meta_da import _build_schema, _post_process_schema
+    from ..shared import (request, request_stream, sok_parse,
+                          arcyfy_name, extract_data)
+    from .meta_da import get_schema_grp, save_meta
+    from .domain_da import get_catalog, domain_name
+    from ..timeparse import parse_date, parse_full_time
+    from ..paging import PageSizeController
     from .geometry import check_empty_geometry, repair_inconsistent_geometry, WKT
 
 logger = logging.getLogger(__name__)
@@ -32,169 +41,225 @@ GEOMETRIES = {'POINT': ['POINT', 'MULTIPOINT'],
               'POLYGON': ['POLYGON', 'MULTIPOLYGON']
              }
 
-def _create_fc(cfg, fc, schema_grp, version, overwrite=False, spatial_ref='utm33',
-               extended_extras=False, verbose=False):
-    opath = dirname(fc)
-    oname = basename(fc)
-    if overwrite and arcpy.Exists(fc):
+def _delete_existing(fc):
+    '''
+    Delete *fc* if it exists
+    '''
+    if arcpy.Exists(fc):
         try:
             arcpy.Delete_management(fc)
         except arcpy.ExecuteError as e:
             if 'ERROR 000732' in e.message:
                 pass
 
+
+def _siblings(fc, geometry):
+    '''
+    Returns dictionary of sibling feature classes for the other geometry
+    types of *fc*, by geometry type
+    '''
+    # Hack: Ikke nødvendig for lag_metrert_vegnett_pyt.py
+    if geometry == 'none' or basename(fc) in ['Vegreferanse_temp']:
+        return {}
+    return dict((_geometry, fc + '_' + GEOMETRY_POSTFIX[_geometry])
+                for _geometry in GEOMETRY_POSTFIX
+                if not geometry.upper() in GEOMETRIES[_geometry])
+
+
+def _create_fc(cfg, fc, schema_grp, version, overwrite=False, spatial_ref='utm33',
+               extended_extras=False, verbose=False):
+    '''
+    Create table or feature class *fc*. Sibling feature classes for other
+    geometry types are left to *_Writers*, which creates them when the
+    first row needs one. With *overwrite* old siblings are deleted.
+    '''
+    geometry = schema_grp.attrs['geometry_type']
+    if overwrite:
+        _delete_existing(fc)
+        for new_fc in _siblings(fc, geometry).values():
+            _delete_existing(new_fc)
+
     if not arcpy.Exists(fc):
-        tmp_path = 'in_memory'
-        tmp_fc = join(tmp_path, oname)
-        if schema_grp.attrs['geometry_type'] == 'none':
+        if geometry == 'none':
             if verbose:
                 logger.info('Oppretter tabell uten geometri i %s' % (fc))
-
-            arcpy.CreateTable_management(tmp_path, oname)
-            _add_fields(tmp_fc, schema_grp, version, extended_extras,
-                        verbose=verbose)
-
-            arcpy.CreateTable_management(opath, oname, template=tmp_fc)
-            _add_domain_to_fields(fc, schema_grp, version, cfg, extended_extras,
-                                  verbose=verbose)
+            _create_output(cfg, fc, schema_grp, version, geometry,
+                           extended_extras=extended_extras, verbose=verbose)
 
         else:
             spatial_reference = arcpy.Describe(cfg['spatial_refs'][spatial_ref]).spatialReference
-            # TODO: Bruk arcpy func her?
-
-            geometry = schema_grp.attrs['geometry_type']
 
             if verbose:
                 msg = 'Oppretter featureklasse med %sgeometri i %s' % \
                       (cfg['invGeomTyperLut'][geometry].lower(), fc)
                 logger.info(msg)
-            arcpy.CreateFeatureclass_management(tmp_path, oname, geometry)
-            _add_fields(tmp_fc, schema_grp, version, extended_extras,
-                        verbose=verbose)
+            _create_output(cfg, fc, schema_grp, version, geometry,
+                           spatial_reference=spatial_reference,
+                           extended_extras=extended_extras, verbose=verbose)
 
-            arcpy.CreateFeatureclass_management(opath, oname, geometry,
-                                                template=tmp_fc,
-                                                spatial_reference=spatial_reference)
-            _add_domain_to_fields(fc, schema_grp, version, cfg, extended_extras,
-                                  verbose=verbose)
 
-            # Hack: Ikke nødvendig for lag_metrert_vegnett_pyt.py
-            if basename(fc) not in ['Vegreferanse_temp']:
-                if geometry.upper() not in GEOMETRIES['POINT']:
-                    _geometry = "POINT"
-                    oname = basename(fc) + '_' + GEOMETRY_POSTFIX[_geometry]
-                    new_fc = join(dirname(fc), oname)
-                    if overwrite and arcpy.Exists(new_fc):
-                        try:
-                            arcpy.Delete_management(new_fc)
-                        except arcpy.ExecuteError as e:
-                            if 'ERROR 000732' in e.message:
-                                pass
-                    if verbose:
-                        msg = u'Oppretter ekstra featureklasse med {}: {}'.format(GEOMETRY_POSTFIX[_geometry], new_fc)
-                        logger.info(msg)
-                    # has_z = 'ENABLED'
-                    arcpy.CreateFeatureclass_management(tmp_path, oname, _geometry)
-                    _add_fields(tmp_fc, schema_grp, version, extended_extras,
-                                verbose=verbose)
-
-                    arcpy.CreateFeatureclass_management(opath, oname, _geometry,
-                                                        template=tmp_fc,
-                                                        spatial_reference=spatial_reference)
-                    _add_domain_to_fields(new_fc, schema_grp, version, cfg, extended_extras,
-                                          verbose=verbose)
-
-                if geometry.upper() not in GEOMETRIES['POLYLINE']:
-                    _geometry = "POLYLINE"
-                    oname = basename(fc) + '_' + GEOMETRY_POSTFIX[_geometry]
-                    new_fc = join(dirname(fc), oname)
-                    if overwrite and arcpy.Exists(new_fc):
-                        try:
-                            arcpy.Delete_management(new_fc)
-                        except arcpy.ExecuteError as e:
-                            if 'ERROR 000732' in e.message:
-                                pass
-                    if verbose:
-                        msg = u'Oppretter ekstra featureklasse med {}: {}'.format(GEOMETRY_POSTFIX[_geometry], new_fc)
-                        logger.info(msg)
-                    arcpy.CreateFeatureclass_management(tmp_path, oname, _geometry)
-                    _add_fields(tmp_fc, schema_grp, version, extended_extras,
-                                verbose=verbose)
-
-                    arcpy.CreateFeatureclass_management(opath, oname, _geometry,
-                                                        template=tmp_fc,
-                                                        spatial_reference=spatial_reference)
-                    _add_domain_to_fields(new_fc, schema_grp, version, cfg, extended_extras,
-                                          verbose=verbose)
-
-                if geometry.upper() not in GEOMETRIES['POLYGON']:
-                    _geometry = "POLYGON"
-                    oname = basename(fc) + '_' + GEOMETRY_POSTFIX[_geometry]
-                    new_fc = join(dirname(fc), oname)
-                    if overwrite and arcpy.Exists(new_fc):
-                        try:
-                            arcpy.Delete_management(new_fc)
-                        except arcpy.ExecuteError as e:
-                            if 'ERROR 000732' in e.message:
-                                pass
-                    if verbose:
-                        msg = u'Oppretter ekstra featureklasse med {}: {}'.format(GEOMETRY_POSTFIX[_geometry], new_fc)
-                        logger.info(msg)
-                    arcpy.CreateFeatureclass_management(tmp_path, oname, _geometry)
-                    _add_fields(tmp_fc, schema_grp, version, extended_extras,
-                                verbose=verbose)
-
-                    arcpy.CreateFeatureclass_management(opath, oname, _geometry,
-                                                        template=tmp_fc,
-                                                        spatial_reference=spatial_reference)
-                    _add_domain_to_fields(new_fc, schema_grp, version, cfg, extended_extras,
-                                          verbose=verbose)
+class _SpillBuffer(object):
+    '''
+    Rows held for later, at most *max_rows* of them in memory. Beyond that
+    rows are written to a temporary file, in chunks of *max_rows* with one
+    list pr column, and read back one chunk at a time by *drain()*.
+    '''
 
-def _create_domains(cfg, fc, schema_grp, version, verbose=False):
+    def __init__(self, max_rows=5000):
+        self.max_rows = max(1, max_rows)
+        self._rows = []
+        self._file = None
+        self.spilled = 0
+
+    def __len__(self):
+        return self.spilled + len(self._rows)
+
+    def append(self, row):
+        self._rows.append(row)
+        if len(self._rows) >= self.max_rows:
+            self._spill()
+
+    def _spill(self):
+        if self._file is None:
+            self._file = tempfile.TemporaryFile()
+        pickle.dump(list(zip(*self._rows)), self._file, 2)
+        self.spilled += len(self._rows)
+        self._rows = []
+
+    def drain(self):
+        '''
+        Yields all rows in the order they were added. Call *clear()*
+        afterwards.
+        '''
+        if self._file is not None:
+            self._file.seek(0)
+            while True:
+                try:
+                    columns = pickle.load(self._file)
+                except EOFError:
+                    break
+                for row in zip(*columns):
+                    yield list(row)
+        for row in self._rows:
+            yield row
+
+    def clear(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self.spilled = 0
+        self._rows = []
+
+
+class _Writers(object):
     '''
-    Create domains in gdb, checks if domain already exists
+    Registry of outputs for the rows of one object type. Rows with the
+    geometry type of *fc* are inserted through one cursor, kept open
+    across pages. Rows with other geometry types are held by type in a
+    *_SpillBuffer* of *cfg['spill_rows']* rows until *close()*, and then
+    written to the sibling feature class, which is created the first time.
+    Only one insert cursor is open at a time.
     '''
-    rkeys = cfg['response_keys']
-    # Use arcpy
-    gdb = dirname(fc)
-    # list domains in gdb
-    domains = [d.name for d in ListDomains(gdb)]
-    # Loop over egenskaper in schema_grp and create domain if not already in
-    # domains
-    egrp = schema_grp['egenskaper']
-    nms = egrp['navn']
-    nv_dt = egrp['nvdb_dt']
-    arc_dt = egrp['dt']
-    u = egrp['uri']
-    dbids = egrp['id']
-    f = lambda n, i, v: arcyfy_name('%s_%d_%s' % (n, i, v))
-#     f = lambda n, i, v: arcpy.ValidateFieldName('%s_%d_%s' % (n, i, v), gdb)
-    d_names = [f(n, i, version) for n, i, d in zip(nms, dbids, nv_dt) if d in cfg['typer']['enum']]
-
-    n_nonexist = len(set(d_names).difference(domains))
-    if verbose and n_nonexist:
-        logger.info('Lager %d nye domener for ENUM-verdier' % n_nonexist)
-    for name, dbid, nvdb_dt, dt, uri in zip(nms, dbids, nv_dt, arc_dt, u):
-#         name = arcyfy_name(name)
-        if nvdb_dt in cfg['typer']['enum']:
-            # Get domain info from nvdb
-            r = request(cfg['baseurl'], uri, cfg['headers'])
+
+    def __init__(self, cfg, fc, schema_grp, version, colnames,
+                 extended_extras=False, spatial_ref='utm33', verbose=False):
+        self.cfg = cfg
+        self.fc = fc
+        self.schema_grp = schema_grp
+        self.version = version
+        self.colnames = colnames
+        self.extended_extras = extended_extras
+        self.spatial_ref = spatial_ref
+        self.verbose = verbose
+        self.siblings = _siblings(fc, schema_grp.attrs['geometry_type'])
+        spill_rows = cfg.get('spill_rows', 5000)
+        self._pending = dict((geometry, _SpillBuffer(spill_rows))
+                             for geometry in self.siblings)
+        self._ready = set()
+        self._cursor = None
+
+    def insert(self, row):
+        if self._cursor is None:
+            self._cursor = InsertCursor(self.fc, self.colnames)
+        self._cursor.insertRow(row)
+
+    def defer(self, geometry, row):
+        '''
+        Hold *row* for the sibling of *geometry*. Returns False if *fc*
+        has no such sibling.
+        '''
+        try:
+            self._pending[geometry].append(row)
+        except KeyError:
+            return False
+        return True
+
+    def _close_cursor(self):
+        if self._cursor is not None:
+            del self._cursor
+            self._cursor = None
+
+    def _prepare(self, geometry):
+        '''
+        Make sure the sibling for *geometry* exists
+        '''
+        fc2 = self.siblings[geometry]
+        if geometry in self._ready:
+            return fc2
+        if not arcpy.Exists(fc2):
+            if self.verbose:
+                msg = u'Oppretter ekstra featureklasse med {}: {}'.format(GEOMETRY_POSTFIX[geometry], fc2)
+                logger.info(msg)
+            spatial_reference = arcpy.Describe(self.cfg['spatial_refs'][self.spatial_ref]).spatialReference
+            _create_output(self.cfg, fc2, self.schema_grp, self.version,
+                           geometry, spatial_reference=spatial_reference,
+                           extended_extras=self.extended_extras)
+        self._ready.add(geometry)
+        return fc2
+
+    def flush(self):
+        '''
+        Write rows held for siblings. If a sibling fails, the others are
+        still written, and the first error is raised afterwards, as the
+        rows are already counted as stored.
+        '''
+        failed = None
+        for geometry, rows in self._pending.items():
+            nrows = len(rows)
+            if not nrows:
+                continue
+            self._close_cursor()
+            fc2 = self.siblings[geometry]
+            nwritten = 0
             try:
-                desc = r[rkeys['egskap.beskriv']]
-            except:
-                desc = 'Ingen beskrivelse'
-            # Create new domain
-            dbid = r[rkeys['egskap.id']]
-            # TODO: Kva skjer hvis domenenavnet eksisterer, men ikkje verdiene?
-            dname = '%s_%d_%s' % (name, int(dbid), version)
-#             domain_name = arcpy.ValidateFieldName(dname, gdb)
-            domain_name = arcyfy_name(dname)
-            if not domain_name in domains:
-                arcpy.CreateDomain_management(gdb, domain_name, desc, dt)
-                for verdi in r[rkeys['egskap.eVerdi']]:
-                    mapped_from = verdi[rkeys['egskap.eVerdi.id']]
-                    mapped_to = verdi[rkeys['egskap.eVerdi.verdi']]
-                    arcpy.AddCodedValueToDomain_management(gdb, domain_name, mapped_from, mapped_to)
+                fc2 = self._prepare(geometry)
+                with InsertCursor(fc2, self.colnames) as cursor2:
+                    for row in rows.drain():
+                        cursor2.insertRow(row)
+                        nwritten += 1
+            except Exception as e:
+                logger.error(u'Klarte ikke skrive {} rader med {} til {}, {} skrevet: {}'.format(
+                    nrows, GEOMETRY_POSTFIX[geometry], fc2, nwritten, e))
+                if failed is None:
+                    failed = e
+            finally:
+                rows.clear()
+        if failed is not None:
+            raise failed
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self._close_cursor()
+
+
+def _create_domains(cfg, fc, schema_grp, version, verbose=False):
+    '''
+    Create domains in gdb, unchanged domains already in gdb are skipped
+    '''
+    catalog = get_catalog(cfg, version)
+    catalog.create_domains(dirname(fc), schema_grp, verbose=verbose)
 
 def _cat_schema(schema_grp, version=None, extended_extras=False,
                 verbose=False):
@@ -240,109 +305,293 @@ def _cat_schema(schema_grp, version=None, extended_extras=False,
     return id_ls, name_ls, dt_ls, nvdb_dt_ls
 
 
-def _add_fields(fc, schema_grp, version, extended_extras=False,
-                verbose=False):
+# Feltbeskrivelser pr (dbid, version, extended_extras), se _field_specs()
+_FIELD_SPECS = {}
+# Maler i in_memory pr (dbid, version, extended_extras, geometri), for
+# arcpy uten AddFields
+_TEMPLATES = {}
+
+
+def _schema_key(schema_grp, version, extended_extras):
+    return (schema_grp.attrs.get('dbid', schema_grp.name), version,
+            bool(extended_extras))
+
+
+def _field_specs(cfg, schema_grp, version, extended_extras=False):
     '''
-    Adding fields in order
+    Returns field description table for *schema_grp*, with one row
+    *[name, type, alias, length, default, domain]* pr field, as expected by
+    *AddFields*. Computed once pr (dbid, version, extended_extras).
     '''
-    gdb = dirname(fc)
+    key = _schema_key(schema_grp, version, extended_extras)
+    try:
+        return _FIELD_SPECS[key]
+    except KeyError:
+        pass
     id_ls, name_ls, dt_ls, nvdb_dt_ls = _cat_schema(schema_grp, version,
-                                                    extended_extras=extended_extras,
-                                                    verbose=verbose)
-    if verbose:
-        nfields = len(name_ls)
-        msg_ls = ['Legger til %d felt.' % nfields]
-        if nfields > 10:
-            msg_ls.append('Dette kan ta litt tid...')
-        logger.info(' '.join(msg_ls))
-    # Iterate over fields
-    for f in zip(name_ls, dt_ls, nvdb_dt_ls, id_ls):
-        ft = f[1]
-        if f[0] == 'SHAPE@WKT':
+                                                    extended_extras=extended_extras)
+    specs = []
+    for name, ft, nvdb_dt, dbid in zip(name_ls, dt_ls, nvdb_dt_ls, id_ls):
+        if name == 'SHAPE@WKT':
             continue
         elif ft == 'ENUM':
             ft = 'LONG'
-
-        fn = arcyfy_name(f[0])
-#        fn = arcpy.ValidateFieldName(f[0], gdb)
+        fn = arcyfy_name(name)
+        domain = None
+        if nvdb_dt in cfg['typer']['enum']:
+            domain = domain_name(fn, dbid, version)
         # TODO: Alias?
-        # logger.debug('AddField_management(fc, field_name="{}", field_type="{}")'.format(fn, ft))
-        arcpy.AddField_management(fc, field_name=fn, field_type=ft)
+        specs.append([fn, ft, None, None, None, domain])
+    _FIELD_SPECS[key] = specs
+    return specs
 
-def _add_domain_to_fields(fc, schema_grp, version, cfg, extended_extras=False,
-                          verbose=False):
-    gdb = dirname(fc)
-    id_ls, name_ls, dt_ls, nvdb_dt_ls = _cat_schema(schema_grp, version,
-                                                    extended_extras=extended_extras,
-                                                    verbose=verbose)
-    for f in zip(name_ls, dt_ls, nvdb_dt_ls, id_ls):
-        if f[0] == 'SHAPE@WKT':
-            continue
-#         fn = arcpy.ValidateFieldName(f[0], gdb)
-        fn = arcyfy_name(f[0])
-        if f[2] in cfg['typer']['enum']:
-            dname = '%s_%d_%s' % (fn, int(f[3]), version)
-            # domain_name = arcpy.ValidateFieldName(dname, gdb)
-            domain_name = arcyfy_name(dname)
-            arcpy.AssignDomainToField_management(fc, fn, domain_name)
+
+def _template(cfg, schema_grp, version, geometry, extended_extras=False,
+              verbose=False):
+    '''
+    Returns in_memory table (*geometry* 'none') or feature class with all
+    fields of *schema_grp*, made once pr (dbid, version, extended_extras,
+    geometry)
+    '''
+    key = _schema_key(schema_grp, version, extended_extras) + (geometry,)
+    tmp_fc = _TEMPLATES.get(key)
+    if tmp_fc is not None and arcpy.Exists(tmp_fc):
+        return tmp_fc
+    specs = _field_specs(cfg, schema_grp, version, extended_extras)
+    tmp_fc = arcpy.CreateUniqueName('nvdb_mal', 'in_memory')
+    if geometry == 'none':
+        arcpy.CreateTable_management('in_memory', basename(tmp_fc))
+    else:
+        arcpy.CreateFeatureclass_management('in_memory', basename(tmp_fc), geometry)
+    if verbose and len(specs) > 10:
+        logger.info('Legger til %d felt. Dette kan ta litt tid...' % len(specs))
+    for spec in specs:
+        arcpy.AddField_management(tmp_fc, field_name=spec[0], field_type=spec[1])
+    _TEMPLATES[key] = tmp_fc
+    return tmp_fc
+
+
+def clear_templates():
+    '''
+    Delete the in_memory templates made by *_template()*
+    '''
+    while _TEMPLATES:
+        _, tmp_fc = _TEMPLATES.popitem()
+        try:
+            if arcpy.Exists(tmp_fc):
+                arcpy.Delete_management(tmp_fc)
+        except Exception:
+            logger.debug('Klarte ikke slette mal %s', tmp_fc, exc_info=True)
+
+
+def _create_output(cfg, fc, schema_grp, version, geometry, spatial_reference=None,
+                   extended_extras=False, verbose=False):
+    '''
+    Create table (*geometry* 'none') or feature class *fc* with all fields
+    of *schema_grp* and their domains. With *AddFields* (ArcGIS Pro) every
+    field is added in one call, otherwise *fc* is made from a template and
+    the domains are assigned afterwards.
+    '''
+    opath = dirname(fc)
+    oname = basename(fc)
+    specs = _field_specs(cfg, schema_grp, version, extended_extras)
+    if hasattr(arcpy, 'AddFields_management'):
+        if verbose:
+            logger.info('Legger til %d felt.' % len(specs))
+        if geometry == 'none':
+            arcpy.CreateTable_management(opath, oname)
+        else:
+            arcpy.CreateFeatureclass_management(opath, oname, geometry,
+                                                spatial_reference=spatial_reference)
+        if specs:
+            arcpy.AddFields_management(fc, specs)
+        return
+
+    template = _template(cfg, schema_grp, version, geometry, extended_extras,
+                         verbose=verbose)
+    if geometry == 'none':
+        arcpy.CreateTable_management(opath, oname, template=template)
+    else:
+        arcpy.CreateFeatureclass_management(opath, oname, geometry,
+                                            template=template,
+                                            spatial_reference=spatial_reference)
+    for spec in specs:
+        if spec[5]:
+            arcpy.AssignDomainToField_management(fc, spec[0], spec[5])
+
+
+def _to_double(thing):
+    try:
+        return float(thing)
+    except:
+        return None
+
+
+def _to_long(thing):
+    try:
+        return int(thing)
+    except:
+        return None
+
+
+def _to_text(thing):
+    try:
+        return format(thing[:255])
+    except:
+        return None
+
+
+def _to_wkt(thing):
+    try:
+        return format(thing)
+    except:
+        return None
+
+
+def _date_converter(fmts):
+    '''
+    Returns converter for NVDB timestamps, falling back to trying the date
+    formats *fmts* in order
+    '''
+    def _to_date(thing):
+        dtime = parse_date(thing)
+        if dtime is not None or thing is None:
+            return dtime
+        for fmt in fmts:
+            try:
+                # TODO: Klokkeslett felt blir nå satt til 1900-tallet, finnes det en Time felttype i ArcGIS DB?
+                return datetime.strptime(thing, fmt)
+            except (TypeError, ValueError):
+                pass
+        return None
+    return _to_date
+
+
+def _unknown_converter(dt):
+    def _to_unknown(thing):
+        if thing is not None:
+            logger.debug('Ukjent datatype %s, verdi %s ignoreres', dt, thing)
+        return None
+    return _to_unknown
 
 
-def _populate_row(cfg, attributes, colnames, data_types,
-                  verbose=False):
+# Compiled row plans, keyed by columns, data types and date formats
+_ROW_PLANS = {}
+
+
+def _get_row_plan(cfg, colnames, data_types):
     '''
-    Populates row with data from *attributes*.
+    Returns row plan for *colnames*/*data_types*. A row plan is a tuple
+    *(plan, wkt_index)* where *plan* is a tuple of *(colname, converter)*,
+    one per column, and *wkt_index* is the position of SHAPE@WKT (or None).
+    The plan is compiled once and reused for every row with the same
+    columns.
 
     :param cfg: Dictionary
-    :param attributes:
-    :param colnames:
-    :param data_types:
-    :param verbose:
+    :param colnames: Column names
+    :param data_types: Column data types, as in *cfg['typerLut']*
     '''
-    row = []
+    fmts = tuple(cfg['try_fmts'].values())
+    key = (tuple(colnames), tuple(data_types), fmts)
+    try:
+        return _ROW_PLANS[key]
+    except KeyError:
+        pass
 
+    to_date = _date_converter(fmts)
+    plan = []
     for c, dt in zip(colnames, data_types):
-        try:
-            thing = attributes.pop(c)
-        except KeyError:
-            row.append(None)
+        udt = dt.upper()
+        if udt == 'DOUBLE':
+            conv = _to_double
+        elif udt == 'LONG':
+            conv = _to_long
+        elif udt in ['TEXT', 'STRING']:
+            conv = _to_wkt if c == 'SHAPE@WKT' else _to_text
+        elif udt == 'DATE':
+            conv = to_date
         else:
-            if dt.upper() == 'DOUBLE':
-                try:
-                    row.append(float(thing))
-                except:
-                    row.append(None)
-            elif dt.upper() == 'LONG':
-                try:
-                    row.append(int(thing))
-                except:
-                    row.append(None)
-            elif dt.upper() in ['TEXT', 'STRING']:
-                try:
-                    if not c == 'SHAPE@WKT':
-                        thing = thing[:255]
-                    row.append(format(thing))
-                except:
-                    row.append(None)
-            elif dt.upper() == 'DATE':
-                dtime = None
-                for fmt in cfg['try_fmts'].values():
-                    try:
-                        # TODO: Klokkeslett felt blir nå satt til 1900-tallet, finnes det en Time felttype i ArcGIS DB?
-                        dtime = datetime.strptime(thing, fmt)
-                        break
-                    except ValueError:
-                        pass
+            conv = _unknown_converter(dt)
+        plan.append((c, conv))
+    colnames = list(colnames)
+    wkt_index = colnames.index('SHAPE@WKT') if 'SHAPE@WKT' in colnames else None
+    _ROW_PLANS[key] = (tuple(plan), wkt_index)
+    return _ROW_PLANS[key]
 
-                row.append(dtime)
-            else:
-                # TODO: Send denne til logger
-                print(format(thing))
-#                         row.append(thing)
-    return row
 
-def _dump_elements(cfg, r, fc, schema_grp, extended_extras=False,
-                   store_failed=False, debug=False, total_get=None):
-    gdb = dirname(fc)
+def _apply_row_plan(plan, attributes):
+    '''
+    Returns row with data from *attributes* converted according to *plan*
+    '''
+    get = attributes.get
+    return [conv(get(c)) for c, conv in plan]
+
+
+def _drain(objs):
+    '''
+    Yields objects of page list *objs* one at a time, removing each from
+    the list as it is yielded so it can be released right away. Lists that
+    can not be modified are iterated without removing anything.
+    '''
+    try:
+        objs.reverse()
+    except (AttributeError, TypeError):
+        for elem in objs:
+            yield elem
+        return
+    pop = objs.pop
+    while objs:
+        yield pop()
+
+
+def _flatten(cfg, elems, geom_type, gdb, debug=False):
+    '''
+    Yields *(attributes, has_geom)* for each object in *elems*
+    '''
+    for elem in elems:
+        # Start med tom attributt-dict
+        attributes = {}
+        extract_data(cfg, elem, attributes, prefix='nvdb', gdb=gdb)
+        del elem
+
+        # Check for empty geometry, Trengs kanskje ikke lenger!!
+        has_geom = check_empty_geometry(cfg, attributes, geom_type)
+        if has_geom:
+            try:
+                repair_inconsistent_geometry(attributes)
+            except:
+                logger.debug('Forsøkte å reparere geometri, men det feila', exc_info=debug)
+        yield attributes, has_geom
+
+
+def _convert(plan, flat):
+    '''
+    Yields *(row, has_geom)* converted with row *plan*
+    '''
+    for attributes, has_geom in flat:
+        yield _apply_row_plan(plan, attributes), has_geom
+
+
+def _route(cfg, wkt_str, expected_wkt_geom_type):
+    '''
+    Returns *(known, key)*, where *known* tells if the geometry differs
+    from *expected_wkt_geom_type*, and *key* is the geometry type it
+    should be stored as instead (None if there is no such type)
+    '''
+    wkt = WKT(wkt_str)
+    wkt_geometry_type = wkt.get_geometry_type(failIfUnknown=False)
+    if wkt.has_known_geometry_type() and not wkt_geometry_type == expected_wkt_geom_type:
+        for geometry_type in cfg['wktTyperLut']:
+            if wkt_geometry_type in cfg['wktTyperLut'][geometry_type]:
+                return True, geometry_type
+        return True, None
+    return False, None
+
+
+def _dump_columns(schema_grp, extended_extras=False):
+    '''
+    Returns *(colnames, data_types)* of the rows made by *_dump_elements()*
+    '''
     grps = [schema_grp['egenskaper'], schema_grp['default_extras']]
     if extended_extras:
         grps.append(schema_grp['extended_extras'])
@@ -355,52 +604,46 @@ def _dump_elements(cfg, r, fc, schema_grp, extended_extras=False,
 
     # Validate names, except SHAPE@WKT
     colnames = [arcyfy_name(n) if not 'SHAPE@' in n else n for n in cn]
+    return colnames, data_types
+
+
+def _dump_elements(cfg, r, writers, schema_grp, extended_extras=False,
+                   store_failed=False, debug=False, total_get=None):
+    '''
+    Insert objects in page *r* through *writers*, returns number of rows
+    stored
+    '''
+    gdb = dirname(writers.fc)
+    colnames, data_types = _dump_columns(schema_grp, extended_extras)
     geom_type = schema_grp.attrs['geometry_type']
+    plan, wkt_index = _get_row_plan(cfg, colnames, data_types)
 
     # Build lookup for attributes in r
     rkeys = cfg['response_keys']
     nelem_appended = 0
     message_step = 1000000
 
-    row_cache = {}
-    for key in GEOMETRY_POSTFIX: #.keys():
-        if key != geom_type:
-            row_cache[key] = []
+    # Objekta blir konsumert eitt og eitt gjennom kjeda
+    # side -> flate ut -> konverter -> ruting på geometri -> insert
+    objs = _drain(r[rkeys['vegObjektType.objekter']])
+    flat = _flatten(cfg, objs, geom_type, gdb, debug=debug)
+    rows = _convert(plan, flat)
 
-    cursor = InsertCursor(fc, colnames)
-    cursor2 = None
-    while r[rkeys['vegObjektType.objekter']]:
+    for row, has_geom in rows:
         total = total_get + nelem_appended
         if total > 0 and (total + 1) % message_step == 0:
             logger.info('Henta totalt {} objekter.'.format(total + 1))
 
-        elem = r[rkeys['vegObjektType.objekter']].pop(0)
-        # Start med tom attributt-dict
-        attributes = {}
-        extract_data(cfg, elem, attributes, prefix='nvdb', gdb=gdb)
-
-        # Check for empty geometry, Trengs kanskje ikke lenger!!
-        has_geom = check_empty_geometry(cfg, attributes, geom_type)
-        if has_geom:
-            try:
-                repair_inconsistent_geometry(attributes)
-            except:
-                logger.debug('Forsøkte å reparere geometri, men det feila', exc_info=debug)
-
-        row = _populate_row(cfg, attributes, colnames, data_types, True)
-
         try:
             # New 19.06.2018: Check geometry type before insertRow
             expected_wkt_geom_type = cfg['wktTyperLut'][geom_type]
-            wkt = WKT(row[colnames.index('SHAPE@WKT')])
-            wkt_geometry_type = wkt.get_geometry_type(failIfUnknown=False)
-            if wkt.has_known_geometry_type() and not wkt_geometry_type == expected_wkt_geom_type:
-                for geometry_type in cfg['wktTyperLut']:
-                    if wkt_geometry_type in cfg['wktTyperLut'][geometry_type]:
-                        row_cache[geometry_type].append(row)
-                        break
+            other, geometry_type = _route(cfg, row[wkt_index],
+                                          expected_wkt_geom_type)
+            if other:
+                if geometry_type is not None:
+                    writers.defer(geometry_type, row)
             else:
-                cursor.insertRow(row)
+                writers.insert(row)
 
             # Original code
             # cursor.insertRow(row)
@@ -412,34 +655,29 @@ def _dump_elements(cfg, r, fc, schema_grp, extended_extras=False,
 
             # Still fails: Try to save as other geometry type
             expected_wkt_geom_type = cfg['wktTyperLut'][geom_type]
-            wkt = WKT(row[colnames.index('SHAPE@WKT')])
             still_failed = True
-            wkt_geometry_type = wkt.get_geometry_type(failIfUnknown=False)
-            if wkt.has_known_geometry_type() and not wkt_geometry_type == expected_wkt_geom_type:
+            other, geometry_type = _route(cfg, row[wkt_index],
+                                          expected_wkt_geom_type)
+            if other:
                 still_failed = False
-                for geometry_type in cfg['wktTyperLut']:
-                    if wkt_geometry_type in cfg['wktTyperLut'][geometry_type]:
-                        try:
-                            row_cache[geometry_type].append(row)
-                            nelem_appended += 1
-                        except Exception as e:
-                            logger.info('error: {}'.format(e))
-                            still_failed = True
-                        finally:
-                            break
+                if geometry_type is not None:
+                    try:
+                        writers.defer(geometry_type, row)
+                        nelem_appended += 1
+                    except Exception as e:
+                        logger.info('error: {}'.format(e))
+                        still_failed = True
             else:
                 arcpy.AddMessage('No geometry found.')
 
             if store_failed and has_geom:
-                wkt = WKT(row[colnames.index('SHAPE@WKT')])
+                wkt = WKT(row[wkt_index])
                 expected_wkt_geom_type = cfg['wktTyperLut'][geom_type]
                 if not wkt.has_known_geometry_type() or not wkt.get_geometry_type(failIfUnknown=False) == expected_wkt_geom_type:
-                    row[colnames.index('SHAPE@WKT')] = '%s %s' % (cfg['wktTyperLut'][geom_type],
-                                                                  cfg['wktEmpty'])
+                    row[wkt_index] = '%s %s' % (cfg['wktTyperLut'][geom_type],
+                                                cfg['wktEmpty'])
                 try:
-                    if not cursor:
-                        cursor = InsertCursor(fc, colnames)
-                    cursor.insertRow(row)
+                    writers.insert(row)
                     nelem_appended += 1
                 except:
                     still_failed = True
@@ -449,63 +687,52 @@ def _dump_elements(cfg, r, fc, schema_grp, extended_extras=False,
                 #raise
                 logger.error('Insert error')
 
-    # for key in GEOMETRY_POSTFIX.iterkeys():
-    for key in GEOMETRY_POSTFIX: #.keys():
-        # if row_cache.has_key(key):
-        if key in row_cache:
-            fc2 = fc + '_' + GEOMETRY_POSTFIX[key]
-            # logger.info(u'(dbg) fc2: {}'.format(fc2))
-            if arcpy.Exists(fc2):
-                try:
-                    if cursor:
-                        del cursor
-                        cursor = None
-                    with InsertCursor(fc2, colnames) as cursor2:
-                        for row in row_cache[key]:
-                            cursor2.insertRow(row)
-                except Exception as e:
-                    logger.info('(dbg) : {}'.format(e))
-
     return nelem_appended
 
 
-def _parse_full_time(t, fmt):
-    try:
-        dt, tz_str = t.split('+')
-    except ValueError:
-        offset = timedelta(hours=1.0)
-        dt = t
-    else:
-        if len(tz_str) == 4:
-            tz_str = '%s:%s' % (tz_str[:2], tz_str[2:])
-        tdelta = float(tz_str.replace(':', '.'))
-        offset = timedelta(hours=tdelta)
-    return datetime.strptime(dt, fmt), offset
+def _set_query_param(uri, key, value):
+    '''
+    Returns *uri* with query parameter *key* set to *value*
+    '''
+    p = urlparse(uri)
+    query = [(k, v) for k, v in parse_qsl(p.query) if k != key]
+    query.append((key, value))
+    return urlunparse((p.scheme, p.netloc, p.path, p.params,
+                       urlencode(query), p.fragment))
+
 
 def get_deleted(cfg, metafile, dbid, max_pr_request=10000,
-                deleted_since=None,
+                deleted_since=None, pager=None,
                 verbose=True):
     # List of deleted features
     # TODO: Mindre hardkoding, meir dynamisk
     # Hardkoder uri enn sa lenge
-    del_uri = '/endringer/objekttype/%s/slettet?rows=%d' % (str(dbid),
-                                                            max_pr_request)
+    if pager is None:
+        pager = PageSizeController.from_config(cfg, maximum=max_pr_request,
+                                               name='slettet %s' % dbid)
+    del_uri = '/endringer/objekttype/%s/slettet' % str(dbid)
     rkeys = cfg['response_keys']
     e_types = cfg['endreTyperLut']
     deleted = []
+    if deleted_since:
+        dtime_lim, offset_lim = parse_full_time(deleted_since)
+        utc_lim = dtime_lim - offset_lim
     while del_uri:
-        r = request(cfg['baseurl'], del_uri, cfg['headers'])
+        # Sidestørrelsen blir valt på nytt for kvar side, også i next-lenka
+        rows = pager.next_size()
+        info = {}
+        r = request(cfg['baseurl'], _set_query_param(del_uri, 'rows', rows),
+                    cfg['headers'], info=info, coalesce=False)
+        pager.record(rows, len(r[rkeys['endre.trans']]),
+                     info.get('elapsed', 0.), info.get('bytes'))
         # Read returned objects
         for e in r[rkeys['endre.trans']]:
             if e[rkeys['endre.trans.type']] == e_types['delete']:
                 if deleted_since:
                     deleted_this = e[rkeys['endre.trans.dato']]
-                    dtime_lim, offset_lim = _parse_full_time(deleted_since,
-                                                             cfg['time_fmt']['full'])
-                    dtime_del, offset_del = _parse_full_time(deleted_this,
-                                                             cfg['time_fmt']['full'])
+                    dtime_del, offset_del = parse_full_time(deleted_this)
 
-                    if dtime_del - offset_del < dtime_lim - offset_lim:
+                    if dtime_del - offset_del < utc_lim:
                         continue
                 deleted.append(e[rkeys['endre.trans.id']])
         del_uri = r['next']
@@ -565,6 +792,7 @@ def multi_update_fc(cfg, meta, fc_list=None, objektTyper=None,
         msg = 'Oppdaterer %s' % fc
         logger.info(msg)
         update_fc(cfg, meta, fc, objTyp, **kwargs)
+    save_meta(cfg, meta)
 
 
 def update_fc(cfg, metafile, fc, objektTyper,
@@ -577,7 +805,8 @@ def update_fc(cfg, metafile, fc, objektTyper,
     :param fc:
     :param objektTyper:
     :param lokasjon:
-    :param max_pr_request:
+    :param max_pr_request: Upper limit for page size, the page size is
+        otherwise chosen by *PageSizeController*
     :param modified_since:
     :param extended_extras:
     :param verbose:
@@ -600,20 +829,7 @@ def update_fc(cfg, metafile, fc, objektTyper,
 
     # get location of schema, create it if it doesn't exist
     # and (implicitly) make sure dbid is available in nvdb
-
-    #
-    schema_uri, name = metafile.by_dbid(dbid)
-    try:
-        schema_grp = metafile[schema_uri]
-    except KeyError:
-        # TODO: Move this to function
-        msg = 'Henter feltnavn og datatyper'
-        logger.info(msg)
-        schema_grp = metafile.create_group(schema_uri)
-        schema_grp.attrs['dbid'] = dbid
-        schema_grp.attrs['name'] = name
-        _build_schema(cfg, schema_grp, schema_uri)
-        _post_process_schema(cfg, metafile, schema_grp)
+    schema_grp = get_schema_grp(cfg, metafile, dbid)
 
     # Hent modifisert fra nvdb, vanlig sok
     # Forst: sett opp antall og startpunkt
@@ -643,25 +859,39 @@ def update_fc(cfg, metafile, fc, objektTyper,
     msg = u'Henter data fra NVDB for %s' % fc
     logger.info(msg)
 
-    deleted = get_deleted(cfg, metafile, dbid,
-                          max_pr_request=max_pr_request,
-                          deleted_since=modified_since,
-                          verbose=verbose)
+    deleted = set(get_deleted(cfg, metafile, dbid,
+                              max_pr_request=max_pr_request,
+                              deleted_since=modified_since,
+                              verbose=verbose))
 
+    # Felta og indeksen på nvdb_id trengs for alle sidene
+    columns = _update_columns(cfg, fc, schema_grp, extended_extras,
+                              verbose=verbose)
+    objid_field = 'nvdb_%s' % rkeys['vegObj.objektId']
+    _ensure_id_index(fc, objid_field)
+    if deleted:
+        ndeleted = _delete_ids(fc, objid_field, deleted)
+        logger.info(u'%d sletta i %s' % (ndeleted, fc))
+
+    pager = PageSizeController.from_config(cfg, maximum=max_pr_request,
+                                           name=basename(fc))
     while next_obj <= nobj:
         # Update query dict
-        objektTyper[0]['antall'] = min([nobj - (next_obj - 1), max_pr_request])
+        antall = pager.next_size(nobj - (next_obj - 1))
+        objektTyper[0]['antall'] = antall
         objektTyper[0]['start'] = next_obj
         sok = sok_parse(objektTyper, lokasjon=lokasjon)
-        r = request(cfg['baseurl'], sok_uri, cfg['headers'], query=sok)
+        info = {}
+        r = request(cfg['baseurl'], sok_uri, cfg['headers'], query=sok,
+                    info=info, coalesce=False)
 
         nelem = r[rkeys['sok.totAntRet']]
-        ndel, nup, napp = update_elements(cfg, r[rkeys['sok.res']][0],
-                                          fc, schema_grp,
-                                          extended_extras=extended_extras,
-                                          deleted=deleted, verbose=verbose)
-        # Get rid of deleted features after first run
-        deleted = None
+        pager.record(antall, nelem, info.get('elapsed', 0.),
+                     info.get('bytes'))
+        _, nup, napp = update_elements(cfg, r[rkeys['sok.res']][0],
+                                       fc, schema_grp,
+                                       extended_extras=extended_extras,
+                                       columns=columns, verbose=verbose)
         # Break if no features were returned, object type
         # is exhausted
         if nelem == 0:
@@ -669,18 +899,14 @@ def update_fc(cfg, metafile, fc, objektTyper,
 
         next_obj += nelem
         nappended += napp
-        ndeleted += ndel
         nupdated += nup
         # Break if we get less than the limit
-        if nelem < max_pr_request:
+        if nelem < antall:
             break
         count += 1
 
         # Print statement pr iteration
-        msg = u'%d sletta, %d endra og %d lagt til i %s' % (ndel,
-                                                            nup,
-                                                            napp,
-                                                            fc)
+        msg = u'%d endra og %d lagt til i %s' % (nup, napp, fc)
         logger.info(msg)
     # Print statement at end
     msg = u'%d sletta, %d endra og %d lagt til i %s' % (ndeleted,
@@ -688,34 +914,94 @@ def update_fc(cfg, metafile, fc, objektTyper,
                                                         nappended,
                                                         fc)
     logger.info(msg)
+    if verbose:
+        logger.info(pager.summary())
 
 
-def update_elements(cfg, r, fc, schema_grp, extended_extras=False,
-                    deleted=None, verbose=False):
-    gdb = dirname(fc)
-    #=====================================================================
-    # Schema
-    #=====================================================================
+# Antall nvdb_id pr where-klausul
+ID_CHUNK = 1000
+
+
+def _id_chunks(ids, size=ID_CHUNK):
+    '''
+    Yields sorted *ids* in lists of at most *size*
+    '''
+    ids = sorted(ids)
+    for i in range(0, len(ids), size):
+        yield ids[i:i + size]
+
+
+def _id_where(fc, field, ids):
+    return '%s IN (%s)' % (arcpy.AddFieldDelimiters(fc, field),
+                           ','.join('%d' % int(i) for i in ids))
+
+
+def _ensure_id_index(fc, field):
+    '''
+    Add attribute index on *field* of *fc*, unless it already has one
+    '''
+    try:
+        for index in arcpy.ListIndexes(fc):
+            if [f.name.lower() for f in index.fields] == [field.lower()]:
+                return
+        arcpy.AddIndex_management(fc, field, '%s_idx' % field)
+    except arcpy.ExecuteError:
+        logger.debug('Klarte ikke lage indeks på %s i %s', field, fc, exc_info=True)
+
+
+def _update_columns(cfg, fc, schema_grp, extended_extras=False, verbose=False):
+    '''
+    Returns *(colnames, plan)* for the columns both in schema and in *fc*
+    '''
     _, cn, _, _ = _cat_schema(schema_grp,
                               extended_extras=extended_extras,
                               verbose=verbose)
-    schemanames = [arcyfy_name(n) if not 'SHAPE@' in n else n for n in cn]
     # Validate names, except SHAPE@WKT
-#     colnames = [arcyfy_name(n) for n in cn]
-#     f = lambda n, gdb: arcpy.ValidateFieldName(n, gdb)
-#     colnames = [f(n, gdb) if not 'SHAPE@' in n else n for n in cn]
-
+    schemanames = set(arcyfy_name(n) if not 'SHAPE@' in n else n for n in cn)
     # Only get columns both in schema and in fc
-    fc_fn = [f.name for f in arcpy.ListFields(fc)]
     columns = [(f.name, f.type) for f in arcpy.ListFields(fc) if f.name in schemanames]
     colnames, data_types = zip(*columns)
     replace = cfg['replaceTyperLut']
     data_types = [replace[d] for d in data_types]
+    plan, _ = _get_row_plan(cfg, colnames, data_types)
+    return colnames, plan
+
+
+def _delete_ids(fc, field, ids):
+    '''
+    Delete rows of *fc* with *field* in *ids*, returns number deleted
+    '''
+    ndeleted = 0
+    for chunk in _id_chunks(ids):
+        with UpdateCursor(fc, [field], _id_where(fc, field, chunk)) as cursor:
+            for _ in cursor:
+                cursor.deleteRow()
+                ndeleted += 1
+    return ndeleted
+
+
+def update_elements(cfg, r, fc, schema_grp, extended_extras=False,
+                    deleted=None, columns=None, verbose=False):
+    '''
+    Update rows of *fc* with the objects in search result *r* and append
+    objects not already in *fc*. Rows with ids in *deleted* are deleted.
+    Rows are looked up by nvdb_id in chunks, so only changed rows are
+    visited. Returns *(ndeleted, nupdated, nappended)*.
+
+    :param columns: *(colnames, plan)* from *_update_columns()*, looked up
+        in *fc* when not given
+    '''
+    gdb = dirname(fc)
+    if columns is None:
+        columns = _update_columns(cfg, fc, schema_grp, extended_extras,
+                                  verbose=verbose)
+    colnames, plan = columns
 
     geom_type = schema_grp.attrs['geometry_type']
 
     # Build lookup for attributes in r
     rkeys = cfg['response_keys']
+    objid_field = 'nvdb_%s' % rkeys['vegObj.objektId']
     r_lut = {}
     if rkeys['vegObj'] in r:
         for ielem, elem in enumerate(r[rkeys['vegObj']]):
@@ -726,30 +1012,25 @@ def update_elements(cfg, r, fc, schema_grp, extended_extras=False,
     nelem_updated = 0
     nelem_deleted = 0
     nelem_appended = 0
-    with UpdateCursor(fc, colnames) as cursor:
-        for row in cursor:
-            record = dict(zip(colnames, row))
-            objid_field = 'nvdb_%s' % rkeys['vegObj.objektId']
-            objid = record[objid_field]
-            # First check if row should be deleted
-            if deleted and objid in deleted:
-                cursor.deleteRow()
-                #deleted.pop(deleted.index(objid))
-                nelem_deleted += 1
-#                 if objid in r_lut:
-#                     r_lut.pop(objid)
-                continue
-            # Then check if row should be updated
-            if objid in r_lut:
-                elem = r[rkeys['vegObj']][r_lut[objid]]
-                r_lut.pop(objid)
+    # First delete rows
+    if deleted:
+        nelem_deleted = _delete_ids(fc, objid_field, set(deleted))
+    # Then update rows
+    iobjid = list(colnames).index(objid_field)
+    for chunk in _id_chunks(r_lut):
+        with UpdateCursor(fc, colnames, _id_where(fc, objid_field, chunk)) as cursor:
+            for row in cursor:
+                objid = row[iobjid]
+                if not objid in r_lut:
+                    continue
+                elem = r[rkeys['vegObj']][r_lut.pop(objid)]
                 attributes = {}
                 extract_data(cfg, elem, attributes, prefix='nvdb', gdb=gdb)
                 # Check for programming error
                 assert objid == attributes[objid_field]
                 # Check for empty geometry
                 check_empty_geometry(cfg, attributes, geom_type)
-                uprow = _populate_row(cfg, attributes, colnames, data_types)
+                uprow = _apply_row_plan(plan, attributes)
                 try:
                     cursor.updateRow(uprow)
                     nelem_updated += 1
@@ -766,11 +1047,9 @@ def update_elements(cfg, r, fc, schema_grp, extended_extras=False,
                 attributes = {}
                 extract_data(cfg, elem, attributes, prefix='nvdb', gdb=gdb)
                 assert objid == attributes[objid_field]
-    #             if 'GeomPunkt' in attributes or 'GeomFlate' in attributes:
-    #                 print('Geom')
                 # Check for empty geometry
                 check_empty_geometry(cfg, attributes, geom_type)
-                row = _populate_row(cfg, attributes, colnames, data_types)
+                row = _apply_row_plan(plan, attributes)
 
                 try:
                     cursor.insertRow(row)
@@ -778,8 +1057,6 @@ def update_elements(cfg, r, fc, schema_grp, extended_extras=False,
                 except:
                     # TODO: Send denne til logger
                     # TODO: Kjor diagnostikk pa element?
-    #                 print('ObjektId {0} feilet'.format(elem[rkeys['vegObj.objektId']]))
-    #                 raise
                     pass
 
     return nelem_deleted, nelem_updated, nelem_appended
@@ -934,6 +1211,7 @@ def multi_populate_fc(cfg, meta, fc_list=None, objektTyper=None,
     for fc, objTyp in zip(fc_list, objektTyper):
         fc = join(dirname(fc), arcpy.ValidateTableName(basename(fc)))
         populate_fc(cfg, meta, fc, objTyp, **kwargs)
+    save_meta(cfg, meta)
 
 
 def parse_lok(lokasjon):
@@ -946,10 +1224,273 @@ def parse_lok(lokasjon):
     # return {k: parse_val(v) for k, v in lokasjon.iteritems()}
     return {k: parse_val(v) for k, v in lokasjon.items()}
 
+
+def _fetch_pages(cfg, sok_uri, params, nobj, pager):
+    '''
+    Generator yielding *(nelem, r)* for each page returned by NVDB,
+    following *metadata.neste.start* until the object type is exhausted
+    or *nobj* objects have been fetched.
+
+    :param cfg: Config dictionary
+    :param sok_uri: Uri to search endpoint for a single object type
+    :param params: Query parameters, 'antall' and 'start' are updated in place
+    :param nobj: Maximum number of objects to fetch
+    :param pager: *PageSizeController* choosing objects pr request
+    '''
+    rkeys = cfg['response_keys']
+    nelem_get = 0
+    next_obj = params.get('start', None)
+    while nelem_get < nobj:
+        # Update query dict
+        params['antall'] = int(pager.next_size(nobj - int(nelem_get)))
+        if next_obj is not None:
+            params['start'] = next_obj
+
+        info = {}
+        try:
+            r = request(cfg['baseurl'], sok_uri, cfg['headers'],
+                        query=urlencode(params), info=info, coalesce=False)
+        except MemoryError:
+            pager.memory_error()
+            continue
+
+        if rkeys['vegObjektType.metadata'] in r:
+            meta = r[rkeys['vegObjektType.metadata']]
+            nelem = meta[rkeys['vegObjektType.metadata.antReturnert']]
+        else:
+            nelem = 0
+        pager.record(params['antall'], nelem, info.get('elapsed', 0.),
+                     info.get('bytes'))
+        # Break if no features were returned, object type
+        # is exhausted
+        if nelem == 0:
+            break
+
+        neste = meta[rkeys['vegObjektType.metadata.neste']]
+        next_obj = neste[rkeys['vegObjektType.metadata.neste.start']]
+
+        yield nelem, r
+        nelem_get += nelem
+
+        # Break if we get less than the limit NO! DON'T! WRONG
+        # if nelem < max_pr_request: # Page limit is DYNAMIC, decreases  with heavy server load
+            # break					 # We need to wait untill nelem=0
+
+
+def _stream_pages(cfg, sok_uri, params, nobj, pager):
+    '''
+    Like *_fetch_pages()*, but objects are decoded while they are read from
+    the connection. Yields *(None, r)* where *r['objekter']* is a
+    *StreamedResponse*, the number of objects is only known when the page
+    has been consumed, from its *nelem*. Pages must be consumed in order.
+
+    :param cfg: Config dictionary
+    :param sok_uri: Uri to search endpoint for a single object type
+    :param params: Query parameters, 'antall' and 'start' are updated in place
+    :param nobj: Maximum number of objects to fetch
+    :param pager: *PageSizeController* choosing objects pr request
+    '''
+    rkeys = cfg['response_keys']
+    nelem_get = 0
+    next_obj = params.get('start', None)
+    while nelem_get < nobj:
+        # Update query dict
+        params['antall'] = int(pager.next_size(nobj - int(nelem_get)))
+        if next_obj is not None:
+            params['start'] = next_obj
+
+        info = {}
+        page = request_stream(cfg['baseurl'], sok_uri, cfg['headers'],
+                              query=urlencode(params),
+                              array_key=rkeys['vegObjektType.objekter'],
+                              info=info)
+        try:
+            yield None, {rkeys['vegObjektType.objekter']: page}
+            # Metadata kjem etter objekta i svaret
+            page.finish()
+        finally:
+            page.close()
+        # Svartid er tida til første byte pluss tida det er venta på resten
+        # av svaret, utan tida som går med til innsetting
+        pager.record(params['antall'], page.nelem,
+                     info.get('elapsed', 0.) + page.read_time, page.nbytes)
+
+        meta = page.fields.get(rkeys['vegObjektType.metadata'])
+        if not meta or not meta[rkeys['vegObjektType.metadata.antReturnert']]:
+            break
+        nelem_get += meta[rkeys['vegObjektType.metadata.antReturnert']]
+        neste = meta[rkeys['vegObjektType.metadata.neste']]
+        next_obj = neste[rkeys['vegObjektType.metadata.neste.start']]
+
+
+_PREFETCH_DONE = object()
+
+def _prefetch(iterable, maxsize=2):
+    '''
+    Iterate over *iterable* in a background thread, keeping at most
+    *maxsize* items ready in a bounded queue. The producer blocks when the
+    queue is full, so memory is capped at roughly *maxsize* + 2 items.
+    Exceptions raised by the producer are re-raised in the consumer.
+    With *maxsize* < 1 the iterable is consumed in the calling thread.
+
+    :param iterable: Iterable to consume, typically *_fetch_pages()*
+    :param maxsize: Number of items to keep ready
+    '''
+    if not maxsize or maxsize < 1:
+        for item in iterable:
+            yield item
+        return
+
+    queue = Queue(maxsize)
+    stop = threading.Event()
+
+    def put(item):
+        # Gi opp dersom konsumenten har avslutta
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((True, item)):
+                    return
+        except BaseException:
+            put((False, sys.exc_info()[1]))
+            return
+        put((True, _PREFETCH_DONE))
+
+    producer = threading.Thread(target=produce, name='nvdb-prefetch')
+    producer.daemon = True
+    producer.start()
+    try:
+        while True:
+            ok, item = queue.get()
+            if not ok:
+                raise item
+            if item is _PREFETCH_DONE:
+                break
+            yield item
+    finally:
+        stop.set()
+
+# Søkeparameter for kvar type område det kan delast opp etter
+_PARTITION_PARAMS = {'fylker': 'fylke', 'kommuner': 'kommune'}
+
+
+def _partitions(cfg, metafile, partition_by):
+    '''
+    Returns *(param, values)* splitting a search into disjoint areas, one
+    for each of the *partition_by* areas ('fylker' or 'kommuner') in
+    *metafile*
+    '''
+    loc, _ = metafile.by_name(cfg['names'][partition_by])
+    values = [int(v) for v in metafile[loc]['id'][:]]
+    return _PARTITION_PARAMS[partition_by], values
+
+
+def _fetch_partitions(cfg, sok_uri, params, key, values, max_pr_request,
+                      workers=4, maxsize=8):
+    '''
+    Generator yielding *(nelem, r)* for the pages of the search *params*
+    restricted to each of *values* for parameter *key*. The partitions are
+    fetched by *workers* threads, pages come in the order they are ready.
+    At most *maxsize* pages wait in the queue. Exceptions raised by a
+    worker are re-raised in the consumer. Partitions are fetched without
+    segmentering, so objects crossing a border come whole from each area.
+
+    :param max_pr_request: Upper limit for each partition's
+        *PageSizeController*
+    '''
+    tasks = Queue()
+    for value in values:
+        tasks.put(value)
+    queue = Queue(maxsize)
+    stop = threading.Event()
+
+    def put(item):
+        # Gi opp dersom konsumenten har avslutta
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                continue
+        return False
+
+    def work():
+        while not stop.is_set():
+            try:
+                value = tasks.get_nowait()
+            except Empty:
+                break
+            part_params = dict(params)
+            part_params[key] = value
+            # Heile objekt, elles kuttar NVDB geometrien ved grensa til
+            # området, og _dedup() ville berre ta vare på éin av bitane
+            part_params['segmentering'] = 'false'
+            pager = PageSizeController.from_config(
+                cfg, maximum=max_pr_request, name='%s=%s' % (key, value))
+            try:
+                for item in _fetch_pages(cfg, sok_uri, part_params, pl.inf,
+                                         pager):
+                    if not put((True, item)):
+                        return
+            except BaseException:
+                put((False, sys.exc_info()[1]))
+                return
+            logger.debug(pager.summary())
+        put((True, _PREFETCH_DONE))
+
+    threads = [threading.Thread(target=work, name='nvdb-partition-%d' % i)
+               for i in range(max(1, min(workers, len(values))))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    try:
+        ndone = 0
+        while ndone < len(threads):
+            ok, item = queue.get()
+            if not ok:
+                raise item
+            if item is _PREFETCH_DONE:
+                ndone += 1
+                continue
+            yield item
+    finally:
+        stop.set()
+
+
+def _dedup(cfg, objs, partition_by, seen):
+    '''
+    Yields the objects in page list *objs* not seen before. Only objects
+    located in more than one of the *partition_by* areas can come twice,
+    so only their ids are kept in the set *seen*.
+    '''
+    rkeys = cfg['response_keys']
+    lok_key = rkeys['vegObj.lok']
+    id_key = rkeys['vegObjektType.objekter.id']
+    for obj in _drain(objs):
+        areas = (obj.get(lok_key) or {}).get(partition_by)
+        if areas is not None and len(areas) < 2:
+            yield obj
+            continue
+        obj_id = obj[id_key]
+        if obj_id in seen:
+            continue
+        seen.add(obj_id)
+        yield obj
+
+
 def populate_fc(cfg, metafile, fc, objektTyper, egenskapsfilter=None,
                 lokasjon=None, vegreferanse=None, max_pr_request=10000,
                 overwrite=True, extended_extras=False, store_failed=False,
-                verbose=False, debug=False):
+                prefetch=2, stream=False, partition_by=None,
+                partition_workers=4, verbose=False, debug=False):
     '''
     Function to populate a single ArcGIS feature class with data from
     NVDB REST API
@@ -973,7 +1514,8 @@ def populate_fc(cfg, metafile, fc, objektTyper, egenskapsfilter=None,
         defaults to *None* which means no restriction by location
     :param vegreferanse: (optional, default None)
     :param max_pr_request: int (optional, default 10000)
-        Integer number of objects obtained pr request.
+        Upper limit for number of objects obtained pr request, the actual
+        number is adapted to server response by *PageSizeController*.
         The method will loop until all features in dataset are collecter or
         until number restriction in *objektTyper* has been reached.
     :param overwrite: bool (optional, default True)
@@ -985,6 +1527,20 @@ def populate_fc(cfg, metafile, fc, objektTyper, egenskapsfilter=None,
         Use extended schema
     :param store_failed: bool (optional default False)
         Try to store failed inserts without geometry
+    :param prefetch: int (optional default 2)
+        Number of pages fetched ahead in a background thread while the
+        current page is inserted. Use 0 to fetch pages sequentially.
+    :param stream: bool (optional default False)
+        Decode objects while they are downloaded instead of reading whole
+        pages. Keeps memory use to about one object, *prefetch* is ignored.
+    :param partition_by: str (optional default None)
+        'fylker' or 'kommuner' to split a search without *lokasjon* into
+        one search pr area, fetched concurrently by *partition_workers*
+        threads. Objects found in several areas are inserted once. *stream*
+        is ignored, and so is *partition_by* when *lokasjon* or a number
+        of objects is given.
+    :param partition_workers: int (optional default 4)
+        Number of areas fetched at the same time
     :param verbose: bool (optional default False)
         Print more messages
     :param debug: bool (optional default False)
@@ -1012,18 +1568,7 @@ def populate_fc(cfg, metafile, fc, objektTyper, egenskapsfilter=None,
 
     # get location of schema, create it if it doesn't exist
     # and (implicitly) make sure dbid is available in nvdb
-    schema_uri, name = metafile.by_dbid(dbid)
-    try:
-        schema_grp = metafile[schema_uri]
-    except KeyError:
-        # TODO: Move this to function
-        if verbose:
-            logger.info('Henter feltnavn og datatyper')
-        schema_grp = metafile.create_group(schema_uri)
-        schema_grp.attrs['dbid'] = dbid
-        schema_grp.attrs['name'] = name
-        _build_schema(cfg, schema_grp, schema_uri)
-        _post_process_schema(cfg, metafile, schema_grp)
+    schema_grp = get_schema_grp(cfg, metafile, dbid, verbose=verbose)
 
     # Get data from nvdb
     sok_uri = basepath.format(vegObjektTypeId=dbid)
@@ -1049,7 +1594,6 @@ def populate_fc(cfg, metafile, fc, objektTyper, egenskapsfilter=None,
         params.update({'vegreferanse': vegreferanse})
 
     nobj = params.get('antall', pl.inf)
-    next_obj = params.get('start', None)
 
     nappended = 0
     nelem_get = 0
@@ -1069,60 +1613,75 @@ def populate_fc(cfg, metafile, fc, objektTyper, egenskapsfilter=None,
         except Exception as e:
             logger.info(u'Henter objekter fra NVDB for {}'.format(fc))
 
-    while nelem_get < nobj:
-        # Update query dict
-        params['antall'] = int(min([nobj - int(nelem_get), max_pr_request]))
-        if next_obj is not None:
-            params['start'] = next_obj
+    if partition_by and (lokasjon or nobj != pl.inf):
+        logger.info(u'Henter uten oppdeling, søket er allerede avgrenset')
+        partition_by = None
+
+    pager = PageSizeController.from_config(cfg, maximum=max_pr_request,
+                                           name=basename(fc))
+    colnames, _ = _dump_columns(schema_grp, extended_extras)
+    writers = _Writers(cfg, fc, schema_grp, version, colnames,
+                       extended_extras=extended_extras, verbose=verbose)
+    seen = None
+    if partition_by:
+        key, values = _partitions(cfg, metafile, partition_by)
+        if verbose:
+            logger.info(u'Henter {} {} med {} tråder'.format(
+                len(values), partition_by, partition_workers))
+        pages = _fetch_partitions(cfg, sok_uri, params, key, values,
+                                  max_pr_request, workers=partition_workers,
+                                  maxsize=max(1, prefetch) * partition_workers)
+        seen = set()
+    elif stream:
+        pages = _stream_pages(cfg, sok_uri, params, nobj, pager)
+    else:
+        pages = _prefetch(_fetch_pages(cfg, sok_uri, params, nobj, pager),
+                          prefetch)
+    try:
+        for nelem, r in pages:
+            if seen is not None:
+                # Tel berre objekt som ikkje er henta før, som uten oppdeling
+                objs_key = rkeys['vegObjektType.objekter']
+                r = {objs_key: list(_dedup(cfg, r[objs_key], partition_by, seen))}
+                nelem = len(r[objs_key])
+            nelem_appended = _dump_elements(cfg,
+                                            r,
+                                            writers, schema_grp,
+                                            extended_extras=extended_extras,
+                                            store_failed=store_failed,
+                                            debug=debug, total_get=nelem_get)
+            if nelem is None:
+                # Strøymd side, antallet er kjent først når den er lest
+                nelem = r[rkeys['vegObjektType.objekter']].nelem
+            # Slepp sida før neste blir henta fra køen
+            del r
+            nelem_get += nelem
+            nappended += nelem_appended
 
+            count += 1
+            if verbose:
+                # logger.info(u'Henta {} objekter, {} lagt til i {}'.format(nelem_get, nappended, format(fc)))
+                logger.info(u'Henta {} objekter, {} lagt til.'.format(nelem_get, nappended))
+    finally:
         try:
-            r = request(cfg['baseurl'], sok_uri, cfg['headers'], query=urlencode(params))
-        except MemoryError:
-            # max_pr_request /= 2
-            max_pr_request = int(max_pr_request/2)
-            continue
-
-        if rkeys['vegObjektType.metadata'] in r:
-            meta = r[rkeys['vegObjektType.metadata']]
-            nelem = meta[rkeys['vegObjektType.metadata.antReturnert']]
-        else:
-            nelem = 0
-        # Break if no features were returned, object type
-        # is exhausted
-        if nelem == 0:
-            break
-
-        neste = meta[rkeys['vegObjektType.metadata.neste']]
-        next_obj = neste[rkeys['vegObjektType.metadata.neste.start']]
-
-        nelem_appended = _dump_elements(cfg,
-                                        r,
-                                        fc, schema_grp,
-                                        extended_extras=extended_extras,
-                                        store_failed=store_failed,
-                                        debug=debug, total_get=nelem_get)
-        nelem_get += nelem
-        nappended += nelem_appended
-
-        # Break if we get less than the limit NO! DON'T! WRONG
-        # if nelem < max_pr_request: # Page limit is DYNAMIC, decreases  with heavy server load
-            # break					 # We need to wait untill nelem=0 
-
-        count += 1
-        if verbose:
-            # logger.info(u'Henta {} objekter, {} lagt til i {}'.format(nelem_get, nappended, format(fc)))
-            logger.info(u'Henta {} objekter, {} lagt til.'.format(nelem_get, nappended))
+            writers.close()
+        finally:
+            # Søsken er laga no, malane trengst ikkje lenger
+            clear_templates()
 
     nelem_tot = nelem_get
     if verbose:
+        if partition_by:
+            logger.info(u'{} objekter lå i flere {}'.format(len(seen), partition_by))
+        else:
+            logger.info(pager.summary())
         count = int(arcpy.GetCount_management(fc).getOutput(0))
         # logger.info(u'Henta {} objekter, {} lagt til i {}'.format(nelem_tot, count, fc))
         logger.info(u'Av {} objekter er {} lagt til i {}'.format(nelem_tot, count, fc))
 
     # Delete empty featureclasses
     other_fc = []
-    for _geometry in GEOMETRIES:
-        fc2 = fc + '_' + GEOMETRY_POSTFIX[_geometry]
+    for _geometry, fc2 in sorted(writers.siblings.items()):
         if arcpy.Exists(fc2):
             count = int(arcpy.GetCount_management(fc2).getOutput(0))
             if count < 1:
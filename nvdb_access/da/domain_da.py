@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+'''
+Coded value domains for ENUM egenskaper.
+
+The allowed values of all ENUM egenskaper of an object type are fetched
+together, kept pr datakatalog version on disk, and every domain is created
+in the geodatabase with one *TableToDomain* call. Domains that already
+exist with the same values are left alone.
+'''
+from __future__ import (print_function, unicode_literals, division)
+import os
+from os.path import basename, dirname, exists
+import pickle
+import threading
+import logging
+
+import arcpy
+from arcpy.da import InsertCursor, ListDomains, UpdateCursor  # @UnresolvedImport
+
+from ..shared import request, gather_json, arcyfy_name, replace_file
+
+logger = logging.getLogger(__name__)
+
+CATALOG_FORMAT = 1
+# Lengde på beskrivelsesfeltet i kodetabellen
+DESCRIPTION_LENGTH = 255
+
+
+def domain_name(name, dbid, version):
+    '''
+    Returns geodatabase name of the domain for egenskap *name*/*dbid*
+    '''
+    return arcyfy_name('%s_%d_%s' % (name, int(dbid), version))
+
+
+class DomainCatalog(object):
+    '''
+    Allowed values of ENUM egenskaper for one datakatalog *version*. Every
+    definition is stored as *(description, [(code, value), ...])* by
+    egenskap uri, and saved to *fname* so the next run does not have to
+    ask NVDB again.
+    '''
+
+    def __init__(self, cfg, version, fname=None):
+        self.cfg = cfg
+        self.version = version
+        self.fname = fname
+        self._defs = {}
+        self._lock = threading.Lock()
+        self.load()
+
+    def _tag(self):
+        return {'version': self.version, 'baseurl': self.cfg['baseurl']}
+
+    def load(self):
+        '''
+        Read stored definitions, if they belong to the same version
+        '''
+        if not self.fname or not exists(self.fname):
+            return
+        try:
+            with open(self.fname, 'rb') as fobj:
+                stored = pickle.load(fobj)
+        except Exception:
+            logger.debug('Klarte ikke lese domener fra %s', self.fname, exc_info=True)
+            return
+        if (stored.get('format') == CATALOG_FORMAT and
+                stored.get('tag') == self._tag()):
+            self._defs.update(stored['domains'])
+
+    def save(self):
+        if not self.fname:
+            return
+        try:
+            opath = dirname(self.fname)
+            if opath and not exists(opath):
+                os.makedirs(opath)
+            tmp_fname = '%s.tmp' % self.fname
+            with open(tmp_fname, 'wb') as fobj:
+                pickle.dump({'format': CATALOG_FORMAT,
+                             'tag': self._tag(),
+                             'domains': self._defs}, fobj, 2)
+            replace_file(tmp_fname, self.fname)
+        except (IOError, OSError):
+            logger.debug('Klarte ikke lagre domener til %s', self.fname, exc_info=True)
+
+    def _definition(self, r):
+        '''
+        Returns *(description, codes)* from egenskapstype response *r*
+        '''
+        rkeys = self.cfg['response_keys']
+        desc = r.get(rkeys['egskap.beskriv']) or 'Ingen beskrivelse'
+        codes = []
+        for verdi in r.get(rkeys['egskap.eVerdi']) or []:
+            value = verdi.get(rkeys['egskap.eVerdi.verdi'])
+            if value is None:
+                # NVDB v2 kallar namnet på verdien 'verdi'
+                value = verdi.get('verdi', verdi[rkeys['egskap.eVerdi.id']])
+            codes.append((int(verdi[rkeys['egskap.eVerdi.id']]),
+                          format(value)[:DESCRIPTION_LENGTH]))
+        return desc, codes
+
+    def _fetch(self, type_uri, uris):
+        '''
+        Fetch definitions for egenskap *uris* of object type *type_uri*.
+        The object type lists allowed values of its egenskaper, so usually
+        one call is enough. Whatever it leaves out is fetched concurrently.
+        '''
+        cfg = self.cfg
+        rkeys = cfg['response_keys']
+        found = {}
+        wanted = set(uris)
+        try:
+            r = request(cfg['baseurl'], type_uri, cfg['headers'])
+            for elem in r[rkeys['egenskapsTyper']]:
+                uri = '%s/%s' % (type_uri.rstrip('/'), elem[rkeys['egenskapsTyper.dbid']])
+                if uri in wanted and rkeys['egskap.eVerdi'] in elem:
+                    found[uri] = self._definition(elem)
+        except (KeyError, TypeError):
+            logger.debug('Fant ikke tillatte verdier i %s', type_uri, exc_info=True)
+        rest = [uri for uri in uris if not uri in found]
+        if rest:
+            results = gather_json(cfg['baseurl'], rest, cfg['headers'])
+            for uri, r in zip(rest, results):
+                if r:
+                    found[uri] = self._definition(r)
+        return found
+
+    def definitions(self, schema_grp):
+        '''
+        Returns dictionary with definitions of all ENUM egenskaper in
+        *schema_grp*, by egenskap uri. Only definitions not already in the
+        catalog are fetched from NVDB.
+        '''
+        egrp = schema_grp['egenskaper']
+        enum = self.cfg['typer']['enum']
+        uris = [uri for uri, d in zip(egrp['uri'], egrp['nvdb_dt']) if d in enum]
+        with self._lock:
+            missing = [uri for uri in uris if not uri in self._defs]
+            if missing:
+                self._defs.update(self._fetch(schema_grp.name, missing))
+                self.save()
+            return dict((uri, self._defs[uri]) for uri in uris if uri in self._defs)
+
+    def create_domains(self, gdb, schema_grp, verbose=False):
+        '''
+        Create coded value domains in *gdb* for all ENUM egenskaper in
+        *schema_grp*. Domains that exist with the same values are skipped,
+        domains with other values are replaced.
+        '''
+        egrp = schema_grp['egenskaper']
+        defs = self.definitions(schema_grp)
+        existing = dict((d.name, d) for d in ListDomains(gdb))
+        todo = []
+        for name, dbid, uri in zip(egrp['navn'], egrp['id'], egrp['uri']):
+            if not uri in defs:
+                continue
+            dname = domain_name(name, dbid, self.version)
+            desc, codes = defs[uri]
+            old = existing.get(dname)
+            if old is not None:
+                if dict(codes) == dict((int(k), v) for k, v in
+                                       (old.codedValues or {}).items()):
+                    continue
+                update = 'REPLACE'
+            else:
+                update = 'APPEND'
+            todo.append((dname, desc, codes, update))
+
+        if verbose and todo:
+            logger.info('Lager %d nye domener for ENUM-verdier' % len(todo))
+        if not todo:
+            return
+        # Ein kodetabell i minnet, fylt på nytt for kvart domene
+        table = arcpy.CreateUniqueName('nvdb_domene', 'in_memory')
+        arcpy.CreateTable_management('in_memory', basename(table))
+        try:
+            arcpy.AddField_management(table, 'code', 'LONG')
+            arcpy.AddField_management(table, 'description', 'TEXT',
+                                      field_length=DESCRIPTION_LENGTH)
+            for dname, desc, codes, update in todo:
+                with UpdateCursor(table, ['OID@']) as cursor:
+                    for _ in cursor:
+                        cursor.deleteRow()
+                with InsertCursor(table, ['code', 'description']) as cursor:
+                    for row in codes:
+                        cursor.insertRow(row)
+                arcpy.TableToDomain_management(table, 'code', 'description',
+                                               gdb, dname, desc, update)
+        finally:
+            arcpy.Delete_management(table)
+
+
+# Kataloger i bruk, pr fil og datakatalogversjon
+_CATALOGS = {}
+_CATALOGS_LOCK = threading.Lock()
+
+
+def get_catalog(cfg, version):
+    '''
+    Returns the *DomainCatalog* for *version*, stored in
+    *cfg['domain_cache']*
+    '''
+    fname = cfg.get('domain_cache')
+    key = (fname, cfg['baseurl'], version)
+    with _CATALOGS_LOCK:
+        catalog = _CATALOGS.get(key)
+        if catalog is None:
+            catalog = _CATALOGS[key] = DomainCatalog(cfg, version, fname)
+        return catalog
@@ -1,11 +1,11 @@
 # -*- coding: utf-8 -*-
 import sys
 import pylab as pl
-from datetime import datetime
 from copy import deepcopy
 import traceback
 import posixpath as path
 import logging
+from multiprocessing.pool import ThreadPool
 
 if sys.version_info[0] < 3:
     from urllib2 import HTTPError
@@ -14,7 +14,9 @@ else:
     from urllib.error import HTTPError
     from urllib.parse import urlencode
 
-from ..shared import request, BaseFile, my_urljoin, extract_data
+from ..shared import (request, gather_json, BaseFile, my_urljoin, extract_data,
+                      set_datakatalog_version)
+from ..timeparse import is_date
 
 from .geometry import check_empty_geometry
 
@@ -58,7 +60,17 @@ def get_omrade_by_name(cfg, metafile, omrade_type, name):
     return int(omr_lut[name])
 
 
-def _build_schema(cfg, grp, uri):
+def sample_query(cfg):
+    '''
+    Returns query for one sample object of a type, the same everywhere so
+    repeated requests share one call to NVDB
+    '''
+    params = dict(antall=1)
+    params.update(cfg['sok_params'])
+    return urlencode(sorted(params.items()))
+
+
+def _build_schema(cfg, grp, uri, r=None):
     # TODO: Sett inn nvdb_name og name (arcname)
     schema = {'uri': [],
               'navn': [],
@@ -66,7 +78,8 @@ def _build_schema(cfg, grp, uri):
               'dt': [],
               'nvdb_dt': []}
 
-    r = request(cfg['baseurl'], uri, cfg['headers'])
+    if r is None:
+        r = request(cfg['baseurl'], uri, cfg['headers'])
 
     rkeys = cfg['response_keys']
 
@@ -141,32 +154,47 @@ def _post_process_schema(cfg, h5file, schema_grp=None):
         vo_typer_uri, _ = h5file.by_name(cfg['names']['objekttyper'])
         parent_grp = h5file[vo_typer_uri]
         # loop over alle schema grupper
+        schema_grps = []
         for schema_uri in parent_grp:
             # Parent group has 'id' and 'navn' datasets listing all
             # available objekttyper in nvdb, exclude those
             if not schema_uri in ['id', 'navn']:
                 schema_grp = parent_grp[schema_uri]
-                _extend_schema(cfg, h5file, schema_grp)
+                # Hopp over schema som ikkje er bygd eller allereie er utvida
+                if 'egenskaper' in schema_grp and not 'default_extras' in schema_grp:
+                    schema_grps.append(schema_grp)
+        # Hent eit eksempelobjekt for alle typane samtidig
+        uris = [_sample_uri(cfg, h5file, g) for g in schema_grps]
+        samples = gather_json(cfg['baseurl'], uris, cfg['headers'],
+                              queries=[sample_query(cfg)] * len(uris))
+        for schema_grp, r in zip(schema_grps, samples):
+            _extend_schema(cfg, h5file, schema_grp, r=r)
+
+
+def _sample_uri(cfg, h5file, schema_grp):
+    '''
+    Returns uri for searching objects of the type of *schema_grp*
+    '''
+    # Hent eit vegobjekt gjennom /vegobjekter
+    base_uri, _ = h5file.by_name(cfg['names']['vegobjekter'])
+    # Maa hardkode uri siden denne ikkje kjem fra meta
+    return my_urljoin(base_uri, str(schema_grp.attrs['dbid']))
 
 
-def _extend_schema(def_cfg, h5file, schema_grp):
+def _extend_schema(def_cfg, h5file, schema_grp, r=None):
     '''
     Method to extend schema with extra attributes not in egenskaper
+
+    :param r: Sample response for the type, fetched if None
     '''
     # Need a temporary copy of cfg since we don't want to get
     # egenskaper here
     cfg = deepcopy(def_cfg)
     e_key = cfg['response_keys']['vegObj.egskap']
     cfg['vegobjekt_exclude'].append(e_key)
-    # Hent eit vegobjekt gjennom /vegobjekter
-    base_uri, _ = h5file.by_name(cfg['names']['vegobjekter'])
-    # Finn id for schema_grp
-    dbid = schema_grp.attrs['dbid']
-    # Maa hardkode uri siden denne ikkje kjem fra meta
-    obj_uri = my_urljoin(base_uri, str(dbid))
-    params = dict(antall=1)
-    params.update(cfg['sok_params'])
-    r = request(cfg['baseurl'], obj_uri, cfg['headers'], query=urlencode(params))
+    if r is None:
+        r = request(cfg['baseurl'], _sample_uri(cfg, h5file, schema_grp),
+                    cfg['headers'], query=sample_query(cfg))
 
     rkeys = cfg['response_keys']
 
@@ -222,6 +250,54 @@ def _extend_schema(def_cfg, h5file, schema_grp):
     _add_schema_grp(schema_grp, ext_schema, 'extended_extras')
 
 
+def get_schema_grp(cfg, metafile, dbid, verbose=True):
+    '''
+    Returns schema group for object type *dbid*. The schema is fetched
+    from NVDB the first time it is asked for and kept in *metafile*, which
+    also (implicitly) makes sure dbid is available in nvdb. New schemas are
+    written to the snapshot by *save_meta()*.
+
+    :param cfg: Config dictionary
+    :param metafile: File instance created by *build_meta()*
+    :param dbid: Id of object type
+    :param verbose: Print more messages
+    '''
+    schema_uri, name = metafile.by_dbid(dbid)
+    try:
+        schema_grp = metafile[schema_uri]
+    except KeyError:
+        schema_grp = None
+
+    built = False
+    if schema_grp is None or not 'egenskaper' in schema_grp:
+        if verbose:
+            logger.info('Henter feltnavn og datatyper')
+        if schema_grp is None:
+            schema_grp = metafile.create_group(schema_uri)
+        schema_grp.attrs['dbid'] = dbid
+        schema_grp.attrs['name'] = name
+        _build_schema(cfg, schema_grp, schema_uri)
+        built = True
+    if not 'default_extras' in schema_grp:
+        _post_process_schema(cfg, metafile, schema_grp)
+        built = True
+
+    if built:
+        # Ta vare på schemaet til neste gong, sjå save_meta()
+        metafile.dirty = True
+    return schema_grp
+
+
+def save_meta(cfg, metafile):
+    '''
+    Write *metafile* to the snapshot once, if schemas have been added by
+    *get_schema_grp()* since it was loaded or saved
+    '''
+    if metafile is not None and getattr(metafile, 'dirty', False):
+        metafile.dirty = False
+        _save_snapshot(cfg, metafile)
+
+
 def _get_dtype(val):
     '''
     Method to extract dtypes from value
@@ -242,16 +318,8 @@ def _get_dtype(val):
     except:
         pass
     else:
-        try:
-            datetime.strptime(val, '%Y-%m-%dT%H:%M:%S+02:00')
-            return 'DATE', 'Dato'
-        except:
-            pass
-        try:
-            datetime.strptime(val, '%Y-%m-%d')
+        if is_date(val):
             return 'DATE', 'Dato'
-        except:
-            pass
 # Vi lagrer klokkeslett som string, siden DATE inneholder år, mnd og dag men vi vet har ikke disse
 #        try:
 #            datetime.strptime(val, '%H:%M:%S')
@@ -294,17 +362,73 @@ def _post_process(cfg, meta):
     # _build_recur(cfg, meta, uri=mod_uri)
 
 
+def get_datakatalog_version(cfg):
+    '''
+    Ask the status endpoint for current datakatalog version. Returns *None*
+    if the version could not be found.
+    '''
+    rkeys = cfg['response_keys']
+    try:
+        r = request(cfg['baseurl'], cfg['names']['version'], cfg['headers'])
+        version = r[rkeys['ver.datakatalog']][rkeys['ver.ver']]
+    except Exception:
+        logger.debug(traceback.format_exc(10))
+        return None
+    # Lagra svar frå ein eldre datakatalog skal ikkje brukast
+    set_datakatalog_version(version)
+    return version
+
+
+def _snapshot_tag(cfg, version):
+    '''
+    Everything that decides the content of a metadata snapshot
+    '''
+    return {'version': version,
+            'baseurl': cfg['baseurl'],
+            'include_by_name': cfg['include_by_name'],
+            'include_by_dbid': cfg['include_by_dbid']}
+
+
+def _save_snapshot(cfg, h5file, ofile=None):
+    '''
+    Write *h5file* to snapshot *ofile*, defaults to *cfg['metafile']*
+    '''
+    if not ofile:
+        ofile = cfg.get('metafile')
+    if not ofile or not 'version' in h5file.attrs:
+        return
+    tag = _snapshot_tag(cfg, h5file.attrs['version'])
+    try:
+        h5file.save(ofile, tag=tag)
+    except (IOError, OSError):
+        logger.warn('Klarte ikke lagre metadata til %s' % ofile)
+        logger.debug(traceback.format_exc(10))
+
+
 def build_meta(cfg, ofile=None, uri='/', verbose=False):
+    '''
+    Build metadata for the NVDB API. If a snapshot path is given by
+    *ofile* or *cfg['metafile']*, the snapshot is loaded when it matches
+    current datakatalog version, and rewritten after a full build otherwise.
+    '''
     if not ofile:
-        h5file = BaseFile('tmp.h5', 'w', driver='core')
-    else:
-        h5file = BaseFile(ofile, 'w')
+        ofile = cfg.get('metafile')
+
+    if ofile:
+        version = get_datakatalog_version(cfg)
+        if version is not None:
+            h5file = BaseFile.load(ofile, tag=_snapshot_tag(cfg, version))
+            if h5file is not None:
+                logger.info('Bruker lagra metadata for datakatalog %s' % version)
+                return h5file
+
+    h5file = BaseFile('tmp.h5', 'w', driver='core')
 
     msg = 'Henter feltnavn og datatyper'
     logger.info(msg)
 
     bldr = Builder(cfg, h5file)
-    bldr._build_recur()
+    bldr.build()
 
     # Post process skal søke opp eit vegobjekt og trekke ut ekstra
     # attributter
@@ -322,7 +446,7 @@ def build_meta(cfg, ofile=None, uri='/', verbose=False):
 
     # Legg inn sjekk her om alt som trengs er bygd
     # TODO: Dette utelukker ikkje feil!!!
-    db_names = h5file._name2uri_map
+    db_names = h5file._by_name
     chklst = [False for n in cfg['names'].values() if not n in db_names]
     ##TODO: implement
     # if not all(chklst):
@@ -332,6 +456,8 @@ def build_meta(cfg, ofile=None, uri='/', verbose=False):
     msg = 'Metadata ferdigbygd'
     logger.info(msg)
 
+    _save_snapshot(cfg, h5file, ofile)
+
     return h5file
 
 
@@ -342,18 +468,70 @@ def uri_get_relative(uri, root):
 
 
 class Builder(object):
-    '''class Builder'''
-    def __init__(self, cfg, h5file):
+    '''
+    class Builder
+
+    Crawls the API depth first. Sibling uris are fetched concurrently by
+    a pool of *workers* threads, but responses are processed in the
+    original order, so the resulting file is the same as for a
+    sequential crawl.
+
+    With *lazy* only the catalogue of object types is built, schemas are
+    built on demand by *get_schema_grp()*.
+    '''
+    def __init__(self, cfg, h5file, workers=None, lazy=None):
         self.cfg = cfg
         self.h5file = h5file
         self.rkeys = cfg['response_keys']
+        if workers is None:
+            workers = cfg.get('crawl_workers', 8)
+        if lazy is None:
+            lazy = cfg.get('lazy_schemas', True)
+        self.workers = workers
+        self.lazy = lazy
+        self._pool = None
+
+    def build(self, uri='/'):
+        '''
+        Crawl API from *uri*
+        '''
+        if self.workers > 1:
+            self._pool = ThreadPool(self.workers)
+        try:
+            self._build_recur(uri)
+        finally:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+                self._pool = None
+
+    def _fetch(self, uri):
+        '''
+        Request *uri*, returns tuple of response and exception. Runs in
+        worker threads, so exceptions are passed back to the caller.
+        '''
+        try:
+            return request(self.cfg['baseurl'], uri, self.cfg['headers']), None
+        except Exception as e:
+            return None, e
+
+    def _fetch_all(self, uris):
+        '''
+        Fetch all *uris* concurrently, returns dictionary uri: (r, exception)
+        '''
+        if self._pool is None or len(uris) < 2:
+            return {uri: self._fetch(uri) for uri in uris}
+        return dict(zip(uris, self._pool.map(self._fetch, uris)))
 
-    def _build_recur(self, uri='/'):
-        dbid = self.h5file._uri2dbid_map[uri]
-        name = self.h5file._uri2name_map[uri]
+    def _build_recur(self, uri='/', fetched=None):
+        dbid, name = self.h5file.by_uri(uri)
 
         try:
-            r = request(self.cfg['baseurl'], uri, self.cfg['headers'])
+            if fetched is None:
+                fetched = self._fetch(uri)
+            r, exc = fetched
+            if exc is not None:
+                raise exc
 
             grp = self.h5file.create_group(uri)
             grp.attrs['dbid'] = dbid
@@ -383,21 +561,26 @@ class Builder(object):
             if name == self.cfg['names']['objekttyper']:
                 obj_id = []
                 obj_name = []
+                children = []
                 for elem in r:
                     dbid = elem[self.rkeys['vegObjektTyper.dbid']]
                     name = elem[self.rkeys['vegObjektTyper.name']]
                     rel = path.join(uri, format(dbid))  ## TODO: Dette er en Hack.
+                    checklist = [name in self.cfg['include_by_name']['vegObjektTyper'],
+                                 dbid in self.cfg['include_by_dbid']['vegObjektTyper'],
+                                 self.cfg['include_by_name']['vegObjektTyper'] == 'All']
+                    children.append((dbid, name, rel, any(checklist) and not self.lazy))
 
+                # Hent alle valgte objekttyper samtidig
+                fetched = self._fetch_all([c[2] for c in children if c[3]])
+                for dbid, name, rel, recur in children:
                     self.h5file.add(dbid, name, rel)  # Add element to top lookup
                     obj_id.append(dbid)  # Add element to local lookup
 
                     obj_name.append(name)
-                    checklist = [name in self.cfg['include_by_name']['vegObjektTyper'],
-                                 dbid in self.cfg['include_by_dbid']['vegObjektTyper'],
-                                 self.cfg['include_by_name']['vegObjektTyper'] == 'All']
 
-                    if any(checklist):
-                        self._build_recur(rel)
+                    if recur:
+                        self._build_schema_grp(rel, fetched.pop(rel, None))
 
                 id_dset = grp.create_dataset('id',
                                              (len(obj_id),),  ## NOTE(Erlend): Var len(obj_name)
@@ -409,6 +592,7 @@ class Builder(object):
                 nm_dset[:] = obj_name
             # elif r[0].has_key(self.rkeys['ressurser.dbid']):
             elif self.rkeys['ressurser.dbid'] in r[0]:
+                children = []
                 for elem in r:
                     dbid = elem[self.rkeys['ressurser.dbid']]
                     uri = elem[self.rkeys['ressurser.uri']]
@@ -418,11 +602,34 @@ class Builder(object):
                     uri = uri_get_relative(uri, self.cfg['baseurl'])
 
                     name = elem[self.rkeys['ressurser.name']].lower()
+                    # Ikke recur hvis det ligner på ett objekt(tall) eller er ekskludert eksplisitt
+                    recur = not dbid.isdigit() and not name in self.cfg['exclude_by_name']
+                    children.append((dbid, name, uri, recur))
+
+                # Hent alle ressurser på dette nivået samtidig
+                fetched = self._fetch_all([c[2] for c in children if c[3]])
+                for dbid, name, uri, recur in children:
                     self.h5file.add(dbid, name, uri)
 
-                    # Ikke recur hvis det ligner på ett objekt(tall) eller er ekskludert eksplisitt
-                    if not dbid.isdigit() and not name in self.cfg['exclude_by_name']:
-                        self._build_recur(uri)
+                    if recur:
+                        self._build_recur(uri, fetched.pop(uri, None))
+
+    def _build_schema_grp(self, uri, fetched=None):
+        '''
+        Build schema group for object type at *uri*
+        '''
+        dbid, name = self.h5file.by_uri(uri)
+        if fetched is None:
+            fetched = self._fetch(uri)
+        r, exc = fetched
+        if exc is not None:
+            logger.warn("Request to {} failed: {}".format(uri, exc))
+            return
+
+        grp = self.h5file.create_group(uri)
+        grp.attrs['dbid'] = dbid
+        grp.attrs['name'] = name
+        _build_schema(self.cfg, grp, uri, r=r)
 
     def _build_omrade(self, grp, omr_type, val_list):
         rkeys = self.cfg['response_keys']
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+'''
+Adaptive page size for paged NVDB requests.
+
+NVDB lets the client choose the page size (*antall* for searches, *rows*
+for endringer), and the server lowers its own limit under heavy load. A
+*PageSizeController* picks the size of each request from what earlier
+requests cost: it grows while responses are fast, shrinks when latency
+spikes, caps the page at a byte budget estimated from bytes per object,
+and backs off on MemoryError.
+'''
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class PageSizeController(object):
+    '''
+    Chooses page size for the next request from observed latency, bytes
+    per object and returned counts. Use *next_size()* before a request and
+    *record()* (or *memory_error()*) after it. Decisions are logged and
+    collected in *stats*.
+    '''
+
+    def __init__(self, initial=1000, minimum=100, maximum=10000,
+                 target_latency=4.0, max_page_bytes=100 * 1024 * 1024,
+                 grow=2.0, shrink=0.5, name='nvdb'):
+        '''
+        :param initial: Size of first request
+        :param minimum: Never ask for fewer objects than this
+        :param maximum: Never ask for more objects than this
+        :param target_latency: Wanted seconds pr request
+        :param max_page_bytes: Byte budget for one page
+        :param grow: Largest factor to grow by after one request
+        :param shrink: Factor to shrink by on latency spikes and MemoryError
+        :param name: Name used in log messages
+        '''
+        self.minimum = max(1, int(minimum))
+        self.maximum = max(self.minimum, int(maximum))
+        self.target_latency = float(target_latency)
+        self.max_page_bytes = max_page_bytes
+        self.grow = float(grow)
+        self.shrink = float(shrink)
+        self.name = name
+        self.size = self._clamp(initial)
+        self.bytes_per_object = None
+        self.stats = {'requests': 0, 'objects': 0, 'bytes': 0,
+                      'elapsed': 0., 'grown': 0, 'shrunk': 0,
+                      'memory_errors': 0, 'min_size': self.size,
+                      'max_size': self.size, 'size': self.size}
+
+    @classmethod
+    def from_config(cls, cfg, maximum=None, name='nvdb'):
+        '''
+        Returns controller set up from *cfg['paging']*
+
+        :param cfg: Config dictionary
+        :param maximum: Upper limit, overrides config if lower
+        :param name: Name used in log messages
+        '''
+        opts = dict(cfg.get('paging') or {})
+        kwargs = {'initial': opts.get('initial', 1000),
+                  'minimum': opts.get('min', 100),
+                  'maximum': opts.get('max', 10000),
+                  'target_latency': opts.get('target_latency', 4.0),
+                  'max_page_bytes': opts.get('max_page_bytes', 100 * 1024 * 1024),
+                  'name': name}
+        if maximum is not None:
+            kwargs['maximum'] = min(kwargs['maximum'], maximum)
+            kwargs['minimum'] = min(kwargs['minimum'], kwargs['maximum'])
+        return cls(**kwargs)
+
+    def _clamp(self, size):
+        return int(max(self.minimum, min(self.maximum, size)))
+
+    def _set_size(self, size, reason):
+        size = self._clamp(size)
+        if size == self.size:
+            return
+        if size > self.size:
+            self.stats['grown'] += 1
+        else:
+            self.stats['shrunk'] += 1
+        logger.debug('%s: sidestørrelse %d -> %d (%s)', self.name, self.size,
+                     size, reason)
+        self.size = size
+        self.stats['size'] = size
+        self.stats['min_size'] = min(self.stats['min_size'], size)
+        self.stats['max_size'] = max(self.stats['max_size'], size)
+
+    def next_size(self, remaining=None):
+        '''
+        Returns number of objects to ask for in the next request
+
+        :param remaining: Number of objects still wanted, if limited
+        '''
+        if remaining is not None and remaining < self.size:
+            return int(max(1, remaining))
+        return self.size
+
+    def record(self, requested, returned, elapsed, nbytes=None):
+        '''
+        Adjust page size after a completed request
+
+        :param requested: Number of objects asked for
+        :param returned: Number of objects returned
+        :param elapsed: Seconds used by the request
+        :param nbytes: Size of response body, if known
+        '''
+        stats = self.stats
+        stats['requests'] += 1
+        stats['objects'] += returned
+        stats['elapsed'] += elapsed
+        if nbytes:
+            stats['bytes'] += nbytes
+        if returned <= 0:
+            return
+        if requested < self.size:
+            # Siste side, avkorta av kallaren. Sei ingenting om tenaren
+            return
+
+        size = self.size
+        reason = 'svartid %.2fs' % elapsed
+        if returned < requested:
+            # Tenaren har senka grensa si, det er ingen vits å be om meir
+            size = returned
+            reason = 'tjeneren returnerte %d av %d' % (returned, requested)
+        elif elapsed > 0:
+            # Proporsjonalt mot ønska svartid, avgrensa til grow/shrink
+            factor = self.target_latency / elapsed
+            factor = max(self.shrink, min(self.grow, factor))
+            if 0.8 < factor < 1.25:
+                # Nær nok, unngå å hoppe fram og tilbake
+                factor = 1.
+            size = size * factor
+
+        if nbytes:
+            bpo = float(nbytes) / returned
+            if self.bytes_per_object is None:
+                self.bytes_per_object = bpo
+            else:
+                self.bytes_per_object = 0.7 * self.bytes_per_object + 0.3 * bpo
+            if self.max_page_bytes:
+                limit = self.max_page_bytes / self.bytes_per_object
+                if size > limit:
+                    size = limit
+                    reason = 'ca. %d bytes pr objekt' % self.bytes_per_object
+        self._set_size(size, reason)
+
+    def memory_error(self):
+        '''
+        Shrink page size after a MemoryError. Raises the error again when
+        already at the minimum size.
+        '''
+        self.stats['memory_errors'] += 1
+        if self.size <= self.minimum:
+            raise MemoryError('Gikk tom for minne med sidestørrelse %d' % self.size)
+        self._set_size(self.size * self.shrink, 'MemoryError')
+
+    def summary(self):
+        '''
+        Returns short text describing the decisions made so far
+        '''
+        s = self.stats
+        return ('%s: %d kall, %d objekter, sidestørrelse %d (min %d, maks %d), '
+                '%d økt, %d senka, %d MemoryError' % (
+                    self.name, s['requests'], s['objects'], s['size'],
+                    s['min_size'], s['max_size'], s['grown'], s['shrunk'],
+                    s['memory_errors']))
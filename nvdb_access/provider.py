@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+'''
+Process-wide provider for config and metadata.
+
+All tools in the toolbox share one parsed config and one metadata file,
+so the config is parsed and the NVDB metadata is built once per process
+rather than once per tool. Use *invalidate()* to force a reload.
+'''
+import sys
+import threading
+from copy import deepcopy
+from os.path import join, normpath
+
+if sys.version_info[0] < 3:
+    from .yaml import load, Loader, __with_libyaml__
+    if __with_libyaml__:
+        from .yaml import CLoader as Loader
+else:
+    from .yaml_3 import load, Loader, __with_libyaml__
+    if __with_libyaml__:
+        from .yaml_3 import CLoader as Loader
+
+from .shared import update_cfg, configure_client
+from .da.meta_da import build_meta
+
+_LOCK = threading.RLock()
+_CONFIGS = {}
+_METAS = {}
+
+
+def _key(cwd):
+    return normpath(cwd)
+
+
+def _load_config(cwd):
+    with open(join(cwd, r'nvdb_access\config\config.yaml')) as fobj:
+        cfg = load(fobj, Loader=Loader)
+    update_cfg(cfg, cwd)
+    configure_client(cfg)
+    return cfg
+
+
+def get_config(cwd):
+    '''
+    Returns config for plugin located in *cwd*. The config file is parsed
+    once, every call returns a private copy so tools can modify it freely.
+
+    :param cwd: Path to plugin root
+    '''
+    key = _key(cwd)
+    with _LOCK:
+        if key not in _CONFIGS:
+            _CONFIGS[key] = _load_config(cwd)
+        return deepcopy(_CONFIGS[key])
+
+
+def get_meta(cwd):
+    '''
+    Returns metadata for plugin located in *cwd*, shared by all callers.
+    Metadata is built on first call, a failed build is not remembered.
+
+    :param cwd: Path to plugin root
+    '''
+    key = _key(cwd)
+    with _LOCK:
+        if _METAS.get(key) is None:
+            _METAS[key] = build_meta(get_config(cwd))
+        return _METAS[key]
+
+
+def invalidate(cwd=None):
+    '''
+    Forget config and metadata for *cwd*, or for all plugins if *cwd* is
+    *None*. Next call to *get_config()*/*get_meta()* reloads.
+
+    :param cwd: Path to plugin root
+    '''
+    with _LOCK:
+        if cwd is None:
+            _CONFIGS.clear()
+            _METAS.clear()
+        else:
+            _CONFIGS.pop(_key(cwd), None)
+            _METAS.pop(_key(cwd), None)
@@ -1,23 +1,29 @@
 # -*- coding: utf-8 -*-
 import sys
-from os.path import join
+import os
+from os.path import join, dirname, exists
 import json
+import codecs
+import hashlib
+import zlib
+import base64
 if sys.version_info[0] < 3:
     from urllib2 import Request
     from urllib2 import HTTPError
     from urllib2 import quote
     from urllib2 import urlopen
-    from urlparse import urljoin, urlparse, urlunparse
+    from urlparse import urljoin, urlparse, urlunparse, parse_qsl
     from urllib import urlencode
 else:
     from urllib.request import Request
     from urllib.error import HTTPError
     from urllib.parse import quote
     from urllib.request import urlopen
-    from urllib.parse import urljoin, urlparse, urlunparse
+    from urllib.parse import urljoin, urlparse, urlunparse, parse_qsl
     from urllib.parse import urlencode
 
 import requests
+from requests.structures import CaseInsensitiveDict
 from requests.packages.urllib3.util import Retry
 from requests.adapters import HTTPAdapter
 from requests import Session
@@ -26,15 +32,26 @@ import urllib
 import pylab as pl
 from collections import OrderedDict
 from itertools import chain
+from multiprocessing.pool import ThreadPool
 from copy import deepcopy
 import re
 import datetime as dtm
+import pickle
+import threading
+import time
+import random
+import weakref
+from io import BytesIO
+from email.utils import parsedate_tz, mktime_tz
+from bisect import bisect_left
 import logging
 from logging import Handler
 import arcpy
 
 logger = logging.getLogger(__name__)
-SESSION = None
+_CLIENT_LOCK = threading.Lock()
+# Bump when the pickled layout of BaseFile changes
+SNAPSHOT_FORMAT = 2
 
 class ArcHandler(Handler):
     def __init__(self):
@@ -210,6 +227,19 @@ def arcyfy_name(field, use_arc=False, gdb=None):
     return ret_field
 
 
+def replace_file(src, dst):
+    '''
+    Move *src* to *dst*, replacing *dst*. Atomic on py3, on py2 *dst* is
+    removed first, since rename can not replace files on Windows.
+    '''
+    if sys.version_info[0] < 3:
+        if exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+    else:
+        os.replace(src, dst)
+
+
 def update_cfg(cfg, cwd):
     '''
     Updates config dictionary after loading
@@ -220,6 +250,18 @@ def update_cfg(cfg, cwd):
 
     sr_gdb = join(cwd, r'nvdb_access\resources\Spatial_refs.gdb')
     cfg['spatial_refs']['utm33'] = join(sr_gdb, cfg['spatial_refs']['utm33'])
+    if cfg.get('metafile'):
+        cfg['metafile'] = join(cwd, 'nvdb_access', 'cache', cfg['metafile'])
+    if cfg.get('transport', {}).get('cassette'):
+        cfg['transport']['cassette'] = join(cwd, 'nvdb_access', 'cache',
+                                            cfg['transport']['cassette'])
+    if cfg.get('http_cache', {}).get('directory'):
+        cfg['http_cache']['directory'] = join(cwd, 'nvdb_access', 'cache',
+                                              cfg['http_cache']['directory'])
+    if cfg.get('metrics_file'):
+        cfg['metrics_file'] = join(cwd, 'nvdb_access', 'cache', cfg['metrics_file'])
+    if cfg.get('domain_cache'):
+        cfg['domain_cache'] = join(cwd, 'nvdb_access', 'cache', cfg['domain_cache'])
 
 
 def sok_parse(objektTyper, lokasjon=None):
@@ -253,9 +295,9 @@ def my_urljoin(basepath, uri):
     uri_tmp = uri.lstrip('/')
     return urljoin(basepath, uri_tmp)
 
-def request(baseurl, uri, headers, params=None, query=None, mode='GET'):
+def _build_url(baseurl, uri, query=None):
     '''
-    The way we access the REST API
+    Returns full url for *uri* relative to *baseurl*
     '''
     if not baseurl.endswith('/'):
         baseurl = '{0}/'.format(baseurl)
@@ -268,12 +310,26 @@ def request(baseurl, uri, headers, params=None, query=None, mode='GET'):
     # Rejoin the pieces with query
     parse_tuple = tuple((p.scheme, p.netloc, urlpath,
                          p.params, query, p.fragment))
-    url = urlunparse(parse_tuple)
+    return urlunparse(parse_tuple)
+
+def request(baseurl, uri, headers, params=None, query=None, mode='GET',
+            info=None, coalesce=True):
+    '''
+    The way we access the REST API
+
+    :param info: Optional dictionary, filled with 'status', 'elapsed'
+        (seconds) and 'bytes' of the response
+    :param coalesce: Share the result with identical GET requests, see
+        *RequestCoalescer*. The result is then read-only. Use False for
+        paged requests and results that are changed by the caller
+    '''
+    url = _build_url(baseurl, uri, query)
     # logger.info('(dbg) request: url: {}'.format(url))
-    logger.debug('(dbg) request: headers: {}'.format(headers))
-    logger.debug('(dbg) request: url: {}'.format(url))
+    logger.debug('(dbg) request: headers: %s', headers)
+    logger.debug('(dbg) request: url: %s', url)
     # return _request(url, headers, params=params, mode=mode)
-    return _request_new(url, headers, params=params, mode=mode)
+    return get_client().request(url, headers, params=params, mode=mode,
+                                info=info, coalesce=coalesce)
 
 def _request(url, headers, params=None, mode='GET'):
     r = Request(url, headers=headers)
@@ -286,33 +342,1341 @@ def _request(url, headers, params=None, mode='GET'):
     response = next(responseObj)
     return json.loads(response)
 
-def _request_new(url, headers, params=None, mode='GET'):
-    global SESSION
-    if not SESSION:
-        SESSION = Session()
-        SESSION.mount(url, HTTPAdapter(max_retries=Retry(total=5, status_forcelist=[500, 503])))
-    if params and mode.lower() == 'post':
-        # response = requests.post(url, params)
-        response = SESSION.post(url, params)
-    else:
+def _log_api_errors(response, url):
+    errors = response.json()
+    logger.info('NVDB-API KALL FEILER:')
+    for error in errors:
+        if 'code' in error:
+            logger.info('FEILKODE: {}'.format(error['code']))
+        if 'message' in error:
+            logger.info('FEILMELDING: {}'.format(error['message']))
+    logger.info('URL: {}'.format(url))
+        # logger.info('FEIL json: {}'.format(error))
+
+class ResponseCache(object):
+    '''
+    Two level cache of GET responses: an in-process LRU in front of one
+    file pr response in *directory*. An entry younger than the TTL of its
+    endpoint is used as is. Older entries are revalidated with
+    If-None-Match/If-Modified-Since when the server gave an ETag or
+    Last-Modified, and reused on 304 Not Modified.
+
+    The endpoint of an url is the first path element found in *ttl* or
+    *uncached*, e.g. *vegobjekttyper* for */vegobjekttyper/5/1234*.
+
+    Keys include *version*, the datakatalog version, so responses stored
+    under an older version are not used once it is set to a new one.
+    '''
+
+    def __init__(self, directory=None, memory_items=256, ttl=None,
+                 default_ttl=0, uncached=()):
+        '''
+        :param directory: Folder for responses on disk, None for memory only
+        :param memory_items: Number of responses kept in memory
+        :param ttl: Dictionary of endpoint: seconds an entry is used
+            without asking the server
+        :param default_ttl: Seconds for endpoints not in *ttl*
+        :param uncached: Endpoints never cached
+        '''
+        self.directory = directory
+        self.memory_items = memory_items
+        self.ttl = dict(ttl or {})
+        self.default_ttl = default_ttl
+        self.uncached = set(uncached or ())
+        self.version = None
+        self.stats = {'hits': 0, 'revalidated': 0, 'misses': 0, 'stored': 0}
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, cfg):
+        '''
+        Returns cache set up from *cfg['http_cache']*, or None if disabled
+        '''
+        opts = cfg.get('http_cache') or {}
+        if not opts.get('enabled', False):
+            return None
+        return cls(directory=opts.get('directory'),
+                   memory_items=opts.get('memory_items', 256),
+                   ttl=opts.get('ttl'),
+                   default_ttl=opts.get('default_ttl', 0),
+                   uncached=opts.get('uncached', ()))
+
+    def ttl_for(self, url):
+        '''
+        Returns TTL in seconds for *url*, or None if it is not cached
+        '''
+        for part in urlparse(url).path.split('/'):
+            if part in self.uncached:
+                return None
+            if part in self.ttl:
+                return self.ttl[part]
+        return self.default_ttl
+
+    def key(self, url, headers=None):
+        # Accept styrer formatet paa svaret, saa det er med i nokkelen
+        accept = (headers or {}).get('Accept', '')
+        key = '%s\n%s\n%s' % (url, accept, self.version or '')
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return join(self.directory, '%s.pkl' % key)
+
+    def get(self, key):
+        '''
+        Returns cached entry for *key*, or None
+        '''
+        with self._lock:
+            entry = self._memory.pop(key, None)
+            if entry is not None:
+                self._memory[key] = entry
+                return entry
+        if not self.directory:
+            return None
+        try:
+            with open(self._path(key), 'rb') as fobj:
+                entry = pickle.load(fobj)
+        except Exception:
+            return None
+        self._remember(key, entry)
+        return entry
+
+    def _remember(self, key, entry):
+        with self._lock:
+            self._memory.pop(key, None)
+            self._memory[key] = entry
+            while len(self._memory) > self.memory_items:
+                self._memory.popitem(last=False)
+
+    def put(self, key, url, response):
+        '''
+        Store body and validators of *response*, returns the entry
+        '''
+        entry = {'url': url,
+                 'stored': time.time(),
+                 'etag': response.headers.get('ETag'),
+                 'last_modified': response.headers.get('Last-Modified'),
+                 'body': response.content}
+        self._remember(key, entry)
+        self._write(key, entry)
+        self.stats['stored'] += 1
+        return entry
+
+    def touch(self, key, entry):
+        '''
+        Mark *entry* as fresh after the server answered 304
+        '''
+        entry = dict(entry, stored=time.time())
+        self._remember(key, entry)
+        self._write(key, entry)
+        return entry
+
+    def _write(self, key, entry):
+        if not self.directory:
+            return
+        try:
+            if not exists(self.directory):
+                os.makedirs(self.directory)
+            fname = self._path(key)
+            tmp_fname = '%s.%d.tmp' % (fname, threading.current_thread().ident)
+            with open(tmp_fname, 'wb') as fobj:
+                pickle.dump(entry, fobj, 2)
+            replace_file(tmp_fname, fname)
+        except (IOError, OSError):
+            logger.debug('Klarte ikke skrive %s til cache', entry['url'], exc_info=True)
+
+    @staticmethod
+    def is_fresh(entry, ttl):
+        return time.time() - entry['stored'] < ttl
+
+    @staticmethod
+    def validators(entry):
+        '''
+        Returns headers for a conditional request revalidating *entry*
+        '''
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+        if self.directory and exists(self.directory):
+            for fname in os.listdir(self.directory):
+                if fname.endswith('.pkl'):
+                    os.remove(join(self.directory, fname))
+
+
+def _decode_body(body):
+    return json.loads(body.decode('utf-8'))
+
+
+def _read_only(*args, **kwargs):
+    raise TypeError('Svaret er delt mellom kall og kan ikke endres, bruk deepcopy')
+
+
+class ReadOnlyDict(dict):
+    '''
+    Dictionary that can not be changed. *copy.copy* and *copy.deepcopy*
+    return ordinary (mutable) dictionaries.
+    '''
+    __setitem__ = __delitem__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return dict((k, deepcopy(v, memo)) for k, v in self.items())
+
+    def __reduce__(self):
+        return (ReadOnlyDict, (dict(self),))
+
+
+class ReadOnlyList(list):
+    '''
+    List that can not be changed. *copy.copy* and *copy.deepcopy* return
+    ordinary (mutable) lists.
+    '''
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _read_only
+    append = extend = insert = pop = remove = reverse = sort = _read_only
+    if sys.version_info[0] < 3:
+        __setslice__ = __delslice__ = _read_only
+
+    def __copy__(self):
+        return list(self)
+
+    def __deepcopy__(self, memo):
+        return [deepcopy(v, memo) for v in self]
+
+    def __reduce__(self):
+        return (ReadOnlyList, (list(self),))
+
+
+def freeze(obj):
+    '''
+    Returns decoded JSON *obj* as *ReadOnlyDict* and *ReadOnlyList*, all
+    the way down
+    '''
+    if isinstance(obj, (ReadOnlyDict, ReadOnlyList)):
+        # Allereie fryst heilt ned
+        return obj
+    if isinstance(obj, dict):
+        return ReadOnlyDict((k, freeze(v)) for k, v in obj.items())
+    elif isinstance(obj, list):
+        return ReadOnlyList(freeze(v) for v in obj)
+    return obj
+
+
+class _Flight(object):
+    __slots__ = ('event', 'result', 'error', 'finished')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        self.finished = None
+
+
+class RequestCoalescer(object):
+    '''
+    Single-flight for GET requests: identical requests sent while one is
+    in flight, or within *window* seconds after it finished, share its
+    result instead of calling NVDB again. Shared results are read-only,
+    see *freeze()*. Errors are passed to the waiting calls, but not kept.
+    '''
+
+    def __init__(self, window=5.):
+        '''
+        :param window: Seconds a finished result is reused, 0 only shares
+            requests in flight
+        '''
+        self.window = float(window)
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'waited': 0}
+
+    @staticmethod
+    def key(url, headers):
+        accept = (headers or {}).get('Accept', '')
+        return urlparse(url).netloc, _cassette_key('GET', url), accept
+
+    def _prune(self, now):
+        # Kalles med låsen
+        expired = [k for k, f in self._flights.items()
+                   if f.finished is not None and now - f.finished >= self.window]
+        for k in expired:
+            del self._flights[k]
+
+    def call(self, key, func):
+        '''
+        Returns frozen result of *func()*, shared with identical calls
+        '''
+        now = time.time()
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None and flight.finished is not None and \
+                    now - flight.finished >= self.window:
+                flight = None
+            if flight is None:
+                self._prune(now)
+                flight = self._flights[key] = _Flight()
+                leader = True
+                self.stats['misses'] += 1
+            else:
+                leader = False
+                self.stats['hits'] += 1
+                if flight.finished is None:
+                    self.stats['waited'] += 1
+
+        if leader:
+            try:
+                flight.result = freeze(func())
+            except BaseException as e:
+                flight.error = e
+                raise
+            finally:
+                flight.finished = time.time()
+                if flight.error is not None or flight.result == '':
+                    # Feil skal ikkje gjenbrukast
+                    with self._lock:
+                        if self._flights.get(key) is flight:
+                            del self._flights[key]
+                flight.event.set()
+            return flight.result
+
+        flight.event.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    def clear(self):
+        with self._lock:
+            self._flights.clear()
+
+
+_ID_PART = re.compile(r'^\d+$')
+
+class RequestMetrics(object):
+    '''
+    Statistics for requests, pr endpoint template like
+    *vegobjekter/{id}* or *vegobjekter/{id}/statistikk*: number of calls,
+    a latency histogram, bytes, status codes, retries, and calls answered
+    by the cache or by a coalesced call. Shared by all threads.
+    '''
+    # Øvre grense for kvar bøtte i histogrammet, i sekunder
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30., 60., 120.)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+        self.started = time.time()
+
+    @staticmethod
+    def endpoint(url):
+        '''
+        Returns endpoint template for *url*, ids replaced by {id}
+        '''
+        parts = [p for p in urlparse(url).path.split('/') if p]
+        return '/'.join('{id}' if _ID_PART.match(p) else p for p in parts) or '/'
+
+    def _new(self):
+        return {'calls': 0, 'errors': 0, 'retries': 0, 'cached': 0,
+                'coalesced': 0, 'bytes': 0, 'elapsed': 0., 'max_elapsed': 0.,
+                'status': {}, 'histogram': [0] * (len(self.BUCKETS) + 1)}
+
+    def record(self, url, status=None, elapsed=0., nbytes=0, retries=0,
+               cached=False, coalesced=False):
+        '''
+        Add one call to *url*. *status* is the HTTP status, or the name of
+        the exception if the call failed without one.
+        '''
+        endpoint = self.endpoint(url)
+        bucket = bisect_left(self.BUCKETS, elapsed)
+        with self._lock:
+            e = self._endpoints.get(endpoint)
+            if e is None:
+                e = self._endpoints[endpoint] = self._new()
+            e['calls'] += 1
+            if not isinstance(status, int) or status >= 400:
+                e['errors'] += 1
+            key = str(status)
+            e['status'][key] = e['status'].get(key, 0) + 1
+            e['retries'] += retries or 0
+            e['cached'] += bool(cached)
+            e['coalesced'] += bool(coalesced)
+            e['bytes'] += nbytes or 0
+            e['elapsed'] += elapsed
+            e['max_elapsed'] = max(e['max_elapsed'], elapsed)
+            e['histogram'][bucket] += 1
+
+    def add_bytes(self, url, nbytes):
+        '''
+        Add bytes read after the call was recorded, for streamed responses
+        '''
+        endpoint = self.endpoint(url)
+        with self._lock:
+            e = self._endpoints.get(endpoint)
+            if e is None:
+                e = self._endpoints[endpoint] = self._new()
+            e['bytes'] += nbytes
+
+    def _percentile(self, histogram, q):
+        # Øvre grense for bøtta som inneheld kvantilen
+        total = sum(histogram)
+        if not total:
+            return None
+        limit = q * total
+        count = 0
+        for i, n in enumerate(histogram):
+            count += n
+            if count >= limit:
+                return self.BUCKETS[i] if i < len(self.BUCKETS) else None
+        return None
+
+    def snapshot(self):
+        '''
+        Returns copy of the statistics as a dictionary, with mean latency
+        and approximate p50/p95 (upper bucket limits, None above the
+        largest bucket) pr endpoint
+        '''
+        with self._lock:
+            endpoints = deepcopy(self._endpoints)
+        for e in endpoints.values():
+            e['mean_elapsed'] = e['elapsed'] / e['calls'] if e['calls'] else 0.
+            e['p50_elapsed'] = self._percentile(e['histogram'], 0.5)
+            e['p95_elapsed'] = self._percentile(e['histogram'], 0.95)
+        return {'started': self.started,
+                'duration': time.time() - self.started,
+                'buckets': list(self.BUCKETS),
+                'endpoints': endpoints}
+
+    def dump(self, fname):
+        '''
+        Write *snapshot()* to *fname* as JSON
+        '''
+        d = dirname(fname)
+        if d and not exists(d):
+            os.makedirs(d)
+        with open(fname, 'w') as f:
+            json.dump(self.snapshot(), f, indent=2, sort_keys=True)
+
+    def summary(self):
+        '''
+        Returns one line pr endpoint, slowest in total first
+        '''
+        endpoints = self.snapshot()['endpoints']
+        lines = []
+        for name, e in sorted(endpoints.items(), key=lambda kv: -kv[1]['elapsed']):
+            lines.append('%s: %d kall, %.1f s (snitt %.2f s, maks %.2f s), %d bytes, '
+                         '%d feil, %d nye forsøk, %d fra cache, %d delt' % (
+                             name, e['calls'], e['elapsed'], e['mean_elapsed'],
+                             e['max_elapsed'], e['bytes'], e['errors'],
+                             e['retries'], e['cached'], e['coalesced']))
+        return '\n'.join(lines)
+
+    def reset(self):
+        with self._lock:
+            self._endpoints.clear()
+        self.started = time.time()
+
+
+# Statistikk for alle kall, uavhengig av klient
+METRICS = RequestMetrics()
+
+
+class RateLimiter(object):
+    '''
+    Throttle for requests, shared by all threads. Each host has a token
+    bucket allowing *rate* requests pr second with bursts of *burst*, and a
+    semaphore allowing *concurrency* requests at the same time. A host can
+    be blocked for a while, e.g. after 429 Too Many Requests with
+    Retry-After.
+    '''
+
+    def __init__(self, rate=10., burst=20, concurrency=8, max_retries=5,
+                 backoff=1., max_backoff=60., max_retry_after=300.,
+                 retry_statuses=(429, 500, 502, 503, 504)):
+        '''
+        :param rate: Requests pr second pr host, None or 0 for no limit
+        :param burst: Number of requests that may be sent at once
+        :param concurrency: Requests in flight pr host
+        :param max_retries: Retries on *retry_statuses*
+        :param backoff: Seconds to wait before first retry, doubled for
+            each retry
+        :param max_backoff: Longest wait between retries
+        :param max_retry_after: Longest wait accepted from Retry-After
+        :param retry_statuses: HTTP statuses that are retried
+        '''
+        self.rate = float(rate or 0)
+        self.burst = max(1., float(burst or 1))
+        self.concurrency = max(1, int(concurrency))
+        self.max_retries = max(0, int(max_retries))
+        self.backoff = float(backoff)
+        self.max_backoff = float(max_backoff)
+        self.max_retry_after = float(max_retry_after)
+        self.retry_statuses = frozenset(retry_statuses)
+        self._buckets = {}
+        self._semaphores = {}
+        self._blocked = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, cfg):
+        '''
+        Returns limiter set up from *cfg['rate_limit']*
+        '''
+        opts = cfg.get('rate_limit') or {}
+        kwargs = dict((k, opts[k]) for k in ('rate', 'burst', 'concurrency',
+                                             'max_retries', 'backoff',
+                                             'max_backoff', 'max_retry_after')
+                      if k in opts)
+        if 'retry_statuses' in opts:
+            kwargs['retry_statuses'] = opts['retry_statuses']
+        return cls(**kwargs)
+
+    def _semaphore(self, host):
+        with self._lock:
+            sem = self._semaphores.get(host)
+            if sem is None:
+                sem = threading.BoundedSemaphore(self.concurrency)
+                self._semaphores[host] = sem
+            return sem
+
+    def try_token(self, host):
+        '''
+        Take a token for *host* if one is available and return 0, otherwise
+        return seconds to wait before trying again. Does not block.
+        '''
+        with self._lock:
+            now = time.time()
+            wait = self._blocked.get(host, 0.) - now
+            if wait > 0:
+                return wait
+            if not self.rate:
+                return 0.
+            tokens, last = self._buckets.get(host, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens >= 1:
+                self._buckets[host] = (tokens - 1, now)
+                return 0.
+            self._buckets[host] = (tokens, now)
+            return (1 - tokens) / self.rate
+
+    def _take_token(self, host):
+        while True:
+            wait = self.try_token(host)
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def acquire(self, host):
+        '''
+        Wait until a request to *host* may be sent. Must be followed by
+        *release()*.
+        '''
+        self._semaphore(host).acquire()
         try:
-            # response = requests.get(url)
-            response = SESSION.get(url, headers=headers, verify=True)
-            if response.status_code != 200:
-                errors = response.json()
-                logger.info('NVDB-API KALL FEILER:')
-                for error in errors:
-                    if 'code' in error:
-                        logger.info('FEILKODE: {}'.format(error['code']))
-                    if 'message' in error:
-                        logger.info('FEILMELDING: {}'.format(error['message']))
-                logger.info('URL: {}'.format(url))
-                    # logger.info('FEIL json: {}'.format(error))
-                return ''
+            self._take_token(host)
+        except BaseException:
+            self.release(host)
+            raise
+
+    def try_acquire(self, host):
+        '''
+        Take one of the *concurrency* slots for *host* if one is free,
+        without waiting. Returns True if taken, which must be followed by
+        *release()*. The rate is not checked, see *try_token()*.
+        '''
+        return self._semaphore(host).acquire(False)
+
+    def release(self, host):
+        self._semaphore(host).release()
+
+    def block(self, host, seconds):
+        '''
+        Hold back all requests to *host* for *seconds*
+        '''
+        with self._lock:
+            until = time.time() + seconds
+            if until > self._blocked.get(host, 0.):
+                self._blocked[host] = until
+
+    def retry_delay(self, response, attempt):
+        '''
+        Returns seconds to wait before retry number *attempt* (from 0),
+        from Retry-After if given, otherwise exponential with jitter
+        '''
+        retry_after = _parse_retry_after(response.headers.get('Retry-After'))
+        if retry_after is not None:
+            return min(retry_after, self.max_retry_after)
+        delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+
+def _parse_retry_after(value):
+    '''
+    Returns seconds from a Retry-After header, given either as seconds or
+    as a HTTP date. Returns None if missing or not understood.
+    '''
+    if not value:
+        return None
+    try:
+        return max(0., float(value))
+    except ValueError:
+        pass
+    parsed = parsedate_tz(value)
+    if parsed is None:
+        return None
+    return max(0., mktime_tz(parsed) - time.time())
+
+
+class CannedResponse(object):
+    '''
+    Response with the body already in memory, quacking like the parts of
+    *requests.Response* used here. Used by the record/replay transports.
+    '''
+
+    def __init__(self, url, status_code, headers, content, bandwidth=None):
+        self.url = url
+        self.status_code = status_code
+        self.headers = CaseInsensitiveDict(headers or {})
+        self.content = content
+        self.bandwidth = bandwidth
+
+    def json(self):
+        return _decode_body(self.content)
+
+    def iter_content(self, chunk_size=1, decode_unicode=False):
+        for i in range(0, len(self.content), chunk_size):
+            chunk = self.content[i:i + chunk_size]
+            if self.bandwidth:
+                time.sleep(len(chunk) / float(self.bandwidth))
+            yield chunk
+
+    def close(self):
+        pass
+
+
+class LiveTransport(object):
+    '''
+    Sends requests to the server
+    '''
+    # Kall skal gå gjennom RateLimiter
+    throttle = True
+
+    def send(self, session, method, url, **kwargs):
+        return session.request(method, url, **kwargs)
+
+    def close(self):
+        pass
+
+
+def _cassette_key(method, url):
+    # Uavhengig av tenar og rekkefølgje på parametrane
+    p = urlparse(url)
+    query = urlencode(sorted(parse_qsl(p.query, keep_blank_values=True)))
+    return '%s %s?%s' % (method.upper(), p.path, query)
+
+# Headers tatt vare paa i kassetten
+_CASSETTE_HEADERS = ('Content-Type', 'ETag', 'Last-Modified', 'Retry-After')
+
+
+class RecordingTransport(LiveTransport):
+    '''
+    Sends requests to the server and appends every exchange to *cassette*,
+    one JSON line with method, url, status, headers and the response body
+    zlib compressed and base64 encoded.
+    '''
+
+    def __init__(self, cassette, inner=None):
+        self.cassette = cassette
+        self.inner = inner if inner is not None else LiveTransport()
+        self._lock = threading.Lock()
+        opath = dirname(cassette)
+        if opath and not exists(opath):
+            os.makedirs(opath)
+
+    def send(self, session, method, url, **kwargs):
+        response = self.inner.send(session, method, url, **kwargs)
+        # Strøyma svar blir lest heilt her, det er prisen for opptaket
+        content = response.content
+        headers = dict((k, response.headers[k]) for k in _CASSETTE_HEADERS
+                       if k in response.headers)
+        record = {'method': method.upper(),
+                  'url': url,
+                  'status': response.status_code,
+                  'headers': headers,
+                  'body': base64.b64encode(zlib.compress(content)).decode('ascii')}
+        line = json.dumps(record, sort_keys=True)
+        with self._lock:
+            with open(self.cassette, 'a') as fobj:
+                fobj.write(line + '\n')
+        response.close()
+        return CannedResponse(url, response.status_code, headers, content)
+
+
+class ReplayTransport(object):
+    '''
+    Serves responses from a cassette written by *RecordingTransport*,
+    without network. Requests are matched on method, path and query
+    (in any order). Repeated requests get the recorded responses in
+    order, the last one is reused. Unknown requests give 404.
+
+    *latency* (seconds pr request) and *bandwidth* (bytes pr second)
+    simulate a network, 0 means instant.
+    '''
+    # Ingen grunn til å bremse avspeling
+    throttle = False
+
+    def __init__(self, cassette, latency=0., bandwidth=0.):
+        self.cassette = cassette
+        self.latency = float(latency or 0)
+        self.bandwidth = float(bandwidth or 0)
+        self.stats = {'hits': 0, 'misses': 0}
+        self._records = {}
+        self._served = {}
+        self._lock = threading.Lock()
+        with open(cassette) as fobj:
+            for line in fobj:
+                line = line.strip()
+                if not line:
+                    continue
+                record = json.loads(line)
+                key = _cassette_key(record['method'], record['url'])
+                self._records.setdefault(key, []).append(record)
+
+    def send(self, session, method, url, **kwargs):
+        key = _cassette_key(method, url)
+        with self._lock:
+            records = self._records.get(key)
+            if records:
+                i = self._served.get(key, 0)
+                self._served[key] = i + 1
+                record = records[min(i, len(records) - 1)]
+                self.stats['hits'] += 1
+            else:
+                record = None
+                self.stats['misses'] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if record is None:
+            logger.warning('Fant ikke %s i kassett %s', key, self.cassette)
+            body = json.dumps([{'code': 0, 'message': 'Ikke i kassett: %s' % key}])
+            return CannedResponse(url, 404, {'Content-Type': 'application/json'},
+                                  body.encode('utf-8'))
+        content = zlib.decompress(base64.b64decode(record['body']))
+        response = CannedResponse(url, record['status'], record['headers'],
+                                  content, bandwidth=self.bandwidth)
+        if self.bandwidth and not kwargs.get('stream'):
+            # Heile svaret blir lasta ned før det blir returnert
+            time.sleep(len(content) / self.bandwidth)
+        return response
+
+    def close(self):
+        pass
+
+
+def transport_from_config(cfg):
+    '''
+    Returns transport for *cfg['transport']['mode']*: live (default),
+    record or replay
+    '''
+    opts = cfg.get('transport') or {}
+    mode = opts.get('mode', 'live') or 'live'
+    if mode == 'live':
+        return LiveTransport()
+    if mode == 'record':
+        return RecordingTransport(opts['cassette'])
+    if mode == 'replay':
+        return ReplayTransport(opts['cassette'],
+                               latency=opts.get('latency', 0),
+                               bandwidth=opts.get('bandwidth', 0))
+    raise ValueError('Ukjent transport: %s' % mode)
+
+
+class NvdbClient(object):
+    '''
+    Thread-safe HTTP client for the NVDB API. Each thread gets its own
+    *requests.Session*, while all sessions share one *HTTPAdapter*, so the
+    connection pool per host is shared and sized for *pool_maxsize*
+    concurrent requests. All requests use connect/read timeouts and ask
+    for gzip compressed responses. GET responses go through *cache* if set.
+    Requests are throttled by *limiter*, which also decides how 429 and
+    5xx responses are retried. The request itself is sent by *transport*,
+    which can record or replay traffic. Identical GET requests share one
+    call through *coalescer*. Every call is recorded in *metrics*.
+    '''
+
+    def __init__(self, pool_connections=4, pool_maxsize=16,
+                 connect_timeout=10., read_timeout=300., retries=5,
+                 cache=None, limiter=None, transport=None, coalescer=None,
+                 metrics=None):
+        '''
+        :param pool_connections: Number of hosts to keep pools for
+        :param pool_maxsize: Connections kept pr host
+        :param connect_timeout: Seconds to wait for a connection
+        :param read_timeout: Seconds to wait for data from the server
+        :param retries: Retries on connection errors
+        :param cache: *ResponseCache* or None
+        :param limiter: *RateLimiter*, a default one is used if None
+        :param transport: *LiveTransport* (default), *RecordingTransport*
+            or *ReplayTransport*
+        :param coalescer: *RequestCoalescer* or None
+        :param metrics: *RequestMetrics*, the module's *METRICS* if None
+        '''
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.cache = cache
+        self.limiter = limiter if limiter is not None else RateLimiter()
+        self.transport = transport if transport is not None else LiveTransport()
+        self.coalescer = coalescer
+        self.metrics = metrics if metrics is not None else METRICS
+        # Statuskodar blir prøvd på nytt av limiter, ikkje av urllib3
+        self._adapter = HTTPAdapter(pool_connections=pool_connections,
+                                    pool_maxsize=pool_maxsize,
+                                    max_retries=Retry(total=retries,
+                                                      status_forcelist=[],
+                                                      respect_retry_after_header=False))
+        self._local = threading.local()
+        # Svake referansar, sesjonen forsvinn med tråden sin
+        self._sessions = weakref.WeakSet()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, cfg):
+        '''
+        Returns client set up from *cfg['http_client']*, *cfg['http_cache']*,
+        *cfg['rate_limit']* and *cfg['transport']*. The response cache is
+        not used when recording or replaying, so every run sees the same
+        requests.
+        '''
+        opts = cfg.get('http_client') or {}
+        transport = transport_from_config(cfg)
+        cache = None
+        if type(transport) is LiveTransport:
+            cache = ResponseCache.from_config(cfg)
+        coalescer = None
+        if opts.get('coalesce', True):
+            coalescer = RequestCoalescer(window=opts.get('coalesce_window', 5.))
+        return cls(pool_connections=opts.get('pool_connections', 4),
+                   pool_maxsize=opts.get('pool_maxsize', 16),
+                   connect_timeout=opts.get('connect_timeout', 10.),
+                   read_timeout=opts.get('read_timeout', 300.),
+                   retries=opts.get('retries', 5),
+                   cache=cache,
+                   limiter=RateLimiter.from_config(cfg),
+                   transport=transport,
+                   coalescer=coalescer)
+
+    @property
+    def session(self):
+        '''
+        Session for the calling thread
+        '''
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = Session()
+            session.mount('https://', self._adapter)
+            session.mount('http://', self._adapter)
+            session.headers['Accept-Encoding'] = 'gzip, deflate'
+            self._local.session = session
+            with self._lock:
+                self._sessions.add(session)
+        return session
+
+    def _send(self, method, url, info=None, **kwargs):
+        '''
+        Send request through the limiter, retrying statuses the limiter
+        asks for. Raises HTTPError when retries are used up. With
+        *stream=True* the slot of the limiter is kept by the returned
+        response, and must be released by *_release()* once it is closed.
+        '''
+        limiter = self.limiter
+        transport = self.transport
+        host = urlparse(url).netloc
+        attempt = 0
+        while True:
+            if transport.throttle:
+                limiter.acquire(host)
+            release = transport.throttle
+            try:
+                response = transport.send(self.session, method, url,
+                                          timeout=self.timeout, **kwargs)
+                status = response.status_code
+                if status not in limiter.retry_statuses:
+                    # Strøymde svar blir lest etterpå, plassen følgjer svaret
+                    if kwargs.get('stream'):
+                        release = False
+                    break
+            finally:
+                if release:
+                    limiter.release(host)
+            if attempt >= limiter.max_retries:
+                body = response.content
+                response.close()
+                raise HTTPError(url, status, 'Ga opp etter %d forsøk' % (attempt + 1),
+                                response.headers, BytesIO(body))
+            delay = limiter.retry_delay(response, attempt)
+            if status == 429 or 'Retry-After' in response.headers:
+                # Gjeld alle trådar som snakkar med same tenar
+                limiter.block(host, delay)
+            logger.debug('%s svarte %d, prøver igjen om %.1f s', url, status, delay)
+            response.close()
+            time.sleep(delay)
+            attempt += 1
+        if info is not None:
+            info['retries'] = attempt
+        return response
+
+    def _release(self, url):
+        '''
+        Release the slot kept by a streamed response from *url*
+        '''
+        if self.transport.throttle:
+            self.limiter.release(urlparse(url).netloc)
+
+    def get(self, url, headers=None, stream=False, info=None):
+        return self._send('GET', url, info=info, headers=headers,
+                          verify=True, stream=stream)
+
+    def post(self, url, params, headers=None, info=None):
+        return self._send('POST', url, info=info, data=params,
+                          headers=headers)
+
+    def request(self, url, headers, params=None, mode='GET', info=None,
+                coalesce=True):
+        '''
+        Returns decoded JSON response from *url*, or '' if NVDB answers with
+        an error. See *request()*.
+        '''
+        if params and mode.lower() == 'post':
+            # response = requests.post(url, params)
+            response = self.post(url, params)
+            return response.json()
+
+        if info is None:
+            info = {}
+        try:
+            coalescer = self.coalescer
+            if not coalesce or coalescer is None:
+                return self._get_json(url, headers, info)
+
+            called = []
+
+            def fetch():
+                called.append(True)
+                return self._get_json(url, headers, info)
+
+            r = coalescer.call(coalescer.key(url, headers), fetch)
+            if not called:
+                info.update(status=200, elapsed=0., bytes=0, coalesced=True)
+            return r
+        except HTTPError as e:
+            info['status'] = e.code
+            raise
         except Exception as e:
+            info['status'] = type(e).__name__
             raise
+        finally:
+            self._record(url, info)
+
+    def _record(self, url, info):
+        self.metrics.record(url, status=info.get('status'),
+                            elapsed=info.get('elapsed', 0.),
+                            nbytes=info.get('bytes', 0),
+                            retries=info.get('retries', 0),
+                            cached=info.get('cached', False),
+                            coalesced=info.get('coalesced', False))
+
+    def _get_json(self, url, headers, info=None):
+        t0 = time.time()
+        r, state = self._lookup(url, headers, info)
+        if state is None:
+            return r
+        response = self.get(url, headers=state[3], info=info)
+        return self._finish(url, response, state, t0, info)
+
+    def _lookup(self, url, headers, info=None):
+        '''
+        Returns *(r, None)* if the cache has a fresh response *r* for *url*.
+        Otherwise returns *(None, state)*, where *state* is passed on to
+        *_finish()* and *state[3]* are the headers to send, with
+        validators for revalidation.
+        '''
+        cache = self.cache
+        ttl = cache.ttl_for(url) if cache is not None else None
+        key = entry = None
+        if ttl is not None:
+            key = cache.key(url, headers)
+            entry = cache.get(key)
+            if entry is not None:
+                if cache.is_fresh(entry, ttl):
+                    cache.stats['hits'] += 1
+                    if info is not None:
+                        info.update(status=200, elapsed=0., bytes=0, cached=True)
+                    return _decode_body(entry['body']), None
+                validators = cache.validators(entry)
+                if validators:
+                    headers = dict(headers or {}, **validators)
+        return None, (ttl, key, entry, headers)
+
+    def _finish(self, url, response, state, t0, info=None):
+        '''
+        Returns decoded JSON from *response*, using and updating the cache
+        as decided by *_lookup()*
+        '''
+        ttl, key, entry, _ = state
+        cache = self.cache
+        if info is not None:
+            info['status'] = response.status_code
+            info['elapsed'] = time.time() - t0
+            info['bytes'] = len(response.content)
+        if response.status_code == 304 and entry is not None:
+            # Uendra sidan sist, bruk lagra svar
+            cache.stats['revalidated'] += 1
+            entry = cache.touch(key, entry)
+            return _decode_body(entry['body'])
+        if response.status_code != 200:
+            _log_api_errors(response, url)
+            return ''
+        if ttl is not None:
+            cache.stats['misses'] += 1
+            # Uten ttl kan svaret bare brukes igjen etter revalidering
+            if (ttl > 0 or response.headers.get('ETag') or
+                    response.headers.get('Last-Modified')):
+                cache.put(key, url, response)
+        return response.json()
+
+    def stream(self, url, headers, array_key='objekter', chunk_size=65536,
+               info=None):
+        '''
+        Returns *StreamedResponse* for *url*, see *request_stream()*. The
+        response counts against the concurrency of the limiter until it is
+        closed.
+        '''
+        if info is None:
+            info = {}
+        t0 = time.time()
+        try:
+            response = self.get(url, headers=headers, stream=True, info=info)
+            info['status'] = response.status_code
+        except Exception as e:
+            info['status'] = getattr(e, 'code', None) or type(e).__name__
+            raise
+        finally:
+            # Bytes blir lagt til når svaret er lest
+            info['elapsed'] = time.time() - t0
+            self._record(url, info)
+        if response.status_code != 200:
+            try:
+                _log_api_errors(response, url)
+            finally:
+                response.close()
+                self._release(url)
+            return StreamedResponse(None, array_key)
+        metrics = self.metrics
+
+        def on_close(s):
+            # Plassen hos limiteren er halden til svaret er lest
+            self._release(url)
+            metrics.add_bytes(url, s.nbytes)
+        return StreamedResponse(response, array_key, chunk_size,
+                                on_close=on_close)
+
+    def close(self):
+        with self._lock:
+            sessions = list(self._sessions)
+            self._sessions.clear()
+        for session in sessions:
+            session.close()
+        self._adapter.close()
+        self.transport.close()
+
+
+# Klienten som brukes av request(), sett opp av configure_client()
+CLIENT = None
+
+def get_client():
+    '''
+    Returns the client used by *request()*, creating a default one if
+    *configure_client()* has not been called
+    '''
+    global CLIENT
+    if CLIENT is None:
+        with _CLIENT_LOCK:
+            if CLIENT is None:
+                CLIENT = NvdbClient()
+    return CLIENT
+
+def set_datakatalog_version(version):
+    '''
+    Tell the response cache of the client used by *request()* which
+    datakatalog version NVDB is at, see *ResponseCache*
+    '''
+    cache = get_client().cache
+    if cache is not None:
+        cache.version = version
 
-    return response.json()
+def dump_metrics(cfg):
+    '''
+    Log request statistics, and write them as JSON to
+    *cfg['metrics_file']* if set. See *RequestMetrics*.
+    '''
+    logger.debug('Kall mot NVDB:\n%s', METRICS.summary())
+    fname = cfg.get('metrics_file')
+    if fname:
+        try:
+            METRICS.dump(fname)
+        except (IOError, OSError) as e:
+            logger.warning('Kunne ikke skrive statistikk til %s: %s', fname, e)
+
+def configure_client(cfg):
+    '''
+    Set up the client used by *request()* from *cfg*, see
+    *NvdbClient.from_config()*
+    '''
+    global CLIENT
+    client = NvdbClient.from_config(cfg)
+    with _CLIENT_LOCK:
+        old, CLIENT = CLIENT, client
+    if old is not None:
+        old.close()
+    return client
+
+def request_stream(baseurl, uri, headers, query=None, array_key='objekter',
+                   chunk_size=65536, info=None):
+    '''
+    Like *request()*, but the response is decoded while it is read. Returns
+    a *StreamedResponse* yielding the items of the top level array
+    *array_key* one at a time, so only one item needs to be in memory.
+    Failed calls are logged and give an empty response.
+
+    :param array_key: Name of top level array to stream
+    :param chunk_size: Number of bytes read from the connection at a time
+    :param info: Optional dictionary, filled with 'status' and 'elapsed'
+        (seconds until headers were received). The number of bytes is
+        known from *nbytes* of the response once it has been read.
+    '''
+    url = _build_url(baseurl, uri, query)
+    logger.debug('(dbg) request_stream: url: %s', url)
+    return get_client().stream(url, headers, array_key=array_key,
+                               chunk_size=chunk_size, info=info)
+
+def _gather_threads(client, urls, headers, concurrency, coalesce,
+                    return_exceptions):
+    def fetch(url):
+        try:
+            return client.request(url, headers, coalesce=coalesce), None
+        except Exception as e:
+            return None, e
+
+    if concurrency < 2 or len(urls) < 2:
+        fetched = [fetch(url) for url in urls]
+    else:
+        pool = ThreadPool(min(concurrency, len(urls)))
+        try:
+            fetched = pool.map(fetch, urls)
+        finally:
+            pool.close()
+            pool.join()
+    results = []
+    for r, e in fetched:
+        if e is not None:
+            if not return_exceptions:
+                raise e
+            r = e
+        results.append(r)
+    return results
+
+def gather_json(baseurl, uris, headers, queries=None, concurrency=None,
+                coalesce=True, return_exceptions=False):
+    '''
+    Returns list of decoded responses for *uris*, fetched concurrently
+    with the cache, rate limiter, retries and metrics of *request()*.
+    Meant for many small requests, like one pr object type.
+
+    On python 3 with aiohttp installed all requests are sent from one
+    thread with asyncio, see *nvdb_access.aio*. Otherwise, or when
+    recording or replaying, a thread pool is used.
+
+    :param queries: Query string for each uri, or None
+    :param concurrency: Requests in flight, defaults to the rate limiter's
+    :param coalesce: Fetch repeated uris once. Results are then read-only,
+        as for *request()*
+    :param return_exceptions: Return exceptions in place of results instead
+        of raising the first one
+    '''
+    if queries is None:
+        queries = [None] * len(uris)
+    urls = [_build_url(baseurl, uri, query) for uri, query in zip(uris, queries)]
+    unique = list(OrderedDict.fromkeys(urls)) if coalesce else urls
+    client = get_client()
+    if concurrency is None:
+        concurrency = client.limiter.concurrency
+
+    results = None
+    if sys.version_info[0] >= 3 and type(client.transport) is LiveTransport:
+        try:
+            from .aio import gather_urls
+        except ImportError:
+            # aiohttp er ikkje installert
+            gather_urls = None
+        if gather_urls is not None:
+            results = gather_urls(client, unique, headers, concurrency,
+                                  return_exceptions=return_exceptions)
+    if results is None:
+        results = _gather_threads(client, unique, headers, concurrency,
+                                  coalesce, return_exceptions)
+    if not coalesce:
+        return results
+    by_url = dict(zip(unique, [freeze(r) for r in results]))
+    return [by_url[url] for url in urls]
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+class StreamedResponse(object):
+    '''
+    Incremental decoder for a JSON object response. Iterating yields the
+    items of the array *array_key*, other top level values are collected in
+    *fields* as they are passed. Values placed after the array (NVDB puts
+    *metadata* there) are available once iteration is done, or after
+    *finish()*. *on_close* is called with the response when it is closed.
+    *read_time* is the time spent waiting for data from the connection.
+    '''
+
+    def __init__(self, response, array_key, chunk_size=65536, on_close=None):
+        self.array_key = array_key
+        self._on_close = on_close
+        self.fields = {}
+        self.nelem = 0
+        self.nbytes = 0
+        self.read_time = 0.
+        self._response = response
+        if response is None:
+            self._chunks = iter(())
+        else:
+            self._chunks = response.iter_content(chunk_size)
+        self._text = codecs.getincrementaldecoder('utf-8')()
+        self._json = json.JSONDecoder()
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+        self._items = self._parse()
+
+    def __iter__(self):
+        return self._items
+
+    @property
+    def metadata(self):
+        return self.fields.get('metadata')
+
+    def finish(self):
+        '''
+        Reads rest of response, skipping any array items not yet consumed
+        '''
+        for _ in self._items:
+            pass
+
+    def close(self):
+        if self._response is not None:
+            self._response.close()
+            self._response = None
+            if self._on_close is not None:
+                self._on_close(self)
+
+    def _fill(self):
+        # Les neste bit og kast det som allereie er tolka
+        while True:
+            t0 = time.time()
+            chunk = next(self._chunks, None)
+            self.read_time += time.time() - t0
+            if chunk is None:
+                break
+            if not chunk:
+                continue
+            self.nbytes += len(chunk)
+            self._buf = self._buf[self._pos:] + self._text.decode(chunk)
+            self._pos = 0
+            return True
+        if not self._eof:
+            self._buf = self._buf[self._pos:] + self._text.decode(b'', final=True)
+            self._pos = 0
+            self._eof = True
+        return False
+
+    def _peek(self):
+        while True:
+            self._pos = _WHITESPACE.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                raise ValueError('Uventa slutt på JSON-svar')
+
+    def _expect(self, char):
+        if self._peek() != char:
+            raise ValueError('Forventa %s i JSON-svar, fant %s' % (char, self._buf[self._pos:self._pos + 20]))
+        self._pos += 1
+
+    def _value(self):
+        self._peek()
+        while True:
+            try:
+                obj, end = self._json.raw_decode(self._buf, self._pos)
+            except ValueError:
+                # Verdien er ikkje heilt lasta ned enno. Doble bufferen
+                # slik at store verdiar ikkje blir tolka om att for ofte
+                need = 2 * (len(self._buf) - self._pos) + 1
+                if not self._fill():
+                    raise
+                while len(self._buf) - self._pos < need and self._fill():
+                    pass
+                continue
+            if end == len(self._buf) and self._fill():
+                # Eit tal kan halde fram i neste bit
+                continue
+            self._pos = end
+            return obj
+
+    def _parse(self):
+        if self._response is None:
+            return
+        try:
+            self._expect('{')
+            if self._peek() == '}':
+                return
+            while True:
+                key = self._value()
+                self._expect(':')
+                if key == self.array_key:
+                    self._expect('[')
+                    if self._peek() == ']':
+                        self._pos += 1
+                    else:
+                        while True:
+                            item = self._value()
+                            self.nelem += 1
+                            yield item
+                            del item
+                            char = self._peek()
+                            self._pos += 1
+                            if char == ']':
+                                break
+                            if char != ',':
+                                raise ValueError('Ugyldig JSON-liste i svar')
+                else:
+                    self.fields[key] = self._value()
+                char = self._peek()
+                self._pos += 1
+                if char == '}':
+                    break
+                if char != ',':
+                    raise ValueError('Ugyldig JSON-objekt i svar')
+        finally:
+            self.close()
 
 def check_token(cfg, t_buffer=1800):
     ttoken = dtm.datetime.fromtimestamp(cfg['token_expires'] / 1e3)
@@ -464,7 +1828,20 @@ class BaseDataset(object):
 
 
 
+def _join_path(*parts):
+    '''
+    Join and normalize node paths, the result always starts with '/'
+    '''
+    return '/%s' % '/'.join(p.strip('/') for p in parts if p.strip('/'))
+
+
 class BaseGroup(object):
+    '''
+    h5py-like group. All groups and datasets in a file share one flat
+    index from absolute path to node, so a lookup is a single dictionary
+    probe regardless of depth. The *_groups*/*_datasets* dictionaries of
+    each group are views of the same nodes, kept for iteration.
+    '''
 
     def __init__(self, *args, **kwargs):
         self.attrs = {}
@@ -474,31 +1851,20 @@ class BaseGroup(object):
             self.name = kwargs['name']
         except:
             self.name = '/'
+        self._index = kwargs.get('index')
+        if self._index is None:
+            self._index = {self.name: self}
 
     def __getitem__(self, uri):
-        pparts = uri.strip('/').split('/')
-        grp_name = pparts.pop(0)
-        db_name = '/'.join([self.name, grp_name])
-        db_name = '/%s' % db_name.lstrip('/')
-        nparts = len(pparts)
-        if not pparts:
-            try:
-                return self._groups[grp_name]
-            except:
-                pass
-            try:
-                return self._datasets[grp_name]
-            except KeyError:
-                msg = 'Name %s does not exist' % db_name
-                raise KeyError(msg)
-        else:
-            new_uri = '/'.join([pparts.pop(0) for _ in range(nparts)])
-            try:
-                return self._groups[grp_name][new_uri]
-            except KeyError:
-                msg = 'Group %s does not exist' % db_name
-                raise KeyError(msg)
+        db_name = _join_path(self.name, uri)
+        try:
+            return self._index[db_name]
+        except KeyError:
+            msg = 'Name %s does not exist' % db_name
+            raise KeyError(msg)
 
+    def __contains__(self, name):
+        return name in self._groups or name in self._datasets
 
     def __iter__(self):
         '''
@@ -507,68 +1873,42 @@ class BaseGroup(object):
         for name in chain(self._groups, self._datasets):
             yield name
 
+    def _parent_for(self, db_name):
+        '''
+        Returns parent group of *db_name*, creating missing groups on the way
+        '''
+        parent_name, _, _ = db_name.rpartition('/')
+        parent_name = parent_name or '/'
+        try:
+            parent = self._index[parent_name]
+        except KeyError:
+            parent = self._index['/'].create_group(parent_name)
+        if not isinstance(parent, BaseGroup):
+            # Kan ikkje leggje noko under eit datasett
+            raise ValueError
+        return parent
 
     def create_group(self, uri, *args, **kwargs):
-        pparts = uri.strip('/').split('/')
-        grp_name = pparts.pop(0)
-        db_name = '/'.join([self.name, grp_name])
-        db_name = '/%s' % db_name.lstrip('/')
-        nparts = len(pparts)
-        if len(pparts) >= 1:
-            new_uri = '/'.join([pparts.pop(0) for _ in range(nparts)])
-            if grp_name in self._datasets:
-                raise ValueError
-                return
-            try:
-                grp = self._groups[grp_name]
-            except KeyError:
-                grp = BaseGroup(name=db_name)
-                self._groups[grp_name] = grp
-            return grp.create_group(new_uri)
-        elif not pparts:
-            # We've come to the bottom, so create a group and return it
-            if grp_name in self._groups:
-#                 raise Exception('Group already exists')
-                raise ValueError
-            elif grp_name in self._datasets:
-#                 raise Exception('%s is an existing dataset' % db_name)
-                raise ValueError
-            else:
-                self._groups[grp_name] = BaseGroup(name=db_name)
-                return self._groups[grp_name]
-
+        db_name = _join_path(self.name, uri)
+        if db_name in self._index:
+            # Group or dataset already exists
+            raise ValueError
+        parent = self._parent_for(db_name)
+        grp = BaseGroup(name=db_name, index=self._index)
+        parent._groups[db_name.rpartition('/')[2]] = grp
+        self._index[db_name] = grp
+        return grp
 
     def create_dataset(self, uri, shape=pl.float64, dtype=None, data=None):
-        pparts = uri.strip('/').split('/')
-        dset_name = pparts.pop(0)
-        db_name = '/'.join([self.name, dset_name])
-        db_name = '/%s' % db_name.lstrip('/')
-        nparts = len(pparts)
-        if len(pparts) >= 1:
-            new_uri = '/'.join([pparts.pop(0) for _ in range(nparts)])
-            if dset_name in self._datasets:
-                raise ValueError
-                return
-            try:
-                grp = self._groups[dset_name]
-            except KeyError:
-                grp = BaseGroup(name=db_name)
-                self._groups[dset_name] = grp
-            return grp.create_dataset(new_uri, shape, dtype, data)
-        elif not pparts:
-            # We've come to the bottom, so create a group and return it
-            if dset_name in self._groups: 
-#                 raise Exception('Group already exists')
-                raise ValueError
-                return
-            elif dset_name in self._datasets:
-#                 raise Exception('%s is an existing dataset' % db_name)
-                raise ValueError
-                return
-            else:
-                self._datasets[dset_name] = BaseDataset(db_name, shape,
-                                                        dtype, data)
-                return self._datasets[dset_name]
+        db_name = _join_path(self.name, uri)
+        if db_name in self._index:
+            # Group or dataset already exists
+            raise ValueError
+        parent = self._parent_for(db_name)
+        dset = BaseDataset(db_name, shape, dtype, data)
+        parent._datasets[db_name.rpartition('/')[2]] = dset
+        self._index[db_name] = dset
+        return dset
 
 # try:
 #     from h5py import File
@@ -586,70 +1926,95 @@ class BaseFile(File):
         A h5py.File object customized to store information about retrieved
         from a REST API, originally for the norwegian road database (nvdb)
 
+        Every entry is stored as one record *(dbid, name, uri)*, indexed
+        by each of the three keys.
+
         :param baseurl: Url to root of database
         :param name:
         '''
         # Initialize the file object
         File.__init__(self, name, *args, **kwds)
-        self._dbid2name_map = {'/': 'root'}
-        self._name2dbid_map = {'root': '/'}
-        self._name2uri_map = {'root': '/'}
-        self._dbid2uri_map = {'/': '/'}
-        self._uri2name_map = {'/': 'root'}
-        self._uri2dbid_map = {'/': '/'}
+        root = ('/', 'root', '/')
+        self._by_dbid = {'/': root}
+        self._by_name = {'root': root}
+        self._by_uri = {'/': root}
         self.attrs['dbid'] = '/'
         self.attrs['name'] = 'root'
 
 
     def add(self, dbid, name, uri):
-        if dbid in self._dbid2name_map:
-            # If we re-add old id check if this is the same object as
-            # existing one
-            assert self._dbid2uri_map[dbid] == uri
-            assert self._dbid2name_map[dbid] == name
-            return
-        if name in self._name2dbid_map:
-            # If we re-add old name check if this is the same object as
-            # existing one
-            assert self._name2dbid_map[name] == dbid
-            assert self._name2uri_map[name] == uri
+        rec = (self._by_dbid.get(dbid) or self._by_name.get(name) or
+               self._by_uri.get(uri))
+        if rec is not None:
+            # If we re-add old id, name or uri check if this is the same
+            # object as existing one
+            assert rec == (dbid, name, uri)
             return
-        if uri in self._uri2name_map:
-            # If we re-add old uri check if this is the same object as
-            # existing one
-            assert self._uri2name_map[uri] == name
-            assert self._uri2dbid_map[uri] == dbid
-            return
-        self._dbid2name_map[dbid] = name
-        self._name2dbid_map[name] = dbid
-        self._name2uri_map[name] = uri
-        self._dbid2uri_map[dbid] = uri
-        self._uri2name_map[uri] = name
-        self._uri2dbid_map[uri] = dbid
+        rec = (dbid, name, uri)
+        self._by_dbid[dbid] = rec
+        self._by_name[name] = rec
+        self._by_uri[uri] = rec
 
     def by_name(self, name):
-        if not name in self._name2dbid_map:
-            raise KeyError("Key %s not found, available keys are %s" % (name, sorted(self._name2dbid_map.keys())))
-        dbid = self._name2dbid_map[name]
-        uri = self._name2uri_map[name]
-        assert self._dbid2name_map[dbid] == name
-        assert self._uri2name_map[uri] == name
+        try:
+            dbid, _, uri = self._by_name[name]
+        except KeyError:
+            raise KeyError("Key %s not found, available keys are %s" % (name, sorted(self._by_name.keys())))
         return uri, dbid
 
     def by_uri(self, uri):
-        dbid = self._uri2dbid_map[uri]
-        name = self._uri2name_map[uri]
-        assert self._dbid2uri_map[dbid] == uri
-        assert self._name2uri_map[name] == uri
+        dbid, name, _ = self._by_uri[uri]
         return dbid, name
 
     def by_dbid(self, dbid):
-        uri = self._dbid2uri_map[dbid]
-        name = self._dbid2name_map[dbid]
-        assert self._uri2dbid_map[uri] == dbid
-        assert self._name2dbid_map[name] == dbid
+        _, name, uri = self._by_dbid[dbid]
         return uri, name
 
+    def save(self, fname, tag=None):
+        '''
+        Write a snapshot of the file to disk. The snapshot is written to a
+        temporary file first, so a crash never leaves a half-written
+        snapshot behind (on py2 it may leave no snapshot).
+
+        :param fname: Path to snapshot
+        :param tag: Dictionary identifying the snapshot, typically
+            datakatalog version and baseurl. Checked by *load()*.
+        '''
+        opath = dirname(fname)
+        if opath and not exists(opath):
+            os.makedirs(opath)
+        tmp_fname = '%s.tmp' % fname
+        snapshot = {'format': SNAPSHOT_FORMAT,
+                    'tag': tag or {},
+                    'file': self}
+        with open(tmp_fname, 'wb') as fobj:
+            # Protokoll 2 kan lesast av baade ArcMap (py2) og ArcGIS Pro (py3)
+            pickle.dump(snapshot, fobj, 2)
+        replace_file(tmp_fname, fname)
+
+    @staticmethod
+    def load(fname, tag=None):
+        '''
+        Read a snapshot written by *save()*. Returns *None* if the snapshot
+        does not exist, can not be read or does not match *tag*.
+
+        :param fname: Path to snapshot
+        :param tag: Dictionary that must equal the tag stored in snapshot
+        '''
+        if not exists(fname):
+            return None
+        try:
+            with open(fname, 'rb') as fobj:
+                snapshot = pickle.load(fobj)
+        except Exception:
+            logger.debug('Klarte ikke lese metadata fra %s', fname, exc_info=True)
+            return None
+        if snapshot.get('format') != SNAPSHOT_FORMAT:
+            return None
+        if tag is not None and snapshot.get('tag') != tag:
+            return None
+        return snapshot['file']
+
 
 class BaseTool(object):
     """
@@ -672,6 +2037,18 @@ class BaseTool(object):
         self.description = ''
         self.canRunInBackground = False
 
+    @classmethod
+    def set_config_meta(cls, cwd):
+        """
+        Set config and metadata for tool. Config and metadata are shared
+        by all tools in the process, see *nvdb_access.provider*.
+
+        """
+        from .provider import get_config, get_meta
+        cls._cwd = cwd
+        cls._cfg = get_config(cwd)
+        cls._meta = get_meta(cwd)
+
     def __getitem__(self, key):
         """
         Returns a parameter object by its name.
@@ -0,0 +1,683 @@
+# -*- coding: utf-8 -*-
+'''
+Local stand-in for the parts of the NVDB v2 API used by the plugin.
+
+Serves deterministic synthetic data, so the same options always give the
+same objects, and nothing is held in memory except the object types.
+Objects are generated when a page is requested, which makes it possible
+to benchmark *populate_fc*, *update_fc* and *Builder* against millions of
+objects.
+
+Supported endpoints::
+
+    /                                   ressurser
+    /status                             datakatalog versjon og dato
+    /omrader, /omrader/{type}           regioner, fylker, kommuner, ...
+    /vegobjekttyper[/{id}[/{eid}]]      objekttyper og egenskapstyper
+    /vegobjekter[/{id}]                 søk med antall, start og neste
+    /vegobjekter/{id}/statistikk        antall og strekningslengde
+    /sokegrensesnitt                    søk med kriterie, som update_fc
+    /endringer/objekttype/{id}/slettet  sletta objekter med rows og next
+
+Searches can be limited with *region*, *fylke* and *kommune*, given as
+comma separated numbers. Objects lying in more than one kommune (see
+*crossing*) get their line geometry cut to the areas searched for, unless
+*segmentering=false*. In *sokegrensesnitt* the same areas are given in
+the *lokasjon* of *kriterie*, objects are never cut, and *start* counts
+from 1. Other parameters, e.g. *endretdato*, are accepted and ignored.
+
+The module only uses the standard library. Start a server from the
+command line and point *baseurl* in config.yaml to it::
+
+    python nvdb_access/standin.py --port 8080 --objects 10000000
+
+or use *start()* to run one in a background thread.
+'''
+import sys
+import json
+import math
+import time
+import zlib
+import hashlib
+import logging
+import threading
+
+if sys.version_info[0] < 3:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+    from urllib import urlencode
+else:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs, urlencode
+
+logger = logging.getLogger(__name__)
+
+GEOMETRY_TYPES = ['PUNKT', 'LINJE', 'FLATE']
+# Tekst, tall, dato, tekst-enum og tall-enum, se typerLut i config.yaml
+DATATYPES = [1, 2, 8, 30, 31]
+ENUM_VALUES = 5
+ID_BASE = 100000000
+SRID = 5973
+# Omtrentleg utstrekning av Noreg i UTM33
+EXTENT = (-100000, 6450000, 1100000, 7950000)
+
+
+def _mix(a, b=0):
+    '''
+    Returns deterministic 32 bit hash of two integers
+    '''
+    h = (a * 0x9E3779B1 + b * 0x85EBCA77 + 0x165667B1) & 0xffffffff
+    h ^= h >> 15
+    h = (h * 0x2C1B3C6D) & 0xffffffff
+    h ^= h >> 12
+    h = (h * 0x297A2D39) & 0xffffffff
+    h ^= h >> 15
+    return h
+
+
+class SyntheticNvdb(object):
+    '''
+    Deterministic synthetic NVDB content. Object *i* of a type is made
+    from a hash of type id and *i*, and belongs to kommune number
+    *i % (fylker * kommuner)*, so every kommune and fylke gets a share of
+    each object type.
+    '''
+
+    def __init__(self, types=20, objects=100000, egenskaper=12,
+                 points=(2, 50), deleted=1000, fylker=11, kommuner=30,
+                 regioner=5, mixed=0., crossing=0., max_page=10000,
+                 version='2.99', date='2019-06-20', seed=0):
+        '''
+        :param types: Number of object types
+        :param objects: Number of objects pr type
+        :param egenskaper: Number of egenskaper pr type
+        :param points: Min and max number of points in line and polygon
+            geometries
+        :param deleted: Number of deleted objects pr type
+        :param fylker: Number of fylker
+        :param kommuner: Number of kommuner pr fylke
+        :param regioner: Number of regioner
+        :param mixed: Share of objects with another geometry type than
+            their object type
+        :param crossing: Share of objects that also lie in the next
+            kommune. Searches limited by area are slower with crossing
+            objects, since objects are then checked one by one.
+        :param max_page: Largest page returned, as NVDB does when asked
+            for more
+        :param version: Datakatalog version
+        :param date: Datakatalog date
+        :param seed: Changes all generated values
+        '''
+        self.objects = int(objects)
+        self.points = (max(2, int(points[0])), max(2, int(points[0]), int(points[1])))
+        self.deleted = int(deleted)
+        self.nfylker = int(fylker)
+        self.nkommuner = int(kommuner)
+        self.nregioner = max(1, int(regioner))
+        self.mixed = int(float(mixed) * 0xffffffff)
+        self.crossing = int(float(crossing) * 0xffffffff)
+        self.max_page = int(max_page)
+        self.version = version
+        self.date = date
+        self.seed = int(seed)
+
+        self.types = {}
+        for n in range(int(types)):
+            dbid = n + 1
+            egenskapstyper = []
+            for j in range(int(egenskaper)):
+                eid = dbid * 1000 + j + 1
+                datatype = DATATYPES[j % len(DATATYPES)]
+                egenskapstyper.append({'id': eid,
+                                       'navn': 'Egenskap %d' % (j + 1),
+                                       'datatype': datatype})
+            self.types[dbid] = {'id': dbid,
+                                'navn': 'Testobjekt %d' % dbid,
+                                'stedfesting': GEOMETRY_TYPES[n % len(GEOMETRY_TYPES)],
+                                'egenskapstyper': egenskapstyper}
+
+    # Områder
+
+    def kommune_of(self, i):
+        '''
+        Returns *(region, fylke, kommune)* numbers for object *i*
+        '''
+        k = i % (self.nfylker * self.nkommuner)
+        fylke = k // self.nkommuner + 1
+        kommune = fylke * 100 + k % self.nkommuner + 1
+        region = (fylke - 1) % self.nregioner + 1
+        return region, fylke, kommune
+
+    def areas_of(self, i):
+        '''
+        Returns kommune indexes of object *i*, its own and the next one
+        for objects crossing a border
+        '''
+        period = self.nfylker * self.nkommuner
+        k = i % period
+        if self.crossing and _mix(i, self.seed + 7) < self.crossing:
+            return [k, (k + 1) % period]
+        return [k]
+
+    def _scan(self, residues):
+        # Med objekt over grensene må kvart objekt sjekkast
+        return self.crossing and len(residues) < self.nfylker * self.nkommuner
+
+    def omrader(self, omrade):
+        '''
+        Returns list of areas of type *omrade*, or None if unknown
+        '''
+        if omrade == 'regioner':
+            return [{'navn': 'Region %d' % r, 'nummer': r}
+                    for r in range(1, self.nregioner + 1)]
+        elif omrade == 'fylker':
+            return [{'navn': 'Fylke %d' % f, 'nummer': f}
+                    for f in range(1, self.nfylker + 1)]
+        elif omrade == 'kommuner':
+            return [{'navn': 'Kommune %d' % (f * 100 + k), 'nummer': f * 100 + k}
+                    for f in range(1, self.nfylker + 1)
+                    for k in range(1, self.nkommuner + 1)]
+        elif omrade == 'vegavdelinger':
+            return [{'navn': 'Vegavdeling %d' % f, 'nummer': f}
+                    for f in range(1, self.nfylker + 1)]
+        elif omrade == 'riksvegruter':
+            return [{'navn': 'RUTE%d' % r, 'nummer': r,
+                     'periode': '2014-2023',
+                     'beskrivelse': 'Testrute %d' % r}
+                    for r in range(1, 11)]
+        elif omrade == 'kontraktsomrader':
+            return [{'navn': '%04d Kontrakt %d' % (f, f), 'nummer': f}
+                    for f in range(1, self.nfylker + 1)]
+        return None
+
+    def residues(self, query):
+        '''
+        Returns sorted kommune indexes matching the area filters in *query*
+        '''
+        def numbers(key):
+            val = query.get(key)
+            if not val:
+                return None
+            return set(int(v) for v in val[0].split(',') if v.strip())
+
+        regioner = numbers('region')
+        fylker = numbers('fylke')
+        kommuner = numbers('kommune')
+        res = []
+        for k in range(self.nfylker * self.nkommuner):
+            region, fylke, kommune = self.kommune_of(k)
+            if regioner is not None and region not in regioner:
+                continue
+            if fylker is not None and fylke not in fylker:
+                continue
+            if kommuner is not None and kommune not in kommuner:
+                continue
+            res.append(k)
+        return res
+
+    def count(self, residues):
+        '''
+        Returns number of objects in the kommuner given by *residues*
+        '''
+        if self._scan(residues):
+            wanted = set(residues)
+            return sum(1 for i in range(self.objects)
+                       if wanted.intersection(self.areas_of(i)))
+        period = self.nfylker * self.nkommuner
+        full, rest = divmod(self.objects, period)
+        return full * len(residues) + sum(1 for r in residues if r < rest)
+
+    def indexes(self, residues, start, antall):
+        '''
+        Returns up to *antall* object indexes from *start* in the kommuner
+        given by *residues*, and the index to continue from
+        '''
+        res = []
+        if antall <= 0:
+            return res, start
+        if not residues:
+            return res, self.objects
+        if self._scan(residues):
+            wanted = set(residues)
+            i = start
+            while i < self.objects and len(res) < antall:
+                if wanted.intersection(self.areas_of(i)):
+                    res.append(i)
+                i += 1
+            return res, i
+        period = self.nfylker * self.nkommuner
+        q, rest = divmod(start, period)
+        i = start
+        while len(res) < antall:
+            for r in residues:
+                if r < rest:
+                    continue
+                i = q * period + r
+                if i >= self.objects:
+                    return res, self.objects
+                res.append(i)
+                if len(res) == antall:
+                    return res, i + 1
+            q += 1
+            rest = 0
+        return res, i + 1
+
+    # Vegobjekter
+
+    def _wkt(self, stedfesting, h, i, part=None):
+        x0, y0, x1, y1 = EXTENT
+        x = x0 + (h % 100000) * (x1 - x0) / 100000.
+        y = y0 + ((h >> 16) % 100000) * (y1 - y0) / 100000.
+        z = (h >> 8) % 1000 / 10.
+        if stedfesting == 'PUNKT':
+            return 'POINT Z (%.3f %.3f %.3f)' % (x, y, z)
+        lo, hi = self.points
+        npoints = lo + _mix(h, i) % (hi - lo + 1)
+        coords = []
+        if stedfesting == 'LINJE':
+            for p in range(npoints):
+                step = _mix(h, p)
+                x += 5 + step % 20
+                y += (step >> 8) % 21 - 10
+                coords.append((x, y))
+            if part is not None:
+                # Segmentert: første eller andre halvdel av lenkja
+                if len(coords) == 2:
+                    mid = ((coords[0][0] + coords[1][0]) / 2.,
+                           (coords[0][1] + coords[1][1]) / 2.)
+                    coords.insert(1, mid)
+                half = len(coords) // 2
+                coords = coords[:half + 1] if part == 0 else coords[half:]
+            return 'LINESTRING Z (%s)' % ', '.join(
+                '%.3f %.3f %.3f' % (cx, cy, z) for cx, cy in coords)
+        # Mangekant med npoints hjørner rundt (x, y), første punkt gjentas
+        radius = 10 + h % 90
+        for p in range(npoints):
+            a = 2 * math.pi * p / npoints
+            coords.append('%.3f %.3f %.3f' % (x + radius * math.cos(a),
+                                             y + radius * math.sin(a), z))
+        coords.append(coords[0])
+        return 'POLYGON Z ((%s))' % ', '.join(coords)
+
+    def _verdi(self, egenskapstype, h):
+        datatype = egenskapstype['datatype']
+        if datatype == 1:
+            return 'Tekst %08x' % h
+        elif datatype == 2:
+            return round((h % 1000000) / 100., 2)
+        elif datatype == 8:
+            return '%04d-%02d-%02d' % (1950 + h % 70, 1 + (h >> 8) % 12,
+                                       1 + (h >> 16) % 28)
+        return None
+
+    def vegobjekt(self, dbid, i, baseurl, wanted=None):
+        '''
+        Returns object *i* of type *dbid*, as in NVDB search results. With
+        *wanted*, a set of kommune indexes, the line geometry of an object
+        crossing a border is cut to the part within them.
+        '''
+        typ = self.types[dbid]
+        h = _mix(_mix(dbid, self.seed), i)
+        obj_id = ID_BASE + i
+        areas = self.areas_of(i)
+        lokasjon = {'kommuner': [], 'fylker': [], 'regioner': [],
+                    'vegavdelinger': []}
+        for k in areas:
+            region, fylke, kommune = self.kommune_of(k)
+            for key, val in (('kommuner', kommune), ('fylker', fylke),
+                             ('regioner', region), ('vegavdelinger', fylke)):
+                if not val in lokasjon[key]:
+                    lokasjon[key].append(val)
+        part = None
+        if wanted is not None and len(areas) > 1:
+            inside = [k in wanted for k in areas]
+            if not all(inside):
+                part = inside.index(True)
+        stedfesting = typ['stedfesting']
+        if self.mixed and _mix(h, 1) < self.mixed:
+            stedfesting = GEOMETRY_TYPES[(GEOMETRY_TYPES.index(stedfesting) + 1) %
+                                         len(GEOMETRY_TYPES)]
+
+        egenskaper = []
+        for et in typ['egenskapstyper']:
+            eh = _mix(h, et['id'])
+            egenskap = {'id': et['id'], 'navn': et['navn'],
+                        'datatype': et['datatype']}
+            if et['datatype'] in (30, 31):
+                k = eh % ENUM_VALUES
+                egenskap['enum_id'] = et['id'] * 10 + k
+                egenskap['verdi'] = ('Verdi %d' % (k + 1) if et['datatype'] == 30
+                                     else k + 1)
+            else:
+                egenskap['verdi'] = self._verdi(et, eh)
+            egenskaper.append(egenskap)
+
+        modified = '%04d-%02d-%02dT%02d:%02d:%02d+01:00' % (
+            2010 + h % 10, 1 + (h >> 4) % 12, 1 + (h >> 8) % 28,
+            (h >> 12) % 24, (h >> 16) % 60, (h >> 20) % 60)
+        return {'id': obj_id,
+                'href': '%s/vegobjekter/%d/%d/1' % (baseurl, dbid, obj_id),
+                'metadata': {'type': {'id': dbid, 'navn': typ['navn']},
+                             'versjon': 1 + h % 3,
+                             'startdato': modified[:10],
+                             'sist_modifisert': modified},
+                'egenskaper': egenskaper,
+                'geometri': {'wkt': self._wkt(stedfesting, h, i, part),
+                             'srid': SRID},
+                'lokasjon': lokasjon}
+
+    def search(self, dbid, query, baseurl):
+        '''
+        Returns a page of search results for type *dbid*
+        '''
+        antall = int(query.get('antall', ['1000'])[0])
+        antall = max(0, min(antall, self.max_page))
+        start = int(query.get('start', ['0'])[0] or 0)
+        residues = self.residues(query)
+        idx, next_start = self.indexes(residues, start, antall)
+        wanted = None
+        if (query.get('segmentering', ['true'])[0] != 'false' and
+                len(residues) < self.nfylker * self.nkommuner):
+            wanted = set(residues)
+        objekter = [self.vegobjekt(dbid, i, baseurl, wanted) for i in idx]
+
+        neste_query = dict((k, v[0]) for k, v in query.items())
+        neste_query['start'] = str(next_start)
+        return {'objekter': objekter,
+                'metadata': {'antall': self.count(residues),
+                             'returnert': len(objekter),
+                             'neste': {'start': str(next_start),
+                                       'href': '%s/vegobjekter/%d?%s' % (
+                                           baseurl, dbid,
+                                           urlencode(sorted(neste_query.items())))}}}
+
+    def _nth(self, residues, n):
+        '''
+        Returns index of object number *n* (from 0) in the kommuner given
+        by *residues*, for use as *start* in *indexes()*
+        '''
+        if n <= 0 or not residues:
+            return 0
+        if self._scan(residues):
+            _, i = self.indexes(residues, 0, n)
+            return i
+        q, j = divmod(n, len(residues))
+        return q * self.nfylker * self.nkommuner + residues[j]
+
+    def sokegrensesnitt(self, query, baseurl):
+        '''
+        Returns search result for *kriterie* in *query*, as made by
+        *shared.sok_parse()*
+        '''
+        if not query.get('kriterie'):
+            return {'totaltAntallReturnert': 0, 'resultater': []}
+        kriterie = json.loads(query['kriterie'][0])
+        lokasjon = kriterie.get('lokasjon') or {}
+        area_query = {}
+        for key in ('region', 'fylke', 'kommune'):
+            val = lokasjon.get(key)
+            if val is not None:
+                if not isinstance(val, list):
+                    val = format(val).split(',')
+                area_query[key] = [','.join('%d' % int(v) for v in val)]
+        residues = self.residues(area_query)
+        resultater = []
+        total = 0
+        for ot in kriterie['objektTyper']:
+            dbid = int(ot['id'])
+            if not dbid in self.types:
+                raise KeyError(dbid)
+            antall = max(0, min(int(ot.get('antall', 1000)), self.max_page))
+            start = max(1, int(ot.get('start', 1)))
+            idx, _ = self.indexes(residues, self._nth(residues, start - 1),
+                                  antall)
+            objekter = [self.vegobjekt(dbid, i, baseurl) for i in idx]
+            total += len(objekter)
+            resultater.append({'typeId': dbid,
+                               'vegObjekter': objekter,
+                               'statistikk': {'antallFunnet': self.count(residues)}})
+        return {'totaltAntallReturnert': total, 'resultater': resultater}
+
+    def statistikk(self, dbid, query):
+        antall = self.count(self.residues(query))
+        lengde = 0.
+        if self.types[dbid]['stedfesting'] == 'LINJE':
+            # Omtrentleg, 15 meter pr punkt i snitt
+            lengde = antall * 15. * sum(self.points) / 2.
+        return {'antall': antall, 'strekningslengde': lengde}
+
+    def slettet(self, dbid, query):
+        '''
+        Returns a page of deleted objects for type *dbid*. Deleted objects
+        have ids following the live objects. *next* is relative to
+        *baseurl*, as *data_da.get_deleted()* expects.
+        '''
+        rows = max(1, min(int(query.get('rows', ['1000'])[0]), self.max_page))
+        start = int(query.get('start', ['0'])[0] or 0)
+        stop = min(start + rows, self.deleted)
+        transactions = []
+        for j in range(start, stop):
+            h = _mix(_mix(dbid, self.seed + 1), j)
+            transactions.append({
+                'id': ID_BASE + self.objects + j,
+                'type': 'SLETTET',
+                'dato': '%04d-%02d-%02dT%02d:%02d:00+01:00' % (
+                    2015 + h % 5, 1 + (h >> 4) % 12, 1 + (h >> 8) % 28,
+                    (h >> 12) % 24, (h >> 16) % 60)})
+        if stop < self.deleted:
+            nxt = '/endringer/objekttype/%d/slettet?%s' % (
+                dbid, urlencode([('rows', rows), ('start', stop)]))
+        else:
+            nxt = None
+        return {'transactions': transactions, 'count': len(transactions),
+                'next': nxt}
+
+    # Ruting
+
+    def respond(self, path, query, baseurl):
+        '''
+        Returns *(status, body)* for a GET of *path*
+        '''
+        parts = [p for p in path.split('/') if p]
+        if not parts:
+            return 200, [{'navn': n, 'href': '%s/%s' % (baseurl, n)}
+                         for n in ('status', 'omrader', 'vegobjekttyper',
+                                   'vegobjekter', 'sokegrensesnitt')]
+        head = parts[0]
+        try:
+            if head == 'status' and len(parts) == 1:
+                return 200, {'datakatalog': {'id': 1, 'versjon': self.version,
+                                             'dato': self.date}}
+            elif head == 'omrader':
+                if len(parts) == 1:
+                    return 200, [{'navn': n, 'href': '%s/omrader/%s' % (baseurl, n)}
+                                 for n in ('regioner', 'fylker', 'vegavdelinger',
+                                           'kommuner', 'riksvegruter',
+                                           'kontraktsomrader')]
+                res = self.omrader(parts[1])
+                if len(parts) == 2 and res is not None:
+                    return 200, res
+            elif head == 'vegobjekttyper':
+                if len(parts) == 1:
+                    return 200, [{'id': t['id'], 'navn': t['navn']}
+                                 for _, t in sorted(self.types.items())]
+                typ = self.types[int(parts[1])]
+                if len(parts) == 2:
+                    return 200, typ
+                if len(parts) == 3:
+                    return 200, self.egenskapstype(typ, int(parts[2]))
+            elif head == 'vegobjekter':
+                if len(parts) == 1:
+                    return 200, [{'id': t['id'], 'navn': t['navn'],
+                                  'href': '%s/vegobjekter/%d' % (baseurl, t['id'])}
+                                 for _, t in sorted(self.types.items())]
+                dbid = int(parts[1])
+                if dbid in self.types:
+                    if len(parts) == 2:
+                        return 200, self.search(dbid, query, baseurl)
+                    if len(parts) == 3 and parts[2] == 'statistikk':
+                        return 200, self.statistikk(dbid, query)
+            elif head == 'sokegrensesnitt' and len(parts) == 1:
+                return 200, self.sokegrensesnitt(query, baseurl)
+            elif head == 'endringer' and len(parts) == 4 and parts[3] == 'slettet':
+                dbid = int(parts[2])
+                if dbid in self.types:
+                    return 200, self.slettet(dbid, query)
+        except (KeyError, ValueError, TypeError) as e:
+            return 400, [{'code': 4000, 'message': 'Ugyldig forespørsel: %s' % e}]
+        return 404, [{'code': 4040, 'message': 'Fant ikke %s' % path}]
+
+    def egenskapstype(self, typ, eid):
+        for et in typ['egenskapstyper']:
+            if et['id'] == eid:
+                res = dict(et)
+                res['beskrivelse'] = 'Syntetisk egenskap %d' % eid
+                if et['datatype'] in (30, 31):
+                    res['tillatte_verdier'] = [
+                        {'id': eid * 10 + k,
+                         'verdi': 'Verdi %d' % (k + 1) if et['datatype'] == 30 else k + 1,
+                         'kortnavn': 'V%d' % (k + 1)}
+                        for k in range(ENUM_VALUES)]
+                return res
+        raise KeyError(eid)
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    '''
+    Serves *server.data* over HTTP. Responses are gzipped when the client
+    accepts it, and carry an ETag answered with 304 on If-None-Match.
+    '''
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        url = urlparse(self.path)
+        baseurl = 'http://%s' % self.headers.get('Host', '%s:%d' % server.server_address)
+
+        if server.error_rate and _mix(server.next_count()) < server.error_rate:
+            # Simulert overlast
+            self._send(503, [{'code': 5030, 'message': 'Prøv igjen'}],
+                       {'Retry-After': '1'})
+            return
+
+        status, body = server.data.respond(url.path, parse_qs(url.query), baseurl)
+        self._send(status, body)
+
+    def _send(self, status, body, headers=None):
+        content = json.dumps(body).encode('utf-8')
+        etag = '"%s"' % hashlib.sha1(content).hexdigest()
+        if status == 200 and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        gzipped = 'gzip' in (self.headers.get('Accept-Encoding') or '')
+        if gzipped:
+            comp = zlib.compressobj(6, zlib.DEFLATED, 31)
+            content = comp.compress(content) + comp.flush()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/vnd.vegvesen.nvdb-v2+json; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+        if status == 200:
+            self.send_header('ETag', etag)
+        if gzipped:
+            self.send_header('Content-Encoding', 'gzip')
+        for key, val in (headers or {}).items():
+            self.send_header(key, val)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, fmt, *args):
+        logger.debug('%s - %s', self.address_string(), fmt % args)
+
+
+class StandinServer(ThreadingMixIn, HTTPServer):
+    '''
+    Threaded HTTP server for *SyntheticNvdb* data
+
+    :param address: *(host, port)*, port 0 picks a free port
+    :param data: *SyntheticNvdb* instance
+    :param latency: Seconds to wait before each response
+    :param error_rate: Share of requests answered with 503
+    '''
+    daemon_threads = True
+
+    def __init__(self, address, data, latency=0., error_rate=0.):
+        HTTPServer.__init__(self, address, StandinHandler)
+        self.data = data
+        self.latency = float(latency)
+        self.error_rate = int(float(error_rate) * 0xffffffff)
+        self._count = 0
+        self._count_lock = threading.Lock()
+
+    @property
+    def baseurl(self):
+        host, port = self.server_address[:2]
+        return 'http://%s:%d' % (host, port)
+
+    def next_count(self):
+        with self._count_lock:
+            self._count += 1
+            return self._count
+
+
+def start(host='127.0.0.1', port=0, latency=0., error_rate=0., **options):
+    '''
+    Starts a stand-in server in a background thread and returns it. Use
+    *server.baseurl* as baseurl, and *server.shutdown()* to stop it.
+
+    :param options: Passed on to *SyntheticNvdb*
+    '''
+    server = StandinServer((host, port), SyntheticNvdb(**options),
+                           latency=latency, error_rate=error_rate)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Lokal NVDB v2 med syntetiske data')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--types', type=int, default=20, help='antall objekttyper')
+    parser.add_argument('--objects', type=int, default=100000, help='objekter pr type')
+    parser.add_argument('--egenskaper', type=int, default=12, help='egenskaper pr type')
+    parser.add_argument('--min-points', type=int, default=2)
+    parser.add_argument('--max-points', type=int, default=50)
+    parser.add_argument('--deleted', type=int, default=1000, help='sletta objekter pr type')
+    parser.add_argument('--fylker', type=int, default=11)
+    parser.add_argument('--kommuner', type=int, default=30, help='kommuner pr fylke')
+    parser.add_argument('--mixed', type=float, default=0.,
+                        help='andel objekter med avvikende geometritype')
+    parser.add_argument('--crossing', type=float, default=0.,
+                        help='andel objekter som ligger i to kommuner')
+    parser.add_argument('--max-page', type=int, default=10000)
+    parser.add_argument('--latency', type=float, default=0., help='sekunder pr kall')
+    parser.add_argument('--error-rate', type=float, default=0., help='andel kall som gir 503')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    data = SyntheticNvdb(types=args.types, objects=args.objects,
+                         egenskaper=args.egenskaper,
+                         points=(args.min_points, args.max_points),
+                         deleted=args.deleted, fylker=args.fylker,
+                         kommuner=args.kommuner, mixed=args.mixed,
+                         crossing=args.crossing, max_page=args.max_page,
+                         seed=args.seed)
+    server = StandinServer((args.host, args.port), data, latency=args.latency,
+                           error_rate=args.error_rate)
+    logger.info('NVDB stand-in på %s', server.baseurl)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+'''
+Fast parsing of the timestamps returned by NVDB.
+
+NVDB only uses a few fixed shapes, *YYYY-MM-DD* and
+*YYYY-MM-DDTHH:MM:SS* with an optional fraction and an optional offset
+(*+HH:MM*, *+HHMM* or *Z*). These are parsed by slicing the string
+directly, and results are memoized since many objects share dates.
+
+Run the module to compare with *datetime.strptime*.
+'''
+import sys
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+if sys.version_info[0] < 3:
+    string_types = basestring  # @UndefinedVariable
+else:
+    string_types = str
+
+# NVDB oppgir ikkje alltid tidssone, då er det norsk vintertid
+DEFAULT_OFFSET = timedelta(hours=1.0)
+
+
+def lru_memo(maxsize=4096):
+    '''
+    Decorator memoizing a single argument function, keeping the *maxsize*
+    most recently used results. Works on both python 2 and 3.
+    '''
+    def decorator(func):
+        cache = OrderedDict()
+        lock = threading.Lock()
+
+        if hasattr(cache, 'move_to_end'):
+            touch = cache.move_to_end
+        else:
+            def touch(arg):
+                cache[arg] = cache.pop(arg)
+
+        def wrapper(arg):
+            try:
+                res = cache[arg]
+            except KeyError:
+                pass
+            else:
+                try:
+                    touch(arg)
+                except KeyError:
+                    # Kasta ut av ein annan tråd i mellomtida
+                    pass
+                return res
+            res = func(arg)
+            with lock:
+                cache[arg] = res
+                if len(cache) > maxsize:
+                    cache.popitem(last=False)
+            return res
+        wrapper.cache_clear = cache.clear
+        wrapper.__doc__ = func.__doc__
+        wrapper.__name__ = func.__name__
+        return wrapper
+    return decorator
+
+
+def _parse(s):
+    '''
+    Returns *(datetime, offset)* for *s*, offset is None if *s* has no
+    timezone. Raises ValueError if *s* is not an NVDB timestamp.
+    '''
+    n = len(s)
+    if n < 10 or s[4] != '-' or s[7] != '-':
+        raise ValueError('Ukjent tidsformat: %r' % (s,))
+    year, month, day = int(s[:4]), int(s[5:7]), int(s[8:10])
+    if n == 10:
+        return datetime(year, month, day), None
+    if n < 19 or s[10] != 'T' or s[13] != ':' or s[16] != ':':
+        raise ValueError('Ukjent tidsformat: %r' % (s,))
+    hour, minute, second = int(s[11:13]), int(s[14:16]), int(s[17:19])
+    i = 19
+    microsecond = 0
+    if i < n and s[i] == '.':
+        j = i + 1
+        while j < n and s[j].isdigit():
+            j += 1
+        if j == i + 1:
+            raise ValueError('Ukjent tidsformat: %r' % (s,))
+        microsecond = int(s[i + 1:j][:6].ljust(6, '0'))
+        i = j
+    dtime = datetime(year, month, day, hour, minute, second, microsecond)
+    tz = s[i:]
+    if not tz:
+        return dtime, None
+    if tz == 'Z':
+        return dtime, timedelta(0)
+    if tz[0] not in '+-':
+        raise ValueError('Ukjent tidsformat: %r' % (s,))
+    if len(tz) == 6 and tz[3] == ':':
+        hh, mm = tz[1:3], tz[4:6]
+    elif len(tz) == 5:
+        hh, mm = tz[1:3], tz[3:5]
+    else:
+        raise ValueError('Ukjent tidsformat: %r' % (s,))
+    offset = timedelta(hours=int(hh), minutes=int(mm))
+    if tz[0] == '-':
+        offset = -offset
+    return dtime, offset
+
+
+@lru_memo()
+def _parse_memo(s):
+    try:
+        return _parse(s)
+    except ValueError:
+        return None
+
+
+def parse_date(s):
+    '''
+    Returns naive datetime for NVDB date or timestamp *s*, the timezone is
+    dropped. Returns None if *s* is not a recognized timestamp.
+
+    :param s: String like 2019-06-20 or 2019-06-20T12:00:00+02:00
+    '''
+    if not isinstance(s, string_types):
+        return None
+    res = _parse_memo(s)
+    if res is None:
+        return None
+    return res[0]
+
+
+def parse_full_time(s, default_offset=DEFAULT_OFFSET):
+    '''
+    Returns *(datetime, offset)* for NVDB timestamp *s*, where datetime is
+    naive local time and offset its UTC offset. Timestamps without timezone
+    get *default_offset*. Raises ValueError for unrecognized strings.
+
+    :param s: String like 2019-06-20T12:00:00+02:00
+    :param default_offset: Offset used when *s* has no timezone
+    '''
+    res = _parse_memo(s) if isinstance(s, string_types) else None
+    if res is None:
+        raise ValueError('Ukjent tidsformat: %r' % (s,))
+    dtime, offset = res
+    if offset is None:
+        offset = default_offset
+    return dtime, offset
+
+
+def is_date(s):
+    '''
+    Returns True if *s* is an NVDB date or timestamp
+    '''
+    return parse_date(s) is not None
+
+
+if __name__ == '__main__':
+    # Mikrobenchmark mot strptime-løkka som ble brukt tidligere
+    import random
+    from timeit import timeit
+
+    fmts = ['%Y-%m-%dT%H:%M:%S+02:00', '%Y-%m-%d']
+    random.seed(0)
+    dates = ['%04d-%02d-%02d' % (random.randint(1950, 2020),
+                                 random.randint(1, 12),
+                                 random.randint(1, 28))
+             for _ in range(2000)]
+    stamps = ['%sT%02d:%02d:%02d+02:00' % (d, random.randint(0, 23),
+                                          random.randint(0, 59),
+                                          random.randint(0, 59))
+              for d in dates]
+    # Typisk uttak: mange objekter deler samme dato
+    values = [random.choice(dates + stamps) for _ in range(100000)]
+
+    def old():
+        for v in values:
+            for fmt in fmts:
+                try:
+                    datetime.strptime(v, fmt)
+                    break
+                except ValueError:
+                    pass
+
+    def new_uncached():
+        for v in values:
+            _parse(v)
+
+    def new():
+        for v in values:
+            parse_date(v)
+
+    for v in values[:1000]:
+        assert parse_date(v) == datetime.strptime(v, fmts[0] if 'T' in v else fmts[1])
+
+    t_old = timeit(old, number=1)
+    t_raw = timeit(new_uncached, number=1)
+    _parse_memo.cache_clear()
+    t_new = timeit(new, number=1)
+    print('%d verdier' % len(values))
+    print('strptime:            %.3f s' % t_old)
+    print('slicing, uten memo:  %.3f s (%.1fx)' % (t_raw, t_old / t_raw))
+    print('slicing, med memo:   %.3f s (%.1fx)' % (t_new, t_old / t_new))